@@ -53,9 +53,9 @@ If action is "add", the following options are supported:
 &params;
 
 For the actions tidy and tree, the bot will store the category structure
-locally in category.dump. This saves time and server load, but if it uses
-these data later, they may be outdated; use the -rebuild parameter in this
-case.
+locally in category.db. This saves time and server load. Entries older than
+config.category_db_ttl days are checked against the wiki before they are
+used; use the -rebuild parameter to discard all of them.
 
 For example, to create a new category from a list of persons, type:
 
@@ -82,9 +82,13 @@ __version__ = '$Id$'
 # Distributed under the terms of the MIT license.
 #
 
-import os, re, pickle, bz2
+import os, re, time
+try:
+    import sqlite3 # Python 2.5
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
 import wikipedia as pywikibot
-import catlib, config, pagegenerators
+import catlib, config, pagegenerators, query
 
 # This is required for the text that is shown when you run this script
 # with the parameter -help.
@@ -233,31 +237,136 @@ class CategoryDatabase:
     This is a temporary knowledge base saving for each category the contained
     subcategories and articles, so that category pages do not need to
     be loaded over and over again
+
+    The titles are kept in an SQLite database. Categories are only read
+    from it when they are needed, and only new or changed entries are
+    written. Entries older than config.category_db_ttl days are checked
+    against the wiki before they are used: the category contents are kept
+    if the number of members is the same and no member has been added
+    since, the supercategories if the category page hasn't been touched.
     '''
-    def __init__(self, rebuild = False, filename = 'category.dump.bz2'):
+    def __init__(self, rebuild = False, filename = 'category.db'):
+        if not os.path.isabs(filename):
+            filename = pywikibot.config.datafilepath(filename)
+        self.filename = filename
+        self.ttl = pywikibot.config.category_db_ttl * 86400
+        try:
+            self._connect()
+        except sqlite3.DatabaseError, error:
+            pywikibot.output(u'Category database %s is unreadable (%s), creating a new one.'
+                             % (pywikibot.config.shortpath(filename), error))
+            self.db.close()
+            os.remove(filename)
+            self._connect()
         if rebuild:
             self.rebuild()
-        else:
-            try:
-                if not os.path.isabs(filename):
-                    filename = pywikibot.config.datafilepath(filename)
-                f = bz2.BZ2File(filename, 'r')
-                pywikibot.output(u'Reading dump from %s'
-                                 % pywikibot.config.shortpath(filename))
-                databases = pickle.load(f)
-                f.close()
-                # keys are categories, values are 2-tuples with lists as entries.
-                self.catContentDB = databases['catContentDB']
-                # like the above, but for supercategories
-                self.superclassDB = databases['superclassDB']
-                del databases
-            except:
-                # If something goes wrong, just rebuild the database
-                self.rebuild()
+
+    def _connect(self):
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                               site TEXT, title TEXT, kind TEXT, fetched REAL,
+                               size INTEGER, PRIMARY KEY (site, title, kind))''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS links (
+                               site TEXT, title TEXT, kind TEXT, target TEXT)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS links_title
+                               ON links (site, title, kind)''')
+        self.db.commit()
+        # the entries which have been used during this run
+        self.catContentDB = {}
+        self.superclassDB = {}
 
     def rebuild(self):
-        self.catContentDB={}
-        self.superclassDB={}
+        self.db.execute('DELETE FROM entries')
+        self.db.execute('DELETE FROM links')
+        self.db.commit()
+        self.catContentDB = {}
+        self.superclassDB = {}
+
+    def _load(self, cat, kind):
+        """Return (fetched, size, links) of the stored entry, or None."""
+        key = (repr(cat.site()), cat.title())
+        row = self.db.execute('SELECT fetched, size FROM entries '
+                              'WHERE site = ? AND title = ? AND kind = ?',
+                              key + (kind,)).fetchone()
+        if row is None:
+            return None
+        links = self.db.execute('SELECT kind, target FROM links '
+                                'WHERE site = ? AND title = ? AND kind IN (?, ?) '
+                                'ORDER BY rowid',
+                                key + self._linkKinds[kind]).fetchall()
+        return row[0], row[1], links
+
+    _linkKinds = {
+        'contents': ('subcat', 'article'),
+        'supercats': ('supercat', 'supercat'),
+    }
+
+    def _store(self, cat, kind, size, links):
+        key = (repr(cat.site()), cat.title())
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                        key + (kind, time.time(), size))
+        self.db.execute('DELETE FROM links WHERE site = ? AND title = ? '
+                        'AND kind IN (?, ?)', key + self._linkKinds[kind])
+        self.db.executemany('INSERT INTO links VALUES (?, ?, ?, ?)',
+                            [key + link for link in links])
+
+    def _touch(self, cat, kind):
+        self.db.execute('UPDATE entries SET fetched = ? '
+                        'WHERE site = ? AND title = ? AND kind = ?',
+                        (time.time(), repr(cat.site()), cat.title(), kind))
+
+    def _isValid(self, cat, kind, fetched, size):
+        """Check whether a stored entry is still up to date."""
+        if time.time() - fetched < self.ttl:
+            return True
+        site = cat.site()
+        if not site.has_api():
+            return False
+        params = {
+            'action': 'query',
+            'titles': cat.title(),
+            'prop': ['info', 'categoryinfo'],
+            'list': 'categorymembers',
+            'cmtitle': cat.title(),
+            'cmsort': 'timestamp',
+            'cmdir': 'desc',
+            'cmprop': 'timestamp',
+            'cmlimit': 1,
+        }
+        pywikibot.get_throttle()
+        data = query.GetData(params, site)
+        if 'error' in data:
+            return False
+        since = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(fetched))
+        page = data['query']['pages'].values()[0]
+        if kind == 'supercats':
+            valid = page.get('touched', '') <= since
+        else:
+            members = data['query']['categorymembers']
+            valid = page.get('categoryinfo', {}).get('size', 0) == size and \
+                    (not members or members[0]['timestamp'] <= since)
+        if valid:
+            self._touch(cat, kind)
+        return valid
+
+    def _getContents(self, cat):
+        if cat in self.catContentDB:
+            return self.catContentDB[cat]
+        site = cat.site()
+        entry = self._load(cat, 'contents')
+        if entry and self._isValid(cat, 'contents', entry[0], entry[1]):
+            subcatlist = [catlib.Category(site, title)
+                          for kind, title in entry[2] if kind == 'subcat']
+            articlelist = [pywikibot.Page(site, title)
+                           for kind, title in entry[2] if kind == 'article']
+        else:
+            subcatlist = catlib.unique(list(cat.subcategories(cacheResults=True)))
+            articlelist = catlib.unique(list(cat.articles(cacheResults=True)))
+            self._store(cat, 'contents', len(subcatlist) + len(articlelist),
+                        [('subcat', c.title()) for c in subcatlist] +
+                        [('article', a.title()) for a in articlelist])
+        self.catContentDB[cat] = (subcatlist, articlelist)
+        return subcatlist, articlelist
 
     def getSubcats(self, supercat):
         '''
@@ -266,15 +375,7 @@ class CategoryDatabase:
         Saves this list in a temporary database so that it won't be loaded from the
         server next time it's required.
         '''
-        # if we already know which subcategories exist here
-        if supercat in self.catContentDB:
-            return self.catContentDB[supercat][0]
-        else:
-            subcatlist = supercat.subcategoriesList()
-            articlelist = supercat.articlesList()
-            # add to dictionary
-            self.catContentDB[supercat] = (subcatlist, articlelist)
-            return subcatlist
+        return self._getContents(supercat)[0]
 
     def getArticles(self, cat):
         '''
@@ -282,45 +383,31 @@ class CategoryDatabase:
         Saves this list in a temporary database so that it won't be loaded from the
         server next time it's required.
         '''
-        # if we already know which articles exist here
-        if cat in self.catContentDB:
-            return self.catContentDB[cat][1]
-        else:
-            subcatlist = cat.subcategoriesList()
-            articlelist = cat.articlesList()
-            # add to dictionary
-            self.catContentDB[cat] = (subcatlist, articlelist)
-            return articlelist
+        return self._getContents(cat)[1]
 
     def getSupercats(self, subcat):
         # if we already know which subcategories exist here
         if subcat in self.superclassDB:
             return self.superclassDB[subcat]
+        entry = self._load(subcat, 'supercats')
+        if entry and self._isValid(subcat, 'supercats', entry[0], entry[1]):
+            supercatlist = [catlib.Category(subcat.site(), title)
+                            for kind, title in entry[2]]
         else:
             supercatlist = subcat.supercategoriesList()
-            # add to dictionary
-            self.superclassDB[subcat] = supercatlist
-            return supercatlist
+            self._store(subcat, 'supercats', len(supercatlist),
+                        [('supercat', c.title()) for c in supercatlist])
+        # add to dictionary
+        self.superclassDB[subcat] = supercatlist
+        return supercatlist
 
-    def dump(self, filename = 'category.dump.bz2'):
+    def dump(self, filename = None):
         '''
-        Saves the contents of the dictionaries superclassDB and catContentDB to disk.
+        Saves the changed entries to disk.
         '''
-        if not os.path.isabs(filename):
-            filename = pywikibot.config.datafilepath(filename)
-        pywikibot.output(u'Dumping to %s, please wait...'
-                         % pywikibot.config.shortpath(filename))
-        f = bz2.BZ2File(filename, 'w')
-        databases = {
-            'catContentDB': self.catContentDB,
-            'superclassDB': self.superclassDB
-        }
-        # store dump to disk in binary format
-        try:
-            pickle.dump(databases, f, protocol=pickle.HIGHEST_PROTOCOL)
-        except pickle.PicklingError:
-            pass
-        f.close()
+        pywikibot.output(u'Saving category database to %s'
+                         % pywikibot.config.shortpath(self.filename))
+        self.db.commit()
 
 def sorted_by_last_name(catlink, pagelink):
         '''Return a Category with key that sorts persons by their last names.
@@ -14,7 +14,8 @@ Library to work with category pages on Wikipedia
 #
 __version__ = '$Id$'
 #
-import re, time, urllib, query
+import re, sys, time, urllib, query
+import threading, Queue
 import wikipedia
 try:
     set # introduced in Python 2.4: faster and future
@@ -108,70 +109,34 @@ class Category(wikipedia.Page):
         cached results will be discarded. If startFrom is used, nothing
         will be cached.
 
+        cache is a set of the pages that have already been yielded and must
+        not be yielded again.
+
         This should not be used outside of this module.
         """
-        if cache is None:
-            cache = []
         if purge:
             self.completelyCached = False
-        if recurse:
-            if type(recurse) is int:
-                newrecurse = recurse - 1
-            else:
-                newrecurse = recurse
-        if self.completelyCached:
-            for article in self.articleCache:
-                if article not in cache:
-                    cache.append(article)
-                    yield ARTICLE, article
-            for subcat in self.subcatCache:
-                if subcat not in cache:
-                    cache.append(subcat)
-                    yield SUBCATEGORY, subcat
-                    if recurse:
-                        # contents of subcategory are cached by calling
-                        # this method recursively; therefore, do not cache
-                        # them again
-                        for item in subcat._getAndCacheContents(newrecurse, purge, cache=cache):
-                            yield item
-        else:
-            for tag, page in self._parseCategory(purge, startFrom):
-                if tag == ARTICLE:
-                    self.articleCache.append(page)
-                    if not page in cache:
-                        cache.append(page)
-                        yield ARTICLE, page
-                elif tag == SUBCATEGORY:
-                    self.subcatCache.append(page)
-                    if not page in cache:
-                        cache.append(page)
-                        yield SUBCATEGORY, page
-                        if recurse:
-                            # contents of subcategory are cached by calling
-                            # this method recursively; therefore, do not cache
-                            # them again
-                            for item in page._getAndCacheContents(newrecurse, purge, cache=cache):
-                                yield item
-            if not startFrom:
-                self.completelyCached = True
+        return CategoryWalker([self], recurse, purge, startFrom,
+                              cacheResults=True, visited=cache)
 
     def _getContentsNaive(self, recurse=False, startFrom=None):
         """
         Simple category content yielder. Naive, do not attempts to
         cache anything
         """
-        for tag, page in self._parseCategory(startFrom=startFrom):
-            yield tag, page
-            if tag == SUBCATEGORY and recurse:
-                for item in page._getContentsNaive(recurse=True):
-                    yield item
+        if recurse:
+            return CategoryWalker([self], recurse, startFrom=startFrom)
+        return self._parseCategory(startFrom=startFrom)
 
-    def _parseCategory(self, purge=False, startFrom=None):
+    def _parseCategory(self, purge=False, startFrom=None, throttle=None):
         """
         Yields all articles and subcategories that are in this category by API.
 
         Set startFrom to a string which is the title of the page to start from.
 
+        throttle is called before each request; defaults to
+        wikipedia.get_throttle.
+
         Yielded results are tuples in the form (tag, page) where tag is one
         of the constants ARTICLE and SUBCATEGORY, and title is the Page or Category
         object.
@@ -180,8 +145,10 @@ class Category(wikipedia.Page):
 
         This should not be used outside of this module.
         """
+        if throttle is None:
+            throttle = wikipedia.get_throttle
         if not self.site().has_api() or self.site().versionnumber() < 11:
-            for tag, page in self._oldParseCategory(purge, startFrom):
+            for tag, page in self._oldParseCategory(purge, startFrom, throttle):
                 yield tag, page
             return
         
@@ -210,7 +177,7 @@ class Category(wikipedia.Page):
             else:
                 wikipedia.output('Getting [[%s]]...' % self.title())
 
-            wikipedia.get_throttle()
+            throttle()
             data = query.GetData(params, self.site())
             if 'error' in data:
                 raise RuntimeError("%s" % data['error'])
@@ -233,7 +200,7 @@ class Category(wikipedia.Page):
             else:
                 break
 
-    def _oldParseCategory(self, purge=False, startFrom=None):
+    def _oldParseCategory(self, purge=False, startFrom=None, throttle=None):
         """
         Yields all articles and subcategories that are in this category.
 
@@ -249,6 +216,8 @@ class Category(wikipedia.Page):
 
         This should not be used outside of this module.
         """
+        if throttle is None:
+            throttle = wikipedia.get_throttle
         if self.site().versionnumber() < 4:
             Rtitle = re.compile('title\s?=\s?\"([^\"]*)\"')
         elif self.site().versionnumber() < 8:
@@ -283,7 +252,7 @@ class Category(wikipedia.Page):
                                  % (self.title(), wikipedia.url2link(currentPageOffset, self.site(), self.site())))
             else:
                 wikipedia.output('Getting [[%s]]...' % self.title())
-            wikipedia.get_throttle()
+            throttle()
             txt = self.site().getUrl(path)
             # index where subcategory listing begins
             if self.site().versionnumber() >= 9:
@@ -354,6 +323,8 @@ class Category(wikipedia.Page):
         categories
 
         Results a sorted (as sorted by MediaWiki), but need not be unique.
+        When recursing, subcategories are walked level by level (see
+        CategoryWalker) and the results are unique.
         """
         if cacheResults:
             gen = self._getAndCacheContents
@@ -391,7 +362,7 @@ class Category(wikipedia.Page):
         categories
 
         Results are unsorted (except as sorted by MediaWiki), and need not
-        be unique.
+        be unique, except when recursing.
         """
         if cacheResults:
             gen = self._getAndCacheContents
@@ -489,6 +460,145 @@ class Category(wikipedia.Page):
         targetCat.put(newtext, creationSummary)
         return True
 
+class CategoryWalker(object):
+    """
+    Breadth-first walk through the contents of categories and their
+    subcategories.
+
+    Iterating yields (tag, page) tuples like Category._parseCategory(), but
+    each page only once, even if the category tree contains cycles. The
+    categories of one level of the tree are retrieved at the same time by a
+    pool of worker threads; requests to one site are still slowed down by
+    that site's own throttle (see wikipedia.getSiteThrottle()). Results are
+    yielded as soon as they arrive, so the order within a level depends on
+    the server's response times.
+
+    Arguments:
+      categories   - list of Category objects to start from
+      recurse      - True to walk all subcategories, an int to walk only
+                     that many levels deep, False to list only categories
+      purge        - see Category._parseCategory()
+      startFrom    - start the listing of the start categories at this
+                     sort key
+      workers      - number of categories to retrieve at the same time;
+                     defaults to config.category_workers
+      cacheResults - reuse and fill the content caches of the Category
+                     objects, see Category.subcategories()
+      visited      - set of pages that must not be yielded; updated while
+                     walking
+
+    """
+    def __init__(self, categories, recurse=True, purge=False, startFrom=None,
+                 workers=None, cacheResults=False, visited=None):
+        self.categories = categories
+        self.recurse = recurse
+        self.purge = purge
+        self.startFrom = startFrom
+        if workers is None:
+            workers = wikipedia.config.category_workers
+        self.workers = max(1, workers)
+        self.cacheResults = cacheResults
+        if visited is None:
+            visited = set()
+        self.visited = visited
+
+    def __iter__(self):
+        level = list(self.categories)
+        self.visited.update(level)
+        depth = 0
+        while level:
+            depth += 1
+            expand = self.recurse is True or \
+                     (self.recurse and depth <= self.recurse)
+            nextLevel = []
+            for tag, page in self._level(level, depth == 1):
+                if page in self.visited:
+                    continue
+                self.visited.add(page)
+                yield tag, page
+                if tag == SUBCATEGORY and expand:
+                    nextLevel.append(page)
+            level = nextLevel
+
+    def _level(self, level, first):
+        """Yield the contents of all categories in level."""
+        queue = Queue.Queue()
+        for cat in level:
+            queue.put(cat)
+        results = Queue.Queue()
+        self.stopped = False
+        threads = []
+        for i in range(min(self.workers, len(level))):
+            thread = threading.Thread(target=self._work,
+                                      args=(queue, results, first))
+            thread.setName('Category-Thread-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        try:
+            running = len(threads)
+            while running:
+                # get with a timeout, so that KeyboardInterrupt gets through
+                try:
+                    item = results.get(True, 1)
+                except Queue.Empty:
+                    continue
+                if item is None:
+                    running -= 1
+                elif isinstance(item, tuple) and len(item) == 3:
+                    exc_type, exc_value, exc_traceback = item
+                    raise exc_type, exc_value, exc_traceback
+                else:
+                    yield item
+        finally:
+            # also stops the workers if the caller doesn't need more results
+            self.stopped = True
+
+    def _work(self, queue, results, first):
+        try:
+            try:
+                while not self.stopped:
+                    try:
+                        cat = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    for item in self._contents(cat, first):
+                        if self.stopped:
+                            return
+                        results.put(item)
+            except:
+                results.put(sys.exc_info())
+        finally:
+            results.put(None)
+
+    def _contents(self, cat, first):
+        """Yield the (tag, page) tuples of one category."""
+        if first:
+            startFrom = self.startFrom
+        else:
+            startFrom = None
+        if self.cacheResults and cat.completelyCached and not self.purge:
+            for article in cat.articleCache:
+                yield ARTICLE, article
+            for subcat in cat.subcatCache:
+                yield SUBCATEGORY, subcat
+            return
+        cache = self.cacheResults and not startFrom
+        if cache:
+            cat.articleCache = []
+            cat.subcatCache = []
+        for tag, page in cat._parseCategory(
+                self.purge, startFrom,
+                throttle=wikipedia.getSiteThrottle(cat.site())):
+            if cache:
+                if tag == ARTICLE:
+                    cat.articleCache.append(page)
+                else:
+                    cat.subcatCache.append(page)
+            yield tag, page
+        if cache:
+            cat.completelyCached = True
+
 #def Category(code, name):
 #    """Factory method to create category link objects from the category name"""
 #    # Standardized namespace
@@ -241,11 +241,21 @@ interwiki_graph_url = None
 # Save file with local articles without interwikis.
 without_interwiki = False
 
+# Maximum number of sites from which interwiki.py loads pages at the same
+# time. Each site is queried under its own throttle; subjects go on as soon
+# as the pages of their site have arrived. 1 queries one site after another.
+interwiki_parallel_queries = 1
+
 # Experimental feature:
 # Store the page contents on disk (/cache/ directory) instead of loading
 # them in RAM.
 interwiki_contents_on_disk = False
 
+# Maximum number of characters of page contents which are kept in memory
+# when interwiki_contents_on_disk is enabled. The least recently used
+# contents are dropped first; they are read back from disk when needed.
+interwiki_contents_memory_size = 1000000
+
 ############## SOLVE_DISAMBIGUATION SETTINGS ############
 #
 # Set disambiguation_comment[FAMILY][LANG] to a non-empty string to override
@@ -276,6 +286,14 @@ maxthrottle = 60
 # 'put_throttle' seconds.
 put_throttle = 10
 
+# Share the access rate of each site between all bot processes running on
+# this computer, instead of multiplying the delays above by the number of
+# processes. Reads may be made in bursts of up to 'throttle_burst' requests
+# if the bot has not accessed the site for a while; the average rate stays
+# the same. Database lag reported by the server slows down all processes.
+shared_throttle = False
+throttle_burst = 3
+
 # Sometimes you want to know when a delay is inserted. If a delay is larger
 # than 'noisysleep' seconds, it is logged on the screen.
 noisysleep = 3.0
@@ -297,6 +315,30 @@ maxretries = 5
 # running solve_disambiguation.py with the -primary argument.
 special_page_limit = 500
 
+# Number of chunks of pages that wikipedia.getall() retrieves at the same
+# time. Chunks for one site are still slowed down by that site's throttle,
+# chunks for different sites don't wait for each other. Set to 1 to fetch
+# the chunks one after another.
+getall_workers = 1
+
+# Number of templates whose transclusions templatecount.py queries at the
+# same time through the API. Set to 0 to use the old, serial method.
+templatecount_workers = 4
+
+# Number of categories that catlib.CategoryWalker retrieves at the same time
+# when walking through a category tree. Requests to one site are still
+# slowed down by that site's throttle.
+category_workers = 4
+
+# Number of days after which category.py checks whether the entries of its
+# category database (category.db) are still up to date.
+category_db_ttl = 7
+
+# Maximum number of edits by which the words that spellcheck.py suggests
+# with the g option may differ from the unknown word. Higher values find
+# more distant words, but make the search slower.
+spellcheck_max_distance = 3
+
 ############## TABLE CONVERSION BOT SETTINGS ##############
 
 # will split long paragraphs for better reading the source.
@@ -315,6 +357,9 @@ table2wikiSkipWarnings = False
 # If you have a fast connection, you might want to increase this number so
 # that slow servers won't slow you down.
 max_external_links = 50
+# How many links to the same host should weblinkchecker.py check at the same
+# time? Keep this low to avoid hammering single servers.
+max_external_links_per_host = 2
 
 report_dead_links_on_talk = False
 
@@ -420,12 +465,18 @@ copyright_show_length = True
 copyright_economize_query = True
 
 ############## HTTP SETTINGS ##############
-# Use a persistent http connection. An http connection has to be established
-# only once per site object, making stuff a whole lot faster. Do NOT EVER
-# use this if you share Site objects across threads without proper locking.
-## DISABLED FUNCTION. Setting this variable will not have any effect.
+# Use persistent (keep-alive) http connections. Connections are kept in a
+# thread-safe pool shared by all sites, so a connection to a host has to be
+# established only once, making stuff a whole lot faster.
 persistent_http = False
 
+# Maximum number of idle persistent connections kept open for each host.
+persistent_http_pool_size = 4
+
+# Idle persistent connections older than this number of seconds are closed
+# instead of being reused, as the server has probably dropped them already.
+persistent_http_idle_timeout = 30
+
 # Default socket timeout. Set to None to disable timeouts.
 socket_timeout = 120  # set a pretty long timeout just in case...
 
@@ -461,6 +512,14 @@ cosmetic_changes_enable = {}
 cosmetic_changes_disable = {}
 # Use the experimental disk cache to prevent huge memory usage
 use_diskcache = False
+# The disk cache of MediaWiki messages is kept between runs; it is loaded
+# again from the wiki when it is older than this number of days.
+diskcache_max_age = 7
+
+# Number of page titles per site whose normalized form is remembered, so
+# that constructing a Page for the same title again is cheap. The memo is
+# emptied when it is full.
+page_title_cache_size = 10000
 
 # Retry loading a page on failure (back off 1 minute, 2 minutes, 4 minutes
 # up to 30 minutes)
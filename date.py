@@ -17,6 +17,7 @@ __version__='$Id$'
 # used for date recognition
 import types
 import re
+import threading
 import wikipedia
 
 #
@@ -170,6 +171,8 @@ def slh( value, lst ):
             formats['MonthName']['en'](u'anything else') => raise ValueError
     """
     if type(value) in _stringTypes:
+        if _recording is not None:
+            _recording.append(('list', lst))
         return lst.index(value)+1
     else:
         return lst[value-1]
@@ -182,6 +185,8 @@ def dh_constVal( value, ind, match ):
             formats['CurrEvents']['en'](ind) => u'Current Events'
             formats['CurrEvents']['en'](u'Current Events') => ind"""
     if type(value) in _stringTypes:
+        if _recording is not None:
+            _recording.append(('const', match))
         if value == match:
             return ind
         else:
@@ -282,6 +287,12 @@ _reParameters = re.compile(u'|'.join([ u'(%%[1-9]?%s)' % s for s in _digitDecode
 
 # A map of   sitecode+pattern  to  (re matching object and corresponding decoders)
 _escPtrnCache2 = {}
+# A map of   pattern  to  the regex source of the pattern without groups
+_escPtrnSource = {}
+
+# While getAutoFormat() examines a decoder, the patterns, lists and constants
+# which the decoder compares a string with are appended to this list.
+_recording = None
 
 # Allow both unicode and single-byte strings
 _stringTypes = [unicode, str]
@@ -292,8 +303,11 @@ def escapePattern2( pattern ):
     Allows matching of any _digitDecoders inside the string.
     Returns a compiled regex object and a list of digit decoders"""
 
+    if _recording is not None:
+        _recording.append(('pattern', pattern))
     if pattern not in _escPtrnCache2:
         newPattern = u'^' # begining of the string
+        plainPattern = u''
         strPattern = u''
         decoders = []
         for s in _reParameters.split(pattern):
@@ -306,23 +320,28 @@ def escapePattern2( pattern ):
                     # Special case for strings that are replaced instead of decoded
                     if len(s) == 3: raise AssertionError("Invalid pattern %s: Cannot use zero padding size in %s!" % (pattern, s))
                     newPattern += re.escape( dec )
+                    plainPattern += re.escape( dec )
                     strPattern += s         # Keep the original text
                 else:
                     if len(s) == 3:
                         newPattern += u'([%s]{%s})' % (dec[0], s[1])    # enforce mandatory field size
+                        plainPattern += u'[%s]{%s}' % (dec[0], s[1])
                         dec += (int(s[1]),)   # add the number of required digits as the last (4th) part of the tuple
                     else:
                         newPattern += u'([%s]+)' % dec[0]
+                        plainPattern += u'[%s]+' % dec[0]
 
                     decoders.append( dec )
                     strPattern += u'%s'     # All encoders produce a string   # this causes problem with the zero padding. Need to rethink
             else:
                 newPattern += re.escape( s )
+                plainPattern += re.escape( s )
                 strPattern += s
 
         newPattern += u'$' # end of the string
         compiledPattern = re.compile( newPattern )
         _escPtrnCache2[pattern] = (compiledPattern, strPattern, decoders)
+        _escPtrnSource[pattern] = plainPattern
 
     return _escPtrnCache2[pattern]
 
@@ -1533,27 +1552,122 @@ def getNumberOfDaysInMonth(month):
     return formatLimits[dayMnthFmts[month-1]][2]-1
 
 
+class _AutoFormatDispatch(object):
+    """Finds the entries of formats which can decode a title, for one
+    language, without calling all the decoders.
+
+    Each decoder is called once with a string that nothing matches, while
+    the patterns (see dh()), lists (see slh()) and constants (see
+    dh_constVal()) it compares the string with are recorded. The patterns
+    of all entries are merged into a few regexes, one optional lookahead
+    group per entry, so that a single match finds all the entries whose
+    patterns match the title; the lists and constants are put into a dict.
+    Decoders that don't use any of these helpers are always tried.
+    """
+    # Python's re module allows 100 groups per regex
+    chunkSize = 90
+
+    def __init__(self, lang):
+        # (dictName, decoder) for each entry, in the order of formats
+        self.entries = []
+        # title -> indices of the entries
+        self.literals = {}
+        # indices of the entries that must always be tried
+        self.opaque = []
+        # (compiled regex, indices of the entries of its groups)
+        self.regexes = []
+        sources = []
+        for dictName, dict in formats.iteritems():
+            if lang not in dict:
+                continue
+            index = len(self.entries)
+            self.entries.append((dictName, dict[lang]))
+            recorded = _recordDecoder(dict[lang])
+            if not recorded or [item for kind, item in recorded
+                                if kind == 'pattern'
+                                and item not in _escPtrnSource]:
+                self.opaque.append(index)
+                continue
+            alternatives = []
+            for kind, item in recorded:
+                if kind == 'pattern':
+                    alternatives.append(_escPtrnSource[item])
+                elif kind == 'list':
+                    for value in item:
+                        self.literals.setdefault(value, set()).add(index)
+                else:
+                    self.literals.setdefault(item, set()).add(index)
+            if alternatives:
+                sources.append((index, u'|'.join(alternatives)))
+        for i in range(0, len(sources), self.chunkSize):
+            chunk = sources[i:i + self.chunkSize]
+            regex = re.compile(u''.join([u'(?:(?=(%s)$)|)' % source
+                                         for index, source in chunk]))
+            self.regexes.append((regex, [index for index, source in chunk]))
+
+    def candidates(self, title):
+        """Return the (dictName, decoder) entries that may decode title, in
+        the order of formats."""
+        found = set(self.opaque)
+        found.update(self.literals.get(title, ()))
+        for regex, indices in self.regexes:
+            m = regex.match(title)
+            if m.lastindex is not None:
+                groups = m.groups()
+                for i in range(len(groups)):
+                    if groups[i] is not None:
+                        found.add(indices[i])
+        found = list(found)
+        found.sort()
+        return [self.entries[i] for i in found]
+
+# A string that no decoder accepts
+_probeTitle = u'\uffff'
+_recordLock = threading.Lock()
+
+def _recordDecoder(decoder):
+    """Return the patterns, lists and constants that decoder compares a
+    string with, as a list of (kind, item) tuples."""
+    global _recording
+    _recordLock.acquire()
+    try:
+        _recording = []
+        try:
+            decoder(_probeTitle)
+        except:
+            # the decoder rejected the string, as expected
+            return _recording
+        # the decoder accepted the string; it must always be tried
+        return []
+    finally:
+        _recording = None
+        _recordLock.release()
+
+# language code -> _AutoFormatDispatch
+_autoFormatDispatch = {}
+
 def getAutoFormat( lang, title, ignoreFirstLetterCase = True ):
     """Returns (dictName,value), where value can be a year, date, etc, and dictName is 'YearBC', 'December', etc."""
-    for dictName, dict in formats.iteritems():
+    if lang not in _autoFormatDispatch:
+        _autoFormatDispatch[lang] = _AutoFormatDispatch(lang)
+    for dictName, decoder in _autoFormatDispatch[lang].candidates(title):
+        # a decoder can still reject the title, e.g. because the value is
+        # out of range
         try:
-            year = dict[ lang ]( title )
+            year = decoder( title )
             return (dictName,year)
         except:
             pass
 
     # sometimes the title may begin with an upper case while its listed as lower case, or the other way around
     # change case of the first character to the opposite, and try again
-    if ignoreFirstLetterCase:
-        try:
-            if title[0].isupper():
-                title = title[0].lower() + title[1:]
-            else:
-                title = title[0].upper() + title[1:]
+    if ignoreFirstLetterCase and title:
+        if title[0].isupper():
+            title = title[0].lower() + title[1:]
+        else:
+            title = title[0].upper() + title[1:]
 
-            return getAutoFormat(lang, title, ignoreFirstLetterCase = False)
-        except:
-            pass
+        return getAutoFormat(lang, title, ignoreFirstLetterCase = False)
 
     return (None,None)
 
@@ -3,65 +3,217 @@ __version__ = '$Id$'
 import random
 import config
 import os
-
-# http://mail.python.org/pipermail/python-list/2006-March/375280.html
-try:
-     os.SEEK_SET
-except AttributeError:
-     os.SEEK_SET, os.SEEK_CUR, os.SEEK_END = range(3)
+import mmap
+import struct
+import threading
+import time
+import zlib
 
 ## Dictionary like disk caching module
 ## (c) Copyright 2008 - Bryan Tong Minh / The Pywikipediabot team
 ## Licensed under the terms of the MIT license
 
-class CachedReadOnlyDictI(object):
-    """A cached readonly dict with case insensitive keys."""
-    def __init__(self, data, prefix = "", max_size = 10, cache_base = 'cache'):
+# File layout (all integers little endian, unsigned 32 bit):
+#
+#   header   'PWBDC1\0\0', number of slots, number of items
+#   slots    number of slots * (key hash, record offset); offset 0 = empty
+#   records  key length, key, value length, value
+#
+# Keys are lowercased and encoded as UTF-8; the key hash is the CRC32 of the
+# encoded key, so that it is the same in each run. Collisions are resolved by
+# linear probing; the table is kept at most half full.
+MAGIC = 'PWBDC1\0\0'
+_header = struct.Struct('<8sII')
+_slot = struct.Struct('<II')
+_length = struct.Struct('<I')
+
+def _key(key):
+    if type(key) is not unicode:
+        key = str(key).decode('utf-8')
+    return key.lower().encode('utf-8')
+
+def _hash(key):
+    return zlib.crc32(key) & 0xFFFFFFFF
+
+def _write(path, data):
+    """Write the (key, value) pairs in data to a new cache file at path."""
+    items = {}
+    for key, value in data:
+        if value is None:
+            value = u''
+        elif type(value) is not unicode:
+            value = str(value).decode('utf-8')
+        items[_key(key)] = value.encode('utf-8')
+    nslots = max(2 * len(items), 1)
+    slots = [(0, 0)] * nslots
+    records = []
+    offset = _header.size + nslots * _slot.size
+    for key, value in items.iteritems():
+        h = _hash(key)
+        i = h % nslots
+        while slots[i][1]:
+            i = (i + 1) % nslots
+        slots[i] = (h, offset)
+        records.append('%s%s%s%s' % (_length.pack(len(key)), key,
+                                     _length.pack(len(value)), value))
+        offset += 2 * _length.size + len(key) + len(value)
+    if offset > 0xFFFFFFFF:
+        raise RuntimeError('Cache file must be smaller than %i bytes'
+                           % 0xFFFFFFFF)
+
+    # Write to a temporary file first, so that a concurrent bot never sees
+    # a partially written cache.
+    tmp = '%s.%s.tmp' % (path, ''.join([random.choice('abcdefghijklmnopqrstuvwxyz')
+                                        for i in xrange(8)]))
+    f = open(tmp, 'wb')
+    try:
+        f.write(_header.pack(MAGIC, nslots, len(items)))
+        f.write(''.join([_slot.pack(h, o) for h, o in slots]))
+        f.write(''.join(records))
+    finally:
+        f.close()
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Windows doesn't replace existing files
+        os.unlink(path)
+        os.rename(tmp, path)
+
+class _LRU(object):
+    """A dict that holds at most max_size items, dropping the least recently
+    used one when full. Hits and insertions are O(1).
+
+    If sizeof is given, it is called on each value, and the sum of the
+    results is kept at most max_size instead of the number of items.
+    """
+    def __init__(self, max_size, sizeof = None):
         self.max_size = max_size
-        while True:
-            self.cache_path = config.datafilepath(cache_base, prefix + ''.join(
-                [random.choice('abcdefghijklmnopqrstuvwxyz')
-                    for i in xrange(16)]))
-            if not os.path.exists(self.cache_path): break
-        self.cache_file = open(self.cache_path, 'wb+')
-
-        lookup = [-1] * 36
-        data.sort(key = lambda i: i[0])
-        for key, value in data:
-            if type(key) is unicode:
-                key = key.encode('utf-8')
-            elif type(key) != str:
-                key = str(key)
-            key = key.lower()
-            index = key[0]
-            if not ((index >= 'a' and index <= 'z') or (index >= '0' and index <= '9')) or '\t' in key:
-                raise RuntimeError('Only alphabetic keys are supported', key)
-
-            if index < 'a':
-                index = ord(index) - 48 + 26 # Numeric
-            else:
-                index = ord(index) - 97
-            if lookup[index] == -1:
-                lookup[index] = self.cache_file.tell()
-
-            if type(value) is unicode:
-                value = value.encode('utf-8')
-            elif type(value) != str:
-                value = str(value)
-
-            if len(key) > 0xFF:
-                raise RuntimeError('Key length must be smaller than %i' % 0xFF)
-            if len(value) > 0xFFFFFF:
-                raise RuntimeError('Value length must be smaller than %i' % 0xFFFFFF)
-
-            self.cache_file.write('%02x%s%06x%s' % (len(key), key, len(value), value))
-
-        self.lookup = lookup
-
-        self.cache_file.close()
-        self.cache_file = open(self.cache_path, 'rb')
-        self.cache_file.seek(0)
-        self.cache = []
+        self.sizeof = sizeof
+        self.size = 0
+        self.map = {}
+        # circular doubly linked list of [prev, next, key, value, size]
+        # nodes, most recently used first
+        self.root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def __getitem__(self, key):
+        node = self.map[key]
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
+        root = self.root
+        first = root[1]
+        node[0], node[1] = root, first
+        first[0] = root[1] = node
+        return node[3]
+
+    def __setitem__(self, key, value):
+        if key in self.map:
+            self.pop(key)
+        if self.sizeof is None:
+            size = 1
+        else:
+            size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        root = self.root
+        while self.size + size > self.max_size:
+            last = root[0]
+            last[0][1] = root
+            root[0] = last[0]
+            del self.map[last[2]]
+            self.size -= last[4]
+        first = root[1]
+        node = [root, first, key, value, size]
+        first[0] = root[1] = node
+        self.map[key] = node
+        self.size += size
+
+    def pop(self, key, default = None):
+        """Remove key and return its value, or default if it isn't held."""
+        node = self.map.pop(key, None)
+        if node is None:
+            return default
+        node[0][1] = node[1]
+        node[1][0] = node[0]
+        self.size -= node[4]
+        return node[3]
+
+class CachedReadOnlyDictI(object):
+    """A cached readonly dict with case insensitive keys.
+
+    The items are stored in a hashed index file which is memory-mapped, so
+    lookups only read the record for the key asked for. The max_size most
+    recently used values are also kept in memory.
+
+    If name is given, the cache is stored as name in the cache_base
+    directory and kept after exit; open() can load it in a later run.
+    Otherwise a temporary file is used, which is removed by delete().
+
+    """
+    def __init__(self, data, prefix = "", max_size = 10, cache_base = 'cache',
+                 name = None):
+        if name is not None:
+            self.cache_path = config.datafilepath(cache_base, name)
+            self.persistent = True
+        else:
+            while True:
+                self.cache_path = config.datafilepath(cache_base, prefix + ''.join(
+                    [random.choice('abcdefghijklmnopqrstuvwxyz')
+                        for i in xrange(16)]))
+                if not os.path.exists(self.cache_path): break
+            self.persistent = False
+        if data is not None:
+            _write(self.cache_path, data)
+        self._open(max_size)
+
+    def _open(self, max_size):
+        f = open(self.cache_path, 'rb')
+        try:
+            self.mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if self.mmap.size() < _header.size:
+            self.mmap.close()
+            raise RuntimeError('Invalid cache file', self.cache_path)
+        magic, self.nslots, self.count = _header.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            self.mmap.close()
+            raise RuntimeError('Invalid cache file', self.cache_path)
+        self.cache = _LRU(max_size)
+
+    def open(cls, name, max_size = 10, cache_base = 'cache', max_age = None):
+        """Return the cache stored as name, or None if it doesn't exist, is
+        older than max_age seconds or can't be read.
+        """
+        path = config.datafilepath(cache_base, name)
+        try:
+            if max_age is not None and \
+               time.time() - os.path.getmtime(path) > max_age:
+                return None
+            return cls(None, max_size = max_size, cache_base = cache_base,
+                       name = name)
+        except (IOError, OSError, RuntimeError, EnvironmentError):
+            return None
+    open = classmethod(open)
+
+    def close(self):
+        """Release the cache file; remove it unless it is persistent.
+
+        Method is called from wikipedia._flush, on Python exit.
+        """
+        try:
+            self.mmap.close()
+        except (IOError, ValueError):
+            pass
+        if not self.persistent:
+            self.delete()
 
     def delete(self):
         """
@@ -73,8 +225,8 @@ class CachedReadOnlyDictI(object):
         3) Strange errors can be raised here, we don't care.
         """
         try:
-            self.cache_file.close()
-        except IOError:
+            self.mmap.close()
+        except (IOError, ValueError):
             pass
         try:
             try:
@@ -85,55 +237,165 @@ class CachedReadOnlyDictI(object):
         finally:
             os = None
 
-    def __getitem__(self, key):
-        key = key.lower()
-        if type(key) is unicode:
-            key = key.encode('utf-8')
+    def __len__(self):
+        return self.count
 
-        try:
-            index = key[0]
-        except IndexError:
-            raise KeyError(key)
-        if not ((index >= 'a' and index <= 'z') or (index >= '0' and index <= '9')):
-            raise KeyError(key)
-
-        if index < 'a':
-            i = ord(index) - 48 + 26 # Numeric
-        else:
-            i = ord(index) - 97
+    def __nonzero__(self):
+        return self.count > 0
 
-        for k, v in self.cache:
-            if k == key:
-                self.cache.remove((k, v))
-                self.cache.append((k, v))
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
 
+    def __getitem__(self, key):
+        key = _key(key)
         try:
-            k, v = self.cache[-1]
-            if k == key:
-                return v
-        except IndexError:
+            return self.cache[key]
+        except KeyError:
             pass
 
-        self.cache_file.seek(self.lookup[i])
+        m = self.mmap
+        h = _hash(key)
+        i = h % self.nslots
         while True:
-            length = int(self.read(2, key), 16)
-            k = self.read(length, key)
-            if k == key:
-                length = int(self.read(6, key), 16)
-                value = self.read(length, key).decode('utf-8')
-                if len(self.cache) > self.max_size:
-                    del self.cache[0]
-                self.cache.append((key, value))
-                return value
-
-            elif k[0] != index:
+            slot_h, offset = _slot.unpack_from(m, _header.size + i * _slot.size)
+            if not offset:
                 raise KeyError(key)
+            if slot_h == h:
+                length, = _length.unpack_from(m, offset)
+                offset += _length.size
+                if m[offset:offset + length] == key:
+                    offset += length
+                    length, = _length.unpack_from(m, offset)
+                    offset += _length.size
+                    value = m[offset:offset + length].decode('utf-8')
+                    self.cache[key] = value
+                    return value
+            i = (i + 1) % self.nslots
+
+class CompressedStore(object):
+    """A dict-like store for large string values, e.g. page contents.
 
-            length = int(self.read(6, key), 16)
-            self.cache_file.seek(length, os.SEEK_CUR)
+    The values are compressed and appended to a temporary file; only the
+    index of file offsets and the most recently used values, up to
+    memory_size characters, are kept in memory. When more than half of the
+    file is taken up by deleted or overwritten values, it is compacted.
+
+    Keys can be any hashable objects. Values must be str or unicode.
+
+    """
+    def __init__(self, prefix = 'store', memory_size = 1000000,
+                 cache_base = 'cache'):
+        while True:
+            self.path = config.datafilepath(cache_base, prefix + ''.join(
+                [random.choice('abcdefghijklmnopqrstuvwxyz')
+                    for i in xrange(16)]))
+            if not os.path.exists(self.path): break
+        self.file = open(self.path, 'w+b')
+        # key -> (offset, length) of the record in the file
+        self.index = {}
+        self.end = 0
+        self.dead = 0
+        self.cache = _LRU(memory_size, len)
+        self.lock = threading.RLock()
 
+    def __len__(self):
+        return len(self.index)
 
-    def read(self, length, key = ''):
-        s = self.cache_file.read(length)
-        if not s: raise KeyError(key)
-        return s
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        self.lock.acquire()
+        try:
+            try:
+                return self.cache[key]
+            except KeyError:
+                pass
+            offset, length = self.index[key]
+            self.file.seek(offset)
+            record = self.file.read(length)
+            value = zlib.decompress(record[1:])
+            if record[0] == 'u':
+                value = value.decode('utf-8')
+            self.cache[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def __setitem__(self, key, value):
+        if type(value) is unicode:
+            record = 'u' + zlib.compress(value.encode('utf-8'), 1)
+        else:
+            record = 's' + zlib.compress(value, 1)
+        self.lock.acquire()
+        try:
+            if key in self.index:
+                self.dead += self.index[key][1]
+            self.file.seek(self.end)
+            self.file.write(record)
+            self.index[key] = (self.end, len(record))
+            self.end += len(record)
+            self.cache[key] = value
+        finally:
+            self.lock.release()
+
+    def __delitem__(self, key):
+        self.lock.acquire()
+        try:
+            offset, length = self.index.pop(key)
+            self.cache.pop(key)
+            self.dead += length
+            if self.dead > 65536 and self.dead * 2 > self.end:
+                self.compact()
+        finally:
+            self.lock.release()
+
+    def compact(self):
+        """Rewrite the file without the deleted and overwritten values."""
+        self.lock.acquire()
+        try:
+            tmp = '%s.tmp' % self.path
+            f = open(tmp, 'w+b')
+            offset = 0
+            for key, (old, length) in self.index.items():
+                self.file.seek(old)
+                f.write(self.file.read(length))
+                self.index[key] = (offset, length)
+                offset += length
+            self.file.close()
+            try:
+                os.rename(tmp, self.path)
+            except OSError:
+                # Windows doesn't replace existing files
+                os.unlink(self.path)
+                os.rename(tmp, self.path)
+            self.file = f
+            self.end = offset
+            self.dead = 0
+        finally:
+            self.lock.release()
+
+    def footprint(self):
+        """Return a tuple of:
+            0 - number of values stored
+            1 - characters of values held in memory
+            2 - size of the file in bytes
+            3 - bytes of the file that hold current values
+        """
+        return len(self.index), self.cache.size, self.end, \
+               self.end - self.dead
+
+    def delete(self):
+        """Close and remove the file."""
+        try:
+            self.file.close()
+        except IOError:
+            pass
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
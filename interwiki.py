@@ -265,11 +265,19 @@ The following arguments influence how many pages the bot works on at once:
     -query:        The maximum number of pages that the bot will load at once.
                    Default value is 60.
 
+    -parallel:     The maximum number of sites that the bot will load pages
+                   from at the same time. Subjects go on as soon as their
+                   pages have arrived. The default is 1, but can be changed
+                   in the config variable interwiki_parallel_queries
+
 Some configuration option can be used to change the working of this robot:
 
 interwiki_min_subjects: the minimum amount of subjects that should be processed
                     at the same time.
 
+interwiki_parallel_queries: the maximum number of sites that are queried at
+                    the same time.
+
 interwiki_backlink: if set to True, all problems in foreign wikis will
                     be reported
 
@@ -305,6 +313,7 @@ __version__ = '$Id$'
 
 import sys, copy, re, os
 import time
+import threading
 import codecs
 import socket
 
@@ -337,6 +346,7 @@ except NameError:
 import wikipedia as pywikibot
 import config
 import catlib
+import diskcache
 import pagegenerators
 import titletranslate, interwiki_graph
 import webbrowser
@@ -588,6 +598,7 @@ class Global(object):
     rememberno = False
     followinterwiki = True
     minsubjects = config.interwiki_min_subjects
+    parallel = config.interwiki_parallel_queries
     nobackonly = False
     askhints = False
     hintnobracket = False
@@ -689,6 +700,8 @@ class Global(object):
             self.minsubjects = int(arg[7:])
         elif arg.startswith('-query:'):
             self.maxquerysize = int(arg[7:])
+        elif arg.startswith('-parallel:'):
+            self.parallel = max(1, int(arg[10:]))
         elif arg == '-back':
             self.nobackonly = True
         elif arg == '-quiet':
@@ -716,10 +729,10 @@ class StoredPage(pywikibot.Page):
     # Please prefix the class members names by SP
     # to avoid possible name clashes with pywikibot.Page
 
-    # path to the shelve
-    SPpath = None
-    # shelve
+    # diskcache.CompressedStore holding the contents
     SPstore = None
+    # key of the next StoredPage in SPstore
+    SPnextKey = 0
 
     # attributes created by pywikibot.Page.__init__
     SPcopy = [ '_editrestriction', 
@@ -738,26 +751,30 @@ class StoredPage(pywikibot.Page):
                '_deletedRevs' ]
                  
     def SPdeleteStore():
-        if StoredPage.SPpath:
-            del StoredPage.SPstore
-            os.unlink(StoredPage.SPpath)
+        if StoredPage.SPstore is not None:
+            StoredPage.SPstore.delete()
+            StoredPage.SPstore = None
     SPdeleteStore = staticmethod(SPdeleteStore)
 
+    def SPfootprint():
+        """Return a message on the memory and disk usage of the store."""
+        if StoredPage.SPstore is None:
+            return u'empty'
+        count, memory, disk, used = StoredPage.SPstore.footprint()
+        return u'%i pages, %i KB of text in memory, %i KB on disk (%i KB used)' \
+               % (count, memory / 1024, disk / 1024, used / 1024)
+    SPfootprint = staticmethod(SPfootprint)
+
     def __init__(self, page):
         for attr in StoredPage.SPcopy:
             setattr(self, attr, getattr(page, attr))
 
-        if not StoredPage.SPpath:
-            import shelve
-            index = 1
-            while True:
-                path = config.datafilepath('cache', 'pagestore' + str(index))       
-                if not os.path.exists(path): break
-                index += 1
-            StoredPage.SPpath = path
-            StoredPage.SPstore = shelve.open(path)
+        if StoredPage.SPstore is None:
+            StoredPage.SPstore = diskcache.CompressedStore(
+                'pagestore', config.interwiki_contents_memory_size)
 
-        self.SPkey = self.aslink().encode('utf-8')
+        self.SPkey = StoredPage.SPnextKey
+        StoredPage.SPnextKey += 1
         self.SPcontentSet = False
 
     def SPgetContents(self):
@@ -769,6 +786,7 @@ class StoredPage(pywikibot.Page):
 
     def SPdelContents(self):
         if self.SPcontentSet:
+            self.SPcontentSet = False
             del StoredPage.SPstore[self.SPkey]
 
     _contents = property(SPgetContents, SPsetContents, SPdelContents)
@@ -1922,6 +1940,30 @@ class Subject(object):
         except (socket.error, IOError):
             pywikibot.output(u'ERROR: could not report backlinks')
 
+class QueryThread(threading.Thread):
+    """Load a batch of pages from one site in the background, for
+    InterwikiBot.parallelQuery().
+
+    The site's own throttle is used (see wikipedia.getSiteThrottle()), so
+    that queries to different sites don't wait for each other.
+    """
+    def __init__(self, site, pages, subjects):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.setName('Query-%s' % site)
+        self.site = site
+        self.pages = pages
+        self.subjects = subjects
+        self.exc_info = None
+
+    def run(self):
+        try:
+            pywikibot.getall_multisite(self.pages, workers = 1)
+        except:
+            # The pages which weren't loaded are fetched one by one later,
+            # as with the PreloadingGenerator in InterwikiBot.oneQuery().
+            self.exc_info = sys.exc_info()
+
 class InterwikiBot(object):
     """A class keeping track of a list of subjects, controlling which pages
        are queried from which languages when."""
@@ -1937,6 +1979,8 @@ class InterwikiBot(object):
         self.counts = {}
         self.pageGenerator = None
         self.generated = 0
+        # QueryThreads that are loading pages, if globalvar.parallel > 1
+        self.running = []
 
     def add(self, page, hints = None):
         """Add a single subject to the list"""
@@ -2034,21 +2078,23 @@ class InterwikiBot(object):
         if self.subjects:
             return self.subjects[0]
 
-    def maxOpenSite(self):
+    def maxOpenSite(self, busy = ()):
         """Return the site that has the most
            open queries plus the number. If there is nothing left, return
            None. Only languages that are TODO for the first Subject
-           are returned."""
+           are returned, unless they are all in the busy list of sites
+           which are being queried already."""
         max = 0
         maxlang = None
         if not self.firstSubject():
             return None
-        oc = dict(self.firstSubject().openSites())
+        oc = [site for site, count in self.firstSubject().openSites()
+              if site not in busy]
         if not oc:
             # The first subject is done. This might be a recursive call made because we
             # have to wait before submitting another modification to go live. Select
             # any language from counts.
-            oc = self.counts
+            oc = [site for site in self.counts if site not in busy]
         if pywikibot.getSite() in oc:
             return pywikibot.getSite()
         for lang in oc:
@@ -2058,8 +2104,9 @@ class InterwikiBot(object):
                 maxlang = lang
         return maxlang
 
-    def selectQuerySite(self):
-        """Select the site the next query should go out for."""
+    def selectQuerySite(self, busy = ()):
+        """Select the site the next query should go out for, except for
+        the busy sites."""
         # How many home-language queries we still have?
         mycount = self.counts.get(pywikibot.getSite(), 0)
         # Do we still have enough subjects to work on for which the
@@ -2080,7 +2127,7 @@ class InterwikiBot(object):
                     else:
                         break
             # If we have a few, getting the home language is a good thing.
-            if not globalvar.restoreAll:
+            if not globalvar.restoreAll and pywikibot.getSite() not in busy:
                 try:
                     if self.counts[pywikibot.getSite()] > 4:
                         return pywikibot.getSite()
@@ -2088,7 +2135,7 @@ class InterwikiBot(object):
                     pass
         # If getting the home language doesn't make sense, see how many
         # foreign page queries we can find.
-        return self.maxOpenSite()
+        return self.maxOpenSite(busy)
 
     def oneQuery(self):
         """
@@ -2129,19 +2176,95 @@ class InterwikiBot(object):
             subject.batchLoaded(self)
         return True
 
+    def startQuery(self):
+        """
+        Start loading pages from a site that is not being queried yet, in
+        the background.
+
+        Returns True if a query was started, or False otherwise.
+        """
+        busy = [thread.site for thread in self.running]
+        while True:
+            site = self.selectQuerySite(busy)
+            if site is None or site in busy:
+                return False
+            subjectGroup = []
+            pageGroup = []
+            for subject in self.subjects:
+                # Subjects that are waiting for another site can't take part.
+                if subject.pending:
+                    continue
+                pages = subject.whatsNextPageBatch(site)
+                if pages:
+                    pageGroup.extend(pages)
+                    subjectGroup.append(subject)
+                    if len(pageGroup) >= globalvar.maxquerysize:
+                        break
+            if pageGroup:
+                break
+            # All the work for this site is waiting for other sites.
+            busy.append(site)
+        thread = QueryThread(site, pageGroup, subjectGroup)
+        thread.start()
+        self.running.append(thread)
+        return True
+
+    def parallelQuery(self):
+        """
+        Perform one step in the solution process, loading pages from up to
+        globalvar.parallel sites at the same time.
+
+        Keeps starting queries for sites that are not busy, then waits until
+        one of the running queries has finished, and lets its subjects go on.
+
+        Returns True if pages could be preloaded, or false
+        otherwise.
+        """
+        while len(self.running) < globalvar.parallel:
+            if not self.startQuery():
+                break
+        if not self.running:
+            pywikibot.output(u"NOTE: Nothing left to do")
+            return False
+        finished = None
+        while finished is None:
+            for thread in self.running:
+                if not thread.isAlive():
+                    finished = thread
+                    break
+            else:
+                # wait with a timeout, so that KeyboardInterrupt gets through
+                self.running[0].join(0.1)
+        self.running.remove(finished)
+        if finished.exc_info:
+            pywikibot.output(u'ERROR: could not load pages from %s: %s'
+                             % (finished.site, finished.exc_info[1]))
+        for subject in finished.subjects:
+            subject.batchLoaded(self)
+        return True
+
     def queryStep(self):
-        self.oneQuery()
+        if globalvar.parallel > 1:
+            self.parallelQuery()
+        else:
+            self.oneQuery()
         # Delete the ones that are done now.
         for i in range(len(self.subjects)-1, -1, -1):
             subj = self.subjects[i]
-            if subj.isDone():
+            # Subjects still waiting for a running query aren't done yet.
+            if subj.isDone() and not subj.pending:
                 subj.finish(self)
                 subj.clean()
                 del self.subjects[i]
+        if globalvar.contentsondisk and \
+                (not globalvar.quiet or pywikibot.verbose):
+            pywikibot.output(u'NOTE: %i subjects, page store: %s'
+                             % (len(self.subjects), StoredPage.SPfootprint()))
 
     def isDone(self):
         """Check whether there is still more work to do"""
-        return len(self) == 0 and self.pageGenerator is None
+        return len(self) == 0 and self.pageGenerator is None \
+               and not self.running
 
     def plus(self, site, count=1):
         """This is a routine that the Subject class expects in a counter"""
@@ -864,34 +864,50 @@ class PreloadingGenerator(object):
     Special:Export, and yields them one after the other. Then retrieves more
     pages, etc. Thus, it is not necessary to load each page separately.
     Operates asynchronously, so the next batch of pages is loaded in the
-    background before the first batch is fully consumed.
+    background before the first batch is fully consumed. Up to lookahead
+    batches are loaded in advance; set lookahead to 0 to load every batch
+    only when it is needed.
     """
     def __init__(self, generator, pageNumber=60, lookahead=10):
         self.wrapped_gen = generator
         self.pageNumber = pageNumber
-#        ThreadedGenerator.__init__(self, name="Preloading-Thread",
-#                                   qsize=lookahead)
+        self.lookahead = lookahead
 
     def __iter__(self):
+        if self.lookahead <= 0:
+            for batch in self.preloadedBatches():
+                for loaded_page in batch:
+                    yield loaded_page
+            return
+        batches = ThreadedGenerator(target=self.preloadedBatches,
+                                    name="Preloading-Thread",
+                                    qsize=self.lookahead)
+        # don't keep the bot alive if the caller does not use all pages
+        batches.setDaemon(True)
+        try:
+            for batch in batches:
+                for loaded_page in batch:
+                    yield loaded_page
+        finally:
+            batches.stop()
+
+    def preloadedBatches(self):
+        """Yield lists of up to pageNumber pages which have been preloaded."""
         try:
             # this array will contain up to pageNumber pages and will be flushed
-            # after these pages have been preloaded and yielded.
+            # after these pages have been preloaded.
             somePages = []
             for page in self.wrapped_gen:
-##                if self.finished.isSet():
-##                    return
                 somePages.append(page)
                 # We don't want to load too many pages at once using XML export.
                 # We only get a maximum number at a time.
                 if len(somePages) >= self.pageNumber:
-                    for loaded_page in self.preload(somePages):
-                        yield loaded_page
+                    yield list(self.preload(somePages))
                     somePages = []
             if somePages:
                 # wrapped generator is exhausted but some pages still unloaded
                 # preload remaining pages
-                for loaded_page in self.preload(somePages):
-                    yield loaded_page
+                yield list(self.preload(somePages))
         except GeneratorExit:
             pass
         except Exception, e:
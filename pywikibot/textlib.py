@@ -30,34 +30,22 @@ def unescape(s):
     return s
 
 
-def replaceExcept(text, old, new, exceptions, caseInsensitive=False,
-                  allowoverlap=False, marker = '', site = None):
-    """
-    Return text with 'old' replaced by 'new', ignoring specified types of text.
+# Compiled exception regexes of replaceExcept(), per site. Building the
+# interwiki regex takes long, so they are only compiled once per site.
+_exceptionRegexesCache = {}
 
-    Skips occurences of 'old' within exceptions; e.g., within nowiki tags or
-    HTML comments. If caseInsensitive is true, then use case insensitive
-    regex matching. If allowoverlap is true, overlapping occurences are all
-    replaced (watch out when using this, it might lead to infinite loops!).
+# Compiled regexes for tag names used as exceptions, e.g. 'nowiki' or 'math'
+_tagRegexesCache = {}
 
-    Parameters:
-        text            - a unicode string
-        old             - a compiled regular expression
-        new             - a unicode string (which can contain regular
-                          expression references), or a function which takes
-                          a match object as parameter. See parameter repl of
-                          re.sub().
-        exceptions      - a list of strings which signal what to leave out,
-                          e.g. ['math', 'table', 'template']
-        caseInsensitive - a boolean
-        marker          - a string that will be added to the last replacement;
-                          if nothing is changed, it is added at the end
+# Group references in the replacement string of replaceExcept()
+_groupR = re.compile(r'\\(?P<number>\d+)|\\g<(?P<name>.+?)>')
 
-    """
-    if site is None:
-        site = pywikibot.getSite()
 
-    exceptionRegexes = {
+def _getExceptionRegexes(site):
+    """Return the dictionary of named exception regexes for site."""
+    key = (site.family.name, site.lang)
+    if key not in _exceptionRegexesCache:
+        _exceptionRegexesCache[key] = {
         'comment':     re.compile(r'(?s)<!--.*?-->'),
         # section headers
         'header':      re.compile(r'\r\n=+.+=+ *\r\n'),
@@ -92,31 +80,198 @@ def replaceExcept(text, old, new, exceptions, caseInsensitive=False,
                                               + site.family.obsolete.keys())
                                   ),
 
-    }
+        }
+    return _exceptionRegexesCache[key]
 
-    # if we got a string, compile it as a regular expression
-    if type(old) in  [str, unicode]:
-        if caseInsensitive:
-            old = re.compile(old, re.IGNORECASE | re.UNICODE)
-        else:
-            old = re.compile(old)
 
+def _tagRegex(tag):
+    """Return the compiled regex matching the contents of tag."""
+    if tag not in _tagRegexesCache:
+        _tagRegexesCache[tag] = re.compile(r'(?is)<%s>.*?</%s>' % (tag, tag))
+    return _tagRegexesCache[tag]
+
+
+def compileExceptions(exceptions, site=None):
+    """
+    Return the list of compiled regexes for the exceptions parameter of
+    replaceExcept(). The result can be passed to replaceExcept() instead of
+    exceptions, to avoid looking the exceptions up on every call.
+    """
+    exceptionRegexes = None
     dontTouchRegexes = []
     for exc in exceptions:
         if isinstance(exc, str) or isinstance(exc, unicode):
+            if exceptionRegexes is None:
+                if site is None:
+                    site = pywikibot.getSite()
+                exceptionRegexes = _getExceptionRegexes(site)
             # assume it's a reference to the exceptionRegexes dictionary
             # defined above.
             if exc in exceptionRegexes:
                 dontTouchRegexes.append(exceptionRegexes[exc])
             else:
                 # nowiki, noinclude, includeonly, timeline, math ond other extensions
-                dontTouchRegexes.append(re.compile(r'(?is)<%s>.*?</%s>' % (exc, exc)))
+                dontTouchRegexes.append(_tagRegex(exc))
             # handle alias
             if exc == 'source':
                 dontTouchRegexes.append(re.compile(r'(?is)<syntaxhighlight .*?</syntaxhighlight>'))
         else:
             # assume it's a regular expression
             dontTouchRegexes.append(exc)
+    return dontTouchRegexes
+
+
+def _compileReplacement(new):
+    """
+    Split the replacement string new into a list of literal strings and
+    group references (ints or group names), to be filled in with
+    _expandReplacement().
+    """
+    # it is a little hack to make \n work. It would be better
+    # to fix it previously, but better than nothing.
+    new = new.replace('\\n', '\n')
+
+    # We cannot just insert the new string, as it may contain regex
+    # group references such as \2 or \g<name>.
+    # On the other hand, using old.sub() on the matched part does not
+    # work because it can't handle lookahead or lookbehind (see bug
+    # #1731008), so we have to process the group references manually.
+    parts = []
+    index = 0
+    for groupMatch in _groupR.finditer(new):
+        parts.append(new[index:groupMatch.start()])
+        parts.append(groupMatch.group('name')
+                     or int(groupMatch.group('number')))
+        index = groupMatch.end()
+    parts.append(new[index:])
+    return parts
+
+
+def _expandReplacement(parts, match):
+    """Return the replacement for match from the result of
+    _compileReplacement()."""
+    if len(parts) == 1:
+        return parts[0]
+    result = []
+    for i in range(len(parts)):
+        if i % 2:
+            result.append(match.group(parts[i]))
+        else:
+            result.append(parts[i])
+    return u''.join(result)
+
+
+def replaceExcept(text, old, new, exceptions, caseInsensitive=False,
+                  allowoverlap=False, marker = '', site = None):
+    """
+    Return text with 'old' replaced by 'new', ignoring specified types of text.
+
+    Skips occurences of 'old' within exceptions; e.g., within nowiki tags or
+    HTML comments. If caseInsensitive is true, then use case insensitive
+    regex matching. If allowoverlap is true, overlapping occurences are all
+    replaced (watch out when using this, it might lead to infinite loops!).
+
+    Parameters:
+        text            - a unicode string
+        old             - a compiled regular expression
+        new             - a unicode string (which can contain regular
+                          expression references), or a function which takes
+                          a match object as parameter. See parameter repl of
+                          re.sub().
+        exceptions      - a list of strings which signal what to leave out,
+                          e.g. ['math', 'table', 'template'], or a list of
+                          compiled regexes as returned by compileExceptions()
+        caseInsensitive - a boolean
+        marker          - a string that will be added to the last replacement;
+                          if nothing is changed, it is added at the end
+
+    Unless allowoverlap is true, the text is scanned once: like re.sub(),
+    'old' and the exceptions are matched against the original text, and
+    the result is joined from its unchanged parts and the replacements.
+
+    """
+    # if we got a string, compile it as a regular expression
+    if type(old) in  [str, unicode]:
+        if caseInsensitive:
+            old = re.compile(old, re.IGNORECASE | re.UNICODE)
+        else:
+            old = re.compile(old)
+
+    dontTouchRegexes = compileExceptions(exceptions, site)
+    if allowoverlap:
+        return _replaceExceptOverlapping(text, old, new, dontTouchRegexes,
+                                         marker)
+    if not callable(new):
+        replacementParts = _compileReplacement(new)
+
+    # The next match of each exception regex, as found by the last search.
+    # Its search only has to be repeated once the scan has passed its start.
+    exceptionMatches = [None] * len(dontTouchRegexes)
+    exceptionSearched = [-1] * len(dontTouchRegexes)
+
+    result = []
+    # number of elements of result up to the last replacement
+    markerpos = None
+    last = 0
+    index = 0
+    while index <= len(text):
+        match = old.search(text, index)
+        if not match:
+            # nothing left to replace
+            break
+
+        # check which exception will occur next.
+        nextExceptionMatch = None
+        for i in range(len(dontTouchRegexes)):
+            excMatch = exceptionMatches[i]
+            if exceptionSearched[i] < 0 or (
+                    excMatch is not None and excMatch.start() < index):
+                excMatch = dontTouchRegexes[i].search(text, index)
+                exceptionMatches[i] = excMatch
+                exceptionSearched[i] = index
+            if excMatch and (
+                    nextExceptionMatch is None or
+                    excMatch.start() < nextExceptionMatch.start()):
+                nextExceptionMatch = excMatch
+
+        if nextExceptionMatch is not None \
+                and nextExceptionMatch.start() <= match.start():
+            # an HTML comment or text in nowiki tags stands before the next
+            # valid match. Skip.
+            index = max(nextExceptionMatch.end(), index + 1)
+        else:
+            # We found a valid match. Replace it.
+            if callable(new):
+                # the parameter new can be a function which takes the match
+                # as a parameter.
+                replacement = new(match)
+            else:
+                replacement = _expandReplacement(replacementParts, match)
+            result.append(text[last:match.start()])
+            result.append(replacement)
+            markerpos = len(result)
+            last = match.end()
+            # continue the search on the remaining text
+            if match.end() > match.start():
+                index = match.end()
+            else:
+                index = match.end() + 1
+    result.append(text[last:])
+    if marker:
+        if markerpos is None:
+            result.append(marker)
+        else:
+            result.insert(markerpos, marker)
+    return ''.join(result)
+
+
+def _replaceExceptOverlapping(text, old, new, dontTouchRegexes, marker):
+    """
+    replaceExcept() with allowoverlap: after each replacement, the search
+    continues on the changed text, right after the start of the match.
+    """
+    if not callable(new):
+        replacementParts = _compileReplacement(new)
     index = 0
     markerpos = len(text)
     while True:
@@ -142,45 +297,27 @@ def replaceExcept(text, old, new, exceptions, caseInsensitive=False,
         else:
             # We found a valid match. Replace it.
             if callable(new):
-                # the parameter new can be a function which takes the match
-                # as a parameter.
                 replacement = new(match)
             else:
-                # it is not a function, but a string.
-
-                # it is a little hack to make \n work. It would be better
-                # to fix it previously, but better than nothing.
-                new = new.replace('\\n', '\n')
-
-                # We cannot just insert the new string, as it may contain regex
-                # group references such as \2 or \g<name>.
-                # On the other hand, this approach does not work because it
-                # can't handle lookahead or lookbehind (see bug #1731008):
-                #replacement = old.sub(new, text[match.start():match.end()])
-                #text = text[:match.start()] + replacement + text[match.end():]
-
-                # So we have to process the group references manually.
-                replacement = new
-
-                groupR = re.compile(r'\\(?P<number>\d+)|\\g<(?P<name>.+?)>')
-                while True:
-                    groupMatch = groupR.search(replacement)
-                    if not groupMatch:
-                        break
-                    groupID = groupMatch.group('name') or int(groupMatch.group('number'))
-                    replacement = replacement[:groupMatch.start()] + match.group(groupID) + replacement[groupMatch.end():]
+                replacement = _expandReplacement(replacementParts, match)
             text = text[:match.start()] + replacement + text[match.end():]
 
             # continue the search on the remaining text
-            if allowoverlap:
-                index = match.start() + 1
-            else:
-                index = match.start() + len(replacement)
+            index = match.start() + 1
             markerpos = match.start() + len(replacement)
     text = text[:markerpos] + marker + text[markerpos:]
     return text
 
 
+_disabledPartsRegexes = {
+        'comments' :       r'<!--.*?-->',
+        'includeonly':     r'<includeonly>.*?</includeonly>',
+        'nowiki':          r'<nowiki>.*?</nowiki>',
+        'pre':             r'<pre>.*?</pre>',
+        'source':          r'<source .*?</source>',
+        'syntaxhighlight': r'<syntaxhighlight .*?</syntaxhighlight>',
+}
+
 def removeDisabledParts(text, tags = ['*']):
     """
     Return text without portions where wiki markup is disabled
@@ -194,14 +331,7 @@ def removeDisabledParts(text, tags = ['*']):
     The exact set of parts which should be removed can be passed as the
     'parts' parameter, which defaults to all.
     """
-    regexes = {
-            'comments' :       r'<!--.*?-->',
-            'includeonly':     r'<includeonly>.*?</includeonly>',
-            'nowiki':          r'<nowiki>.*?</nowiki>',
-            'pre':             r'<pre>.*?</pre>',
-            'source':          r'<source .*?</source>',
-            'syntaxhighlight': r'<syntaxhighlight .*?</syntaxhighlight>',
-    }
+    regexes = _disabledPartsRegexes
     if '*' in tags:
         tags = regexes.keys()
     # add alias
@@ -705,7 +835,195 @@ def compileLinkR(withoutBracketed=False, onlyBracketed=False):
 # Functions dealing with templates
 #----------------------------------
 
-def extract_templates_and_params(text, get_redirect=False):
+# Tokens that matter for parse_templates(). Disabled parts and math are
+# single tokens, so that the braces, brackets and pipes in them are ignored.
+_templateTokenR = re.compile(
+    r'(?P<disabled>%s)|(?P<math><math>[^<]+</math>)'
+    r'|(?P<open>\{\{+)|(?P<close>\}\}+)'
+    r'|(?P<link>\[\[)|(?P<unlink>\]\])|(?P<pipe>\|)'
+    % '|'.join(_disabledPartsRegexes.values()),
+    re.IGNORECASE | re.DOTALL)
+
+class _TemplateFrame(object):
+    """A template call or template argument being read by parse_templates().
+    """
+    def __init__(self, start, argument):
+        self.start = start
+        self.argument = argument
+        # finished fields: tuples of text and position of the first '='
+        self.fields = []
+        # (kind, text) tuples of the current field; kind is 'text',
+        # 'nested', 'link', 'unlink' or 'pipe' (a '|' inside a link)
+        self.pieces = []
+        # number of open links, in which '|' doesn't separate fields
+        self.links = 0
+        # whether the name contains other templates or math
+        self.complexName = False
+
+    def add(self, text, nested=False):
+        if nested:
+            if not self.fields:
+                self.complexName = True
+            self.pieces.append(('nested', text))
+        else:
+            self.pieces.append(('text', text))
+
+    def link(self, text):
+        self.links += 1
+        self.pieces.append(('link', text))
+
+    def unlink(self, text):
+        if self.links:
+            self.links -= 1
+        self.pieces.append(('unlink', text))
+
+    def pipe(self):
+        if self.links:
+            self.pieces.append(('pipe', u'|'))
+        else:
+            self.split()
+
+    def split(self):
+        text = []
+        length = 0
+        equals = None
+        links = 0
+        for kind, piece in self.pieces:
+            if kind == 'link':
+                links += 1
+            elif kind == 'unlink':
+                if links:
+                    links -= 1
+            elif kind == 'text' and equals is None and links == 0 \
+                    and '=' in piece:
+                equals = length + piece.index('=')
+            text.append(piece)
+            length += len(piece)
+        self.fields.append((u''.join(text), equals))
+        self.pieces = []
+
+    def close(self):
+        """Finish the last field. Links which are still open aren't links
+        after all, e.g. '[[x' in '{{A|b=[[x|c=d}}': the pipes in them
+        separate fields.
+        """
+        if self.links:
+            unclosed = []
+            for i in xrange(len(self.pieces)):
+                kind = self.pieces[i][0]
+                if kind == 'link':
+                    unclosed.append(i)
+                elif kind == 'unlink' and unclosed:
+                    unclosed.pop()
+            pieces = self.pieces
+            self.pieces = []
+            links = 0
+            for i in xrange(len(pieces)):
+                kind, piece = pieces[i]
+                if kind == 'link':
+                    if i in unclosed:
+                        kind = 'text'
+                    else:
+                        links += 1
+                elif kind == 'unlink':
+                    if links:
+                        links -= 1
+                elif kind == 'pipe' and links == 0:
+                    self.split()
+                    continue
+                self.pieces.append((kind, piece))
+            self.links = 0
+        self.split()
+
+def parse_templates(text):
+    """Return a list of the template calls in text.
+
+    The text is read in a single pass, keeping the nested template calls
+    on a stack. Comments, nowiki, pre and similar parts (see
+    removeDisabledParts) are skipped; braces and pipes inside links and
+    math don't count.
+
+    There is one tuple for each template call, in the order in which the
+    calls end, so nested calls come before the calls containing them:
+        0 - template name, as written (without a msg: prefix)
+        1 - list of parameters, as tuples of the parameter text (including
+            nested templates, without disabled parts) and the position of
+            the '=' separating the parameter name in it, or None if it is an
+            unnamed parameter
+        2 - start offset of the call in text
+        3 - end offset of the call in text
+
+    Template arguments ({{{1}}}) and templates whose name contains other
+    templates or math are not included.
+
+    """
+    result = []
+    stack = []
+    pos = 0
+    for m in _templateTokenR.finditer(text):
+        if stack and m.start() > pos:
+            stack[-1].add(text[pos:m.start()])
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == 'disabled':
+            continue
+        elif kind == 'open':
+            count = len(m.group())
+            start = m.start()
+            while count >= 2:
+                argument = count == 3 or count >= 5
+                stack.append(_TemplateFrame(start, argument))
+                if argument:
+                    count -= 3
+                    start += 3
+                else:
+                    count -= 2
+                    start += 2
+            continue
+        elif not stack:
+            continue
+        top = stack[-1]
+        if kind == 'math':
+            top.add(m.group(), nested=True)
+        elif kind == 'close':
+            count = len(m.group())
+            end = m.start()
+            while count >= 2 and stack:
+                top = stack[-1]
+                if top.argument:
+                    if count < 3:
+                        break
+                    count -= 3
+                    end += 3
+                    braces = (u'{{{', u'}}}')
+                else:
+                    count -= 2
+                    end += 2
+                    braces = (u'{{', u'}}')
+                stack.pop()
+                top.close()
+                if stack:
+                    stack[-1].add(braces[0]
+                                  + u'|'.join([f[0] for f in top.fields])
+                                  + braces[1], nested=True)
+                if top.argument or top.complexName:
+                    continue
+                name = top.fields[0][0]
+                if name.startswith(u'msg:'):
+                    name = name[4:]
+                if name:
+                    result.append((name, top.fields[1:], top.start, end))
+            if count and stack:
+                stack[-1].add(u'}' * count)
+        elif kind == 'link':
+            top.link(m.group())
+        elif kind == 'unlink':
+            top.unlink(m.group())
+        else:
+            top.pipe()
+    return result
+
+def extract_templates_and_params(text, get_redirect=False, offsets=False):
     """Return list of template calls found in text.
 
     Return value is a list of tuples. There is one tuple for each use of a
@@ -716,102 +1034,27 @@ def extract_templates_and_params(text, get_redirect=False):
     parameters, and if this results multiple parameters with the same name
     only the last value provided will be returned.
 
-    """
-    # remove commented-out stuff etc.
-    thistxt = removeDisabledParts(text)
-
-    # marker for inside templates or parameters
-    marker = u'@@'
-    while marker in thistxt:
-        marker += u'@'
-
-    # marker for links
-    marker2 = u'##'
-    while marker2 in thistxt:
-        marker2 += u'#'
-
-    # marker for math
-    marker3 = u'%%'
-    while marker2 in thistxt:
-        marker3 += u'%'
+    If offsets is True, the start and end offsets of the template call in
+    text are added as third and fourth entry. See parse_templates().
 
+    """
     result = []
-    inside = {}
-    count = 0
-    Rtemplate = re.compile(
-                ur'{{(msg:)?(?P<name>[^{\|]+?)(\|(?P<params>[^{]+?))?}}')
-    Rmath = re.compile(ur'<math>[^<]+</math>')
-    Rmarker = re.compile(ur'%s(\d+)%s' % (marker, marker))
-    Rmarker2 = re.compile(ur'%s(\d+)%s' % (marker2, marker2))
-    Rmarker3 = re.compile(ur'%s(\d+)%s' % (marker3, marker3))
-
-    # Replace math with markers
-    maths = {}
-    count = 0
-    for m in Rmath.finditer(thistxt):
-        count += 1
-        text = m.group()
-        thistxt = thistxt.replace(text, '%s%d%s' % (marker3, count, marker3))
-        maths[count] = text
-
-    while Rtemplate.search(thistxt) is not None:
-        for m in Rtemplate.finditer(thistxt):
-            # Make sure it is not detected again
-            count += 1
-            text = m.group()
-            thistxt = thistxt.replace(text,
-                                      '%s%d%s' % (marker, count, marker))
-            # Make sure stored templates don't contain markers
-            for m2 in Rmarker.finditer(text):
-                text = text.replace(m2.group(), inside[int(m2.group(1))])
-            for m2 in Rmarker3.finditer(text):
-                text = text.replace(m2.group(), maths[int(m2.group(1))])
-            inside[count] = text
-
-            # Name
-            name = m.group('name').strip()
-            m2 = Rmarker.search(name) or Rmath.search(name)
-            if m2 is not None:
-                # Doesn't detect templates whose name changes,
-                # or templates whose name contains math tags
-                continue
-            # Parameters
-            paramString = m.group('params')
-            params = {}
-            numbered_param = 1
-            if paramString:
-                # Replace wikilinks with markers
-                links = {}
-                count2 = 0
-                for m2 in pywikibot.link_regex.finditer(paramString):
-                    count2 += 1
-                    text = m2.group(0)
-                    paramString = paramString.replace(text,
-                                    '%s%d%s' % (marker2, count2, marker2))
-                    links[count2] = text
-                # Parse string
-                markedParams = paramString.split('|')
-                # Replace markers
-                for param in markedParams:
-                    if "=" in param:
-                        param_name, param_val = param.split("=", 1)
-                    else:
-                        param_name = unicode(numbered_param)
-                        param_val = param
-                        numbered_param += 1
-                    for m2 in Rmarker.finditer(param_val):
-                        param_val = param_val.replace(m2.group(),
-                                                      inside[int(m2.group(1))])
-                    for m2 in Rmarker2.finditer(param_val):
-                        param_val = param_val.replace(m2.group(),
-                                                      links[int(m2.group(1))])
-                    for m2 in Rmarker3.finditer(param_val):
-                        param_val = param_val.replace(m2.group(),
-                                                      maths[int(m2.group(1))])
-                    params[param_name.strip()] = param_val.strip()
-
-            # Add it to the result
-            result.append((name, params))
+    for name, fields, start, end in parse_templates(text):
+        params = {}
+        numbered_param = 1
+        for param, equals in fields:
+            if equals is None:
+                param_name = unicode(numbered_param)
+                param_val = param
+                numbered_param += 1
+            else:
+                param_name = param[:equals]
+                param_val = param[equals + 1:]
+            params[param_name.strip()] = param_val.strip()
+        if offsets:
+            result.append((name.strip(), params, start, end))
+        else:
+            result.append((name.strip(), params))
     return result
 
 #----------------
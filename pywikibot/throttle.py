@@ -13,9 +13,17 @@ import wikipedia as pywikibot
 import config
 
 import math
+import os
 import threading
 import time
 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows; TokenBucketThrottle then only shares its
+    # buckets between the threads of this process
+    fcntl = None
+
 pid = False     # global process identifier
                 # when the first Throttle is instantiated, it will set this
                 # variable to a positive integer, which will apply to all
@@ -258,6 +266,10 @@ class Throttle(object):
         finally:
             self.lock.release()
 
+    def backoff(self, seconds):
+        """Wait because the server asked us to retry later."""
+        time.sleep(seconds)
+
     def lag(self, lagtime):
         """Seize the throttle lock due to server lag.
 
@@ -284,3 +296,228 @@ class Throttle(object):
         finally:
             self.lock.release()
 
+
+
+# Buckets of TokenBucketThrottle objects, if they can't be kept in the
+# state file.
+_localBuckets = {}
+
+
+class TokenBucketThrottle(object):
+    """Control rate of access to wiki server, sharing it between processes
+
+    This is a replacement for Throttle, used if config.shared_throttle is
+    set. For each site there is a bucket for reads and one for writes. A
+    bucket fills up with one token per 'delay' (for writes: 'writedelay')
+    seconds, up to 'burst' tokens. Each request takes tokens from the
+    bucket, and waits until they have been refilled if there are not
+    enough. The tokens are taken before waiting, so that processes waiting
+    for the same bucket get their turn one after the other.
+
+    The buckets are kept in a state file locked with fcntl, so all bot
+    processes on this host share the capacity of a site, instead of each of
+    them waiting for the delay multiplied by the number of processes. When
+    the server reports database lag or asks to retry later, backoff() blocks
+    the site for all processes.
+
+    """
+    def __init__(self, mindelay=None, maxdelay=None, writedelay=None,
+                 multiplydelay=True, verbosedelay=False, write=False,
+                 site=None, burst=None):
+        self.lock = threading.RLock()
+        self.mysite = site
+        self.statefilename = config.datafilepath('pywikibot',
+                                                 'throttle.state')
+        self.mindelay = mindelay
+        if self.mindelay is None:
+            self.mindelay = config.minthrottle
+        self.maxdelay = maxdelay
+        if self.maxdelay is None:
+            self.maxdelay = config.maxthrottle
+        self.burst = burst
+        if self.burst is None:
+            self.burst = config.throttle_burst
+        self.expiry = 3600     # Forget buckets of sites which have not been
+                               # used for this many seconds
+        self.verbosedelay = verbosedelay
+        self.write = write
+        self.setDelay(writedelay=writedelay)
+
+    def setDelay(self, delay=None, writedelay=None, absolute=False):
+        """Set the nominal delays in seconds. Defaults to config values."""
+        self.lock.acquire()
+        try:
+            if delay is None:
+                delay = self.mindelay
+            if writedelay is None:
+                writedelay = config.put_throttle
+            if absolute:
+                self.maxdelay = delay
+                self.mindelay = delay
+            self.delay = delay
+            self.writedelay = min(max(self.mindelay, writedelay),
+                                  self.maxdelay)
+        finally:
+            self.lock.release()
+
+    def getDelay(self, write=False):
+        """Return the nominal delay between two reads/writes."""
+        if write or self.write:
+            return self.writedelay
+        return self.delay
+
+    # The helpers below take write as the bucket to use, the write bucket
+    # if it is True and the read bucket otherwise, regardless of self.write;
+    # the public methods decide on the bucket.
+
+    def _key(self, write):
+        if self.mysite is None:
+            self.mysite = str(pywikibot.getSite())
+        if write:
+            return '%s:write' % self.mysite
+        return '%s:read' % self.mysite
+
+    def _capacity(self, write):
+        # edits are never made in bursts
+        if write:
+            return 1.0
+        return float(max(1, self.burst))
+
+    def _delay(self, write):
+        if write:
+            return self.writedelay
+        return self.delay
+
+    def _update(self, func):
+        """Call func(buckets, now) with the buckets locked, and store them.
+
+        buckets maps keys to [tokens, timestamp, blocked until] lists.
+        Returns the result of func.
+
+        """
+        self.lock.acquire()
+        try:
+            f = None
+            if fcntl is not None:
+                try:
+                    f = os.fdopen(os.open(self.statefilename,
+                                          os.O_RDWR | os.O_CREAT), 'r+')
+                except (IOError, OSError):
+                    f = None
+            if f is None:
+                return func(_localBuckets, time.time())
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                now = time.time()
+                buckets = {}
+                for line in f.readlines():
+                    # format is "key tokens timestamp blockeduntil"
+                    try:
+                        key, tokens, stamp, blocked = line.split()
+                        bucket = [float(tokens), float(stamp), float(blocked)]
+                    except ValueError:
+                        continue    # Sometimes the file gets corrupted
+                                    # ignore that line
+                    if now - bucket[1] <= self.expiry or bucket[2] > now:
+                        buckets[key] = bucket
+                result = func(buckets, now)
+                f.seek(0)
+                f.truncate()
+                for key, bucket in buckets.iteritems():
+                    f.write("%s %f %f %f\n" % (key, bucket[0], bucket[1],
+                                               bucket[2]))
+                f.flush()
+                return result
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                f.close()
+        finally:
+            self.lock.release()
+
+    def _refill(self, buckets, now, write):
+        """Return the bucket for reads/writes, refilled up to now."""
+        key = self._key(write)
+        capacity = self._capacity(write)
+        if key not in buckets:
+            buckets[key] = [capacity, now, 0.0]
+        bucket = buckets[key]
+        delay = self._delay(write)
+        if delay > 0:
+            bucket[0] = min(capacity,
+                            bucket[0] + max(0, now - bucket[1]) / delay)
+        else:
+            bucket[0] = capacity
+        bucket[1] = now
+        return bucket
+
+    def _wait(self, bucket, now, write):
+        """Return the time to wait until the bucket is not empty."""
+        wait = max(0.0, bucket[2] - now)
+        if bucket[0] < 0:
+            wait = max(wait, -bucket[0] * self._delay(write))
+        return wait
+
+    def waittime(self, write=False):
+        """Return waiting time in seconds if a query would be made right now"""
+        write = write or self.write
+        def check(buckets, now):
+            bucket = self._refill(buckets, now, write)
+            return self._wait([bucket[0] - 1, now, bucket[2]], now, write)
+        return self._update(check)
+
+    def drop(self):
+        """Nothing to do; kept for compatibility with Throttle."""
+        pass
+
+    def __call__(self, requestsize=1, write=False):
+        """Block the calling program until enough tokens are available.
+
+        Parameter requestsize is the number of Pages to be read/written;
+        a read request takes one token for each factor of two in its size.
+
+        """
+        write = write or self.write
+        if write:
+            cost = 1.0
+        else:
+            cost = max(1.0, math.log(1 + requestsize) / math.log(2.0))
+        def take(buckets, now):
+            bucket = self._refill(buckets, now, write)
+            bucket[0] -= cost
+            return self._wait(bucket, now, write)
+        wait = self._update(take)
+        if wait > 0:
+            if wait > config.noisysleep or self.verbosedelay \
+                    or pywikibot.verbose:
+                pywikibot.output(
+                    u"Sleeping for %(wait).1f seconds, %(now)s"
+                    % {'wait': wait,
+                       'now' : time.strftime("%Y-%m-%d %H:%M:%S",
+                                             time.localtime())
+                    } )
+            time.sleep(wait)
+
+    def backoff(self, seconds):
+        """Block this site for all processes for the given number of
+        seconds, because the server asked us to retry later.
+        """
+        def block(buckets, now):
+            for write in (False, True):
+                bucket = self._refill(buckets, now, write)
+                bucket[2] = max(bucket[2], now + seconds)
+        self._update(block)
+        time.sleep(seconds)
+
+    def lag(self, lagtime):
+        """Block this site for all processes due to server lag."""
+        # start at 1/2 the current server lag time
+        # wait at least 5 seconds but not more than 120 seconds
+        delay = min(max(5, lagtime//2), 120)
+        if delay > config.noisysleep:
+            pywikibot.output(
+                u"Sleeping for %(wait).1f seconds, %(now)s"
+                % {'wait': delay,
+                   'now': time.strftime("%Y-%m-%d %H:%M:%S",
+                                        time.localtime())
+                } )
+        self.backoff(delay)
@@ -26,6 +26,7 @@ __version__ = '$Id$'
 #
 
 import wikipedia, time
+import sys, threading
 try:
     #For Python 2.6 newer
     import json
@@ -161,6 +162,184 @@ def GetData(params, site = None, useAPI = True, retryCount = 5, encodeTitle = Tr
 
     raise lastError
 
+# Parameter prefixes of the list and prop modules, used to set their limit
+# parameter in IterData().
+ModulePrefixes = {
+    'allcategories': 'ac', 'allimages': 'ai', 'alllinks': 'al',
+    'allpages': 'ap', 'allusers': 'au', 'backlinks': 'bl', 'blocks': 'bk',
+    'categories': 'cl', 'categorymembers': 'cm', 'deletedrevs': 'dr',
+    'embeddedin': 'ei', 'exturlusage': 'eu', 'extlinks': 'el',
+    'imageinfo': 'ii', 'images': 'im', 'imageusage': 'iu', 'langlinks': 'll',
+    'links': 'pl', 'logevents': 'le', 'protectedtitles': 'pt',
+    'random': 'rn', 'recentchanges': 'rc', 'revisions': 'rv', 'search': 'sr',
+    'templates': 'tl', 'usercontribs': 'uc', 'watchlist': 'wl',
+}
+
+def IterData(params, site = None, listkey = None, limit = None, step = None,
+             prefetch = True, throttle = True, sysop = False):
+    """Iterate over the result items of an API query, following the
+    query-continue values until the query is exhausted.
+
+    Items are yielded as soon as the result they belong to has arrived, so
+    that walking huge lists does not need to keep them in memory.
+
+    params   - the request parameters, as taken by GetData(). 'action'
+               defaults to 'query'.
+    listkey  - key of data['query'] containing the items. Defaults to the
+               'list' parameter. If its value is a dict (like 'pages'), the
+               values are yielded.
+    limit    - maximum number of items to yield; None to yield all.
+    step     - number of items to request at once; defaults to
+               config.special_page_limit. Used to set the limit parameter of
+               the list module (or generator) unless params already does.
+    prefetch - if True, the next continuation is requested in the
+               background while the items of the current one are consumed.
+    throttle - if True, slow down using the read throttle before each
+               request.
+
+    Example:
+
+        params = {'list': 'allpages', 'apnamespace': 10}
+        for item in query.IterData(params, site):
+            print item['title']
+
+    """
+    if not site:
+        site = wikipedia.getSite()
+    params = params.copy()
+    params.setdefault('action', 'query')
+    if listkey is None:
+        listkey = params['list']
+    if step is None:
+        step = wikipedia.config.special_page_limit
+
+    limitparam = None
+    if 'generator' in params:
+        if params['generator'] in ModulePrefixes:
+            limitparam = 'g%slimit' % ModulePrefixes[params['generator']]
+    elif listkey in ModulePrefixes:
+        limitparam = '%slimit' % ModulePrefixes[listkey]
+    if limitparam in params:
+        limitparam = None
+
+    def request(params, count):
+        params = params.copy()
+        if limitparam:
+            if limit is None:
+                params[limitparam] = step
+            else:
+                params[limitparam] = min(step, limit - count)
+        if throttle:
+            wikipedia.get_throttle()
+        data = GetData(params, site, sysop = sysop)
+        if 'error' in data:
+            raise RuntimeError("%s" % data['error'])
+        return data
+
+    count = 0
+    data = request(params, count)
+    while True:
+        items = data.get('query', {}).get(listkey, [])
+        if type(items) == dict:
+            items = items.values()
+        params = ContinueParams(params, data)
+        pending = None
+        if params is not None and prefetch \
+                and (limit is None or count + len(items) < limit):
+            pending = _PrefetchThread(request, params, count + len(items))
+            pending.start()
+        for item in items:
+            yield item
+            count += 1
+            if limit is not None and count >= limit:
+                return
+        if params is None:
+            return
+        if pending:
+            data = pending.result()
+        else:
+            data = request(params, count)
+
+def IterResults(params, site = None, prefetch = True, throttle = True,
+                sysop = False):
+    """Iterate over the complete results of an API query, following the
+    query-continue values until the query is exhausted.
+
+    Unlike IterData(), which yields the items of one list, each result is
+    yielded as a whole, e.g. to read both the 'pages' and the 'redirects'
+    of a generator query. The arguments are the same as for IterData().
+
+    """
+    if not site:
+        site = wikipedia.getSite()
+    params = params.copy()
+    params.setdefault('action', 'query')
+
+    def request(params, count):
+        if throttle:
+            wikipedia.get_throttle()
+        data = GetData(params.copy(), site, sysop = sysop)
+        if 'error' in data:
+            raise RuntimeError("%s" % data['error'])
+        return data
+
+    data = request(params, 0)
+    while True:
+        params = ContinueParams(params, data)
+        pending = None
+        if params is not None and prefetch:
+            pending = _PrefetchThread(request, params, 0)
+            pending.start()
+        yield data
+        if params is None:
+            return
+        if pending:
+            data = pending.result()
+        else:
+            data = request(params, 0)
+
+def ContinueParams(params, data):
+    """Return the request parameters continuing the query params, whose
+    result was data, or None if the query has been completed.
+    """
+    if 'continue' in data:
+        cont = data['continue']
+    elif 'query-continue' in data:
+        cont = {}
+        for values in data['query-continue'].itervalues():
+            cont.update(values)
+    else:
+        return None
+    params = params.copy()
+    params.update(cont)
+    return params
+
+class _PrefetchThread(threading.Thread):
+    """For internal use only - runs a request of IterData() in the background"""
+    def __init__(self, request, params, count):
+        threading.Thread.__init__(self, name = 'Prefetch-Thread')
+        self.setDaemon(True)
+        self.request = request
+        self.params = params
+        self.count = count
+        self.data = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.data = self.request(self.params, self.count)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def result(self):
+        """Wait for the request to finish and return its data."""
+        # join with a timeout, so that KeyboardInterrupt gets through
+        while self.isAlive():
+            self.join(1)
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.data
+
 def GetInterwikies(site, titles, extraParams = None ):
     """ Usage example: data = GetInterwikies('ru','user:yurik')
     titles may be either ane title (as a string), or a list of strings
@@ -63,6 +63,7 @@ import wikipedia as pywikibot
 import config, query
 import xmlreader
 import re, sys, datetime
+import array
 
 __version__='$Id$'
 
@@ -176,6 +177,144 @@ sd_template = {
     'zh': u'{{delete|R1}}',
 }
 
+class RedirectMap:
+    """
+    Compact map of the redirects and page titles found in a dump.
+
+    Each distinct title gets an integer id, and the redirect target of each
+    id is kept in an array, so that a page costs little more than its title
+    string. resolve() follows all redirect chains in one pass.
+
+    """
+    # value in targets for pages which are not redirects
+    NONE = -1
+
+    def __init__(self):
+        self.ids = {}
+        self.titles = []
+        # id -> id of the redirect target, or NONE
+        self.targets = array.array('l')
+        # id -> 1 if the page exists in the dump, else 0
+        self.exists = array.array('b')
+        self.redirectCount = 0
+
+    def __len__(self):
+        return self.redirectCount
+
+    def id(self, title):
+        """Return the id of title, adding it if it is new."""
+        i = self.ids.get(title)
+        if i is None:
+            i = len(self.titles)
+            self.ids[title] = i
+            self.titles.append(title)
+            self.targets.append(self.NONE)
+            self.exists.append(0)
+        return i
+
+    def addPage(self, title):
+        self.exists[self.id(title)] = 1
+
+    def addRedirect(self, source, target):
+        i = self.id(source)
+        self.exists[i] = 1
+        if self.targets[i] == self.NONE:
+            self.redirectCount += 1
+        self.targets[i] = self.id(target)
+
+    def redirects(self):
+        """Yield (source id, target id) tuples in the order of the dump."""
+        targets = self.targets
+        for i in xrange(len(targets)):
+            if targets[i] != self.NONE:
+                yield i, targets[i]
+
+    def asDict(self):
+        """Return a dictionary mapping source titles to target titles."""
+        titles = self.titles
+        return dict([(titles[i], titles[t]) for i, t in self.redirects()])
+
+    def resolve(self):
+        """
+        Follow all redirect chains. Return an array which gives for each id
+        the id of the page at the end of its chain, the id itself for pages
+        which are not redirects, or NONE for redirects which lead into a
+        loop.
+        """
+        NONE = self.NONE
+        targets = self.targets
+        final = array.array('l', [NONE]) * len(targets)
+        # 0 = not visited yet, 1 = on the current chain, 2 = resolved
+        state = array.array('b', [0]) * len(targets)
+        for start in xrange(len(targets)):
+            if state[start]:
+                continue
+            chain = []
+            i = start
+            while targets[i] != NONE and not state[i]:
+                state[i] = 1
+                chain.append(i)
+                i = targets[i]
+            if targets[i] == NONE:
+                end = i
+                final[i] = i
+                state[i] = 2
+            elif state[i] == 1:
+                # the chain runs into itself
+                end = NONE
+            else:
+                end = final[i]
+            for i in chain:
+                final[i] = end
+                state[i] = 2
+        return final
+
+    def brokenRedirects(self):
+        """Yield the titles of redirects whose target doesn't exist."""
+        targets = self.targets
+        exists = self.exists
+        for i, t in self.redirects():
+            if not exists[t] and targets[t] == self.NONE:
+                yield self.titles[i]
+
+
+def _pipelined(function, batches, depth=4):
+    """
+    Yield function(batch) for each of the batches, in order, while running
+    up to depth of the calls at the same time.
+    """
+    import threading
+    class Call(threading.Thread):
+        def __init__(self, batch):
+            threading.Thread.__init__(self)
+            self.setDaemon(True)
+            self.batch = batch
+            self.exc_info = None
+        def run(self):
+            try:
+                self.result = function(self.batch)
+            except:
+                self.exc_info = sys.exc_info()
+    running = []
+    batches = iter(batches)
+    while True:
+        for batch in batches:
+            call = Call(batch)
+            call.start()
+            running.append(call)
+            if len(running) >= depth:
+                break
+        if not running:
+            return
+        call = running.pop(0)
+        # join with a timeout, so that KeyboardInterrupt gets through
+        while call.isAlive():
+            call.join(1)
+        if call.exc_info:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        yield call.result
+
+
 class RedirectGenerator:
     def __init__(self, xmlFilename=None, namespaces=[], offset=-1,
                  use_move_log=False, use_api=False, start=None, until=None,
@@ -201,53 +340,83 @@ class RedirectGenerator:
         a dictionary where the redirect names are the keys and the redirect
         targets are the values.
         '''
+        redirectMap = self.get_redirect_map_from_dump(alsoGetPageTitles)
+        redict = redirectMap.asDict()
+        if alsoGetPageTitles:
+            titles = redirectMap.titles
+            exists = redirectMap.exists
+            pageTitles = set([titles[i] for i in xrange(len(titles))
+                              if exists[i]])
+            return redict, pageTitles
+        else:
+            return redict
+
+    def interwikiRegex(self):
+        """
+        Return a compiled regular expression matching link targets which
+        start with a language code of the site's family. Group 1 is the
+        language code.
+        """
+        codes = self.site.family.langs.keys()
+        # longest first, so that e.g. 'zh-yue' isn't taken for 'zh'
+        codes.sort(key=len, reverse=True)
+        return re.compile(u'^:?(%s):' % u'|'.join(map(re.escape, codes)))
+
+    def get_redirect_map_from_dump(self, alsoGetPageTitles=False):
+        '''
+        Load a local XML dump file, look at all pages which have the
+        redirect flag set, and find out where they're pointing at. Return
+        a RedirectMap of the redirects, which also contains all page titles
+        if alsoGetPageTitles is True.
+        '''
         xmlFilename = self.xmlFilename
-        redict = {}
+        redirectMap = RedirectMap()
         # open xml dump and read page titles out of it
         dump = xmlreader.XmlDump(xmlFilename)
         redirR = self.site.redirectRegex()
+        interwikiR = self.interwikiRegex()
+        language = self.site.language()
+        capitalize = not pywikibot.getSite().nocapitalize
+        namespaceOf = xmlreader.TitleNamespaces(self.site)
         readPagesCount = 0
-        if alsoGetPageTitles:
-            pageTitles = set()
         for entry in dump.parse():
             readPagesCount += 1
             # always print status message after 10000 pages
             if readPagesCount % 10000 == 0:
                 pywikibot.output(u'%i pages read...' % readPagesCount)
             if len(self.namespaces) > 0:
-                if pywikibot.Page(self.site, entry.title).namespace() \
-                        not in self.namespaces:
+                if namespaceOf(entry.title) not in self.namespaces:
                     continue
+            source = entry.title.replace(' ', '_')
+            if capitalize:
+                source = source[:1].upper() + source[1:]
             if alsoGetPageTitles:
-                pageTitles.add(entry.title.replace(' ', '_'))
+                redirectMap.addPage(source)
 
             m = redirR.match(entry.text)
             if m:
                 target = m.group(1)
                 # There might be redirects to another wiki. Ignore these.
-                for code in self.site.family.langs.keys():
-                    if target.startswith('%s:' % code) \
-                            or target.startswith(':%s:' % code):
-                        if code == self.site.language():
+                m = interwikiR.match(target)
+                while m:
+                    code = m.group(1)
+                    if code == language:
                         # link to our wiki, but with the lang prefix
-                            target = target[(len(code)+1):]
-                            if target.startswith(':'):
-                                target = target[1:]
-                        else:
-                            pywikibot.output(
-                                u'NOTE: Ignoring %s which is a redirect to %s:'
-                                % (entry.title, code))
-                            target = None
-                            break
+                        target = target[m.end():]
+                        m = interwikiR.match(target)
+                    else:
+                        pywikibot.output(
+                            u'NOTE: Ignoring %s which is a redirect to %s:'
+                            % (entry.title, code))
+                        target = None
+                        break
                 # if the redirect does not link to another wiki
                 if target:
-                    source = entry.title.replace(' ', '_')
                     target = target.replace(' ', '_')
                     # remove leading and trailing whitespace
                     target = target.strip('_')
                     # capitalize the first letter
-                    if not pywikibot.getSite().nocapitalize:
-                        source = source[:1].upper() + source[1:]
+                    if capitalize:
                         target = target[:1].upper() + target[1:]
                     if '#' in target:
                         target = target[:target.index('#')].rstrip("_")
@@ -257,54 +426,91 @@ class RedirectGenerator:
                             % entry.title)
                         target = target[:target.index('|')].rstrip("_")
                     if target: # in case preceding steps left nothing
-                        redict[source] = target
-        if alsoGetPageTitles:
-            return redict, pageTitles
-        else:
-            return redict
+                        redirectMap.addRedirect(source, target)
+        return redirectMap
 
-    def get_redirect_pageids_via_api(self):
-        """Return generator that yields page IDs of Pages that are redirects."""
-        params = {
-            'action': 'query',
-            'list': 'allpages',
-            'apfilterredir': 'redirects',
-            'aplimit': self.api_number,
-            'apdir': 'ascending',
-            #'':'',
-        }
+    def _redirect_batches(self):
+        """
+        Return a generator that retrieves the redirects from the API, as
+        many at a time as the API allows, together with information on
+        their targets, and yields them as tuples:
+            0 - dictionary mapping the redirect titles to their targets
+            1 - dictionary mapping the target titles to the API's page
+                information on them ('missing', 'redirect', 'lastrevid')
+        """
         for ns in self.namespaces:
-            params['apnamespace'] = ns
+            params = {
+                'action': 'query',
+                'generator': 'allpages',
+                'gapfilterredir': 'redirects',
+                'gapnamespace': ns,
+                'gaplimit': self.api_number,
+                'gapdir': 'ascending',
+                'redirects': 1,
+                'prop': 'info',
+            }
             if self.api_start:
-                params['apfrom'] = self.api_start
-            done = False
-            while not done:
-                pywikibot.output(u'\nRetrieving pages...', newline=False)
-                data = query.GetData(params, self.site)
-                if "limits" in data: # process aplimit = max
-                    params['aplimit'] = int(data['limits']['allpages'])
-                for x in data['query']['allpages']:
-                    done = self.api_until and x['title'] >= self.api_until
-                    if done: break
-                    yield x['pageid']
-                if not done and 'query-continue' in data:
-                    params['apfrom'] = data['query-continue']['allpages']['apfrom']
-                else:
+                params['gapfrom'] = self.api_start
+            for data in query.IterResults(params, self.site):
+                pywikibot.output(u'.', newline=False)
+                if data == [] or 'query' not in data:
+                    raise RuntimeError("No results given.")
+                redirects = {}
+                done = False
+                for x in data['query'].get('redirects', []):
+                    if self.api_until and x['from'] >= self.api_until:
+                        done = True
+                    else:
+                        redirects[x['from']] = x['to']
+                pages = dict([(page['title'], page) for page
+                              in data['query'].get('pages', {}).values()])
+                yield redirects, pages
+                if done:
                     break
 
-    def _next_redirect_group(self):
+    def _resolve_titles(self, titles):
         """
-        Return a generator that retrieves pageids from the API 500 at a time
-        and yields them as a list
+        Resolve one redirect level of the given titles. Return the same
+        kind of tuple as _redirect_batches().
         """
-        apiQ = []
-        for pageid in self.get_redirect_pageids_via_api():
-            apiQ.append(pageid)
-            if len(apiQ) >= 500:
-                yield apiQ
-                apiQ = []
-        if apiQ:
-            yield apiQ
+        params = {
+            'action': 'query',
+            'titles': titles,
+            'redirects': 1,
+            'prop': 'info',
+        }
+        pywikibot.get_throttle()
+        data = query.GetData(params, self.site)
+        if 'error' in data:
+            raise RuntimeError("API query error: %s" % data)
+        redirects = dict([(x['from'], x['to'])
+                          for x in data.get('query', {}).get('redirects', [])])
+        pages = dict([(page['title'], page) for page
+                      in data.get('query', {}).get('pages', {}).values()])
+        return redirects, pages
+
+    def _resolve_chains(self, titles, redirects, pages):
+        """
+        Resolve the redirects among titles level by level, up to the
+        maximum chain length, adding the results to redirects and pages.
+        The titles of each level are split into batches as big as the API
+        allows, and several batches are requested at the same time.
+        """
+        if self.site.isAllowed('apihighlimits'):
+            batchsize = 500
+        else:
+            batchsize = 50
+        while titles:
+            batches = [titles[i:i + batchsize]
+                       for i in range(0, len(titles), batchsize)]
+            titles = []
+            for newRedirects, newPages in _pipelined(self._resolve_titles,
+                                                     batches):
+                redirects.update(newRedirects)
+                pages.update(newPages)
+            yield
+            titles = [title for title, page in pages.iteritems()
+                      if 'redirect' in page and title not in redirects]
 
     def get_redirects_via_api(self, maxlen=8):
         """
@@ -315,59 +521,47 @@ class RedirectGenerator:
                          1 - normal redirect, target page exists and is not a
                              redirect
                  2..maxlen - start of a redirect chain of that many redirects
-                             (currently, the API seems not to return sufficient
-                             data to make these return values possible, but
-                             that may change)
                   maxlen+1 - start of an even longer chain, or a loop
-                             (currently, the API seems not to return sufficient
-                             data to allow this return values, but that may
-                             change)
-                      None - start of a redirect chain of unknown length, or loop
+                      None - target could not be resolved, e.g. an interwiki
+                             link
             2 - target page title of the redirect, or chain (may not exist)
             3 - target page of the redirect, or end of chain, or page title where
                 chain or loop detecton was halted, or None if unknown
+
+        The redirects are retrieved together with information on their
+        targets, as many as the API allows in one request, so that broken
+        and double redirects are found without further requests. Only for
+        maxlen > 2, the following links of redirect chains are resolved,
+        with batched requests.
         """
-        import urllib
-        params = {
-            'action':'query',
-            'redirects':1,
-            #'':'',
-        }
-        for apiQ in self._next_redirect_group():
-            params['pageids'] = apiQ
-            pywikibot.output(u'.', newline=False)
-            data = query.GetData(params, self.site)
-            if 'error' in data:
-                raise RuntimeError("API query error: %s" % data)
-            if data == [] or 'query' not in data:
-                raise RuntimeError("No results given.")
-            redirects = {}
-            pages = {}
-            redirects = dict((x['from'], x['to'])
-                             for x in data['query']['redirects'])
-
-            for pagetitle in data['query']['pages'].values():
-                if 'missing' in pagetitle and 'pageid' not in pagetitle:
-                    pages[pagetitle['title']] = False
-                else:
-                    pages[pagetitle['title']] = True
-            for redirect in redirects:
+        for redirects, pages in self._redirect_batches():
+            batch = sorted(redirects.keys())
+            if maxlen > 2:
+                # follow the chains up to maxlen redirects
+                titles = [title for title, page in pages.iteritems()
+                          if 'redirect' in page and title not in redirects]
+                level = 2
+                for dummy in self._resolve_chains(titles, redirects, pages):
+                    level += 1
+                    if level > maxlen:
+                        break
+            for redirect in batch:
                 target = redirects[redirect]
-                result = 0
-                final = None
-                try:
-                    if pages[target]:
-                        final = target
-                        try:
-                            while result <= maxlen:
-                               result += 1
-                               final = redirects[final]
-                            # result = None
-                        except KeyError:
-                            pass
-                except KeyError:
-                    result = None
-                    pass
+                if target not in pages:
+                    # e.g. an interwiki link
+                    yield (redirect, None, target, None)
+                    continue
+                if 'missing' in pages[target] and 'pageid' not in pages[target]:
+                    yield (redirect, 0, target, None)
+                    continue
+                result = 1
+                final = target
+                while result <= maxlen and final in pages \
+                        and 'redirect' in pages[final]:
+                    result += 1
+                    if final not in redirects:
+                        break
+                    final = redirects[final]
                 yield (redirect, result, target, final)
 
     def retrieve_broken_redirects(self):
@@ -402,11 +596,10 @@ class RedirectGenerator:
             # retrieve information from XML dump
             pywikibot.output(
                 u'Getting a list of all redirects and of all page titles...')
-            redirs, pageTitles = self.get_redirects_from_dump(
+            redirectMap = self.get_redirect_map_from_dump(
                                             alsoGetPageTitles=True)
-            for (key, value) in redirs.iteritems():
-                if value not in pageTitles:
-                    yield key
+            for title in redirectMap.brokenRedirects():
+                yield title
 
     def retrieve_double_redirects(self):
         if self.use_api and not self.use_move_log:
@@ -445,16 +638,23 @@ class RedirectGenerator:
             for redir_name in redir_names:
                 yield redir_name
         else:
-            redict = self.get_redirects_from_dump()
+            redirectMap = self.get_redirect_map_from_dump()
+            final = redirectMap.resolve()
             num = 0
-            for (key, value) in redict.iteritems():
+            for i, target in redirectMap.redirects():
                 num += 1
-                # check if the value - that is, the redirect target - is a
-                # redirect as well
-                if num > self.offset and value in redict:
-                    yield key
+                # check if the target is a redirect as well
+                if num > self.offset and \
+                        redirectMap.targets[target] != RedirectMap.NONE:
+                    if final[i] == RedirectMap.NONE:
+                        # the fixer can't do anything about loops
+                        pywikibot.output(
+                            u'Skipping: %s is part of a redirect loop.'
+                            % redirectMap.titles[i])
+                        continue
+                    yield redirectMap.titles[i]
                     pywikibot.output(u'\nChecking redirect %i of %i...'
-                                     % (num + 1, len(redict)))
+                                     % (num + 1, len(redirectMap)))
 
     def get_moved_pages_redirects(self):
         '''generate redirects to recently-moved pages'''
@@ -76,6 +76,12 @@ Furthermore, the following command line parameters are supported:
 
 -always           Don't prompt you for each replacement
 
+-pipeline         Together with -always, do the replacements in several
+                  worker processes while pages are loaded and saved at the
+                  same time. Argument can also be given as "-pipeline:n",
+                  where n is the number of worker processes (default: the
+                  number of CPUs).
+
 -recursive        Recurse replacement as long as possible. Be careful, this
                   might lead to an infinite loop.
 
@@ -124,6 +130,7 @@ __version__='$Id$'
 #
 
 import sys, re, time
+import threading
 import wikipedia as pywikibot
 import pagegenerators
 import editarticle
@@ -180,6 +187,107 @@ msg = {
 }
 
 
+class CombinedPattern:
+    """
+    Searches for several compiled regular expressions at once.
+
+    For each pattern, the longest run of plain text that every match must
+    contain is determined. A text can only match a pattern if it contains
+    that literal, which Python checks much faster than the regular
+    expression engine can find out that there is no match. The regular
+    expression is only run when the literal is found, or when the pattern
+    has no such literal. Patterns which consist of plain text only are not
+    run at all.
+
+    Joining the patterns into one alternation doesn't help here: Python's
+    re module tries each alternative at each position of the text, so it is
+    not faster than searching for the patterns one after another.
+
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        # list of (literal, regex) tuples; literal is None if the pattern
+        # doesn't require one, regex is None if the literal is enough
+        self.checks = []
+        # same for the patterns with the IGNORECASE flag; their literals are
+        # searched in the lowercased text
+        self.checksI = []
+        for pattern in patterns:
+            literal, exact = self.requiredLiteral(pattern)
+            if exact:
+                regex = None
+            else:
+                regex = pattern
+            if literal and pattern.flags & re.IGNORECASE:
+                self.checksI.append((literal.lower(), regex or pattern))
+            else:
+                self.checks.append((literal, regex))
+
+    def requiredLiteral(self, pattern):
+        """
+        Returns the longest text that every match of the pattern contains,
+        as a unicode string or None, and whether that text is the only
+        thing the pattern matches.
+        """
+        import sre_parse, sre_constants
+        if pattern.flags & (re.LOCALE | re.VERBOSE):
+            return None, False
+        try:
+            items = sre_parse.parse(pattern.pattern, pattern.flags)
+        except (re.error, sre_constants.error):
+            return None, False
+        runs = [[]]
+        exact = [True]
+        def walk(items):
+            for op, av in items:
+                if op == sre_constants.LITERAL:
+                    runs[-1].append(av)
+                elif op == sre_constants.SUBPATTERN and av[0] is None:
+                    # non-capturing group: part of the concatenation
+                    walk(av[1])
+                elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) \
+                        and av[0] >= 1:
+                    # the repeated part must occur at least once
+                    exact[0] = False
+                    runs.append([])
+                    walk(av[2])
+                    runs.append([])
+                else:
+                    exact[0] = False
+                    runs.append([])
+        walk(items)
+        best = max(runs, key=len)
+        if not best:
+            return None, False
+        if pattern.flags & re.IGNORECASE:
+            # lower() doesn't exactly match the case folding of the re
+            # module for all non-ASCII characters
+            if max(best) > 127:
+                return None, False
+            exact[0] = False
+        return u''.join([unichr(c) for c in best]), exact[0] and len(runs) == 1
+
+    def search(self, text):
+        """
+        Returns True iff one of the patterns matches somewhere in text.
+        """
+        if not isinstance(text, unicode):
+            for pattern in self.patterns:
+                if pattern.search(text):
+                    return True
+            return False
+        for literal, regex in self.checks:
+            if literal is None or literal in text:
+                if regex is None or regex.search(text):
+                    return True
+        if self.checksI:
+            lowered = text.lower()
+            for literal, regex in self.checksI:
+                if literal in lowered and regex.search(text):
+                    return True
+        return False
+
+
 class XmlDumpReplacePageGenerator:
     """
     Iterator that will yield Pages that might contain text to replace.
@@ -208,6 +316,12 @@ class XmlDumpReplacePageGenerator:
             self.excsInside += self.exceptions['inside-tags']
         if "inside" in self.exceptions:
             self.excsInside += self.exceptions['inside']
+        # Most pages in a dump don't contain anything to replace, so they
+        # are rejected by searching for all replacements at once before
+        # running them through replaceExcept().
+        self.candidateR = CombinedPattern([old for old, new in replacements])
+        self.titleR = CombinedPattern(self.exceptions.get('title', []))
+        self.textR = CombinedPattern(self.exceptions.get('text-contains', []))
         import xmlreader
         self.site = pywikibot.getSite()
         dump = xmlreader.XmlDump(self.xmlFilename)
@@ -221,6 +335,7 @@ class XmlDumpReplacePageGenerator:
                         continue
                     self.skipping = False
                 if not self.isTitleExcepted(entry.title) \
+                        and self.candidateR.search(entry.text) \
                         and not self.isTextExcepted(entry.text):
                     new_text = entry.text
                     for old, new in self.replacements:
@@ -237,10 +352,8 @@ class XmlDumpReplacePageGenerator:
                 pass
 
     def isTitleExcepted(self, title):
-        if "title" in self.exceptions:
-            for exc in self.exceptions['title']:
-                if exc.search(title):
-                    return True
+        if self.titleR.search(title):
+            return True
         if "require-title" in self.exceptions:
             for req in self.exceptions['require-title']:
                 if not req.search(title): # if not all requirements are met:
@@ -249,11 +362,7 @@ class XmlDumpReplacePageGenerator:
         return False
 
     def isTextExcepted(self, text):
-        if "text-contains" in self.exceptions:
-            for exc in self.exceptions['text-contains']:
-                if exc.search(text):
-                    return True
-        return False
+        return self.textR.search(text)
 
 
 class ReplaceRobot:
@@ -262,7 +371,7 @@ class ReplaceRobot:
     """
     def __init__(self, generator, replacements, exceptions={},
                  acceptall=False, allowoverlap=False, recursive=False,
-                 addedCat=None, sleep=None, editSummary=''):
+                 addedCat=None, sleep=None, editSummary='', processes=0):
         """
         Arguments:
             * generator    - A generator that yields Page objects.
@@ -277,6 +386,9 @@ class ReplaceRobot:
                              replaced.
             * addedCat     - If set to a value, add this category to every page
                              touched.
+            * processes    - If set to a positive number and acceptall is
+                             True, the replacements are done by that number
+                             of worker processes, see runPipelined().
 
         Structure of the exceptions dictionary:
         This dictionary can have these keys:
@@ -309,6 +421,7 @@ class ReplaceRobot:
         self.sleep = sleep
         # Some function to set default editSummary should probably be added
         self.editSummary = editSummary
+        self.processes = processes
 
     def isTitleExcepted(self, title):
         """
@@ -357,6 +470,8 @@ class ReplaceRobot:
         """
         Starts the robot.
         """
+        if self.acceptall and self.processes > 0:
+            return self.runPipelined()
         # Run the generator which will yield Pages which might need to be
         # changed.
         for page in self.generator:
@@ -450,6 +565,182 @@ class ReplaceRobot:
                     pywikibot.output(u'Skipping %s (locked page)'
                                      % (page.title(),))
 
+    def runPipelined(self):
+        """
+        Starts the robot in pipelined mode, which needs acceptall.
+
+        The work is split into three stages which run at the same time:
+        the pages are loaded by the generator (use a PreloadingGenerator to
+        load them in batches), the replacements are done by a pool of
+        self.processes worker processes, and the changed pages are saved
+        through the put queue of each site (see Page.put_async()). At most
+        four pages per worker process are waiting for their replacements,
+        and the put queue holds at most config.max_queue_size pages, so
+        that no stage can run far ahead of the others.
+        """
+        import multiprocessing
+        stats = PipelineStats()
+        # Start the worker processes before the generator starts any
+        # threads, so that the workers don't inherit locks held by them.
+        pool = multiprocessing.Pool(self.processes, _initPipelineWorker,
+                                    (self.replacements, self.exceptions,
+                                     self.allowoverlap, self.recursive,
+                                     self.sleep))
+        # (page, original text, result of the worker) in the order in
+        # which the pages were loaded
+        pending = []
+        maxPending = self.processes * 4
+        try:
+            for page in self.generator:
+                if self.isTitleExcepted(page.title()):
+                    pywikibot.output(
+                        u'Skipping %s because the title is on the exceptions list.'
+                        % page.aslink())
+                    continue
+                try:
+                    original_text = page.get(get_redirect=True)
+                    if not page.canBeEdited():
+                        pywikibot.output(u"You can't edit page %s"
+                                         % page.aslink())
+                        continue
+                except pywikibot.NoPage:
+                    pywikibot.output(u'Page %s not found' % page.aslink())
+                    continue
+                stats.count('loaded')
+                pending.append((page, original_text,
+                                pool.apply_async(_transformText,
+                                                 (original_text,))))
+                while pending and (len(pending) >= maxPending
+                                   or pending[0][2].ready()):
+                    self.savePipelined(pending.pop(0), stats)
+            while pending:
+                self.savePipelined(pending.pop(0), stats)
+            # wait for the put queues, so that the statistics are complete
+            while pywikibot.page_put_queue.remaining()[0]:
+                time.sleep(1)
+        finally:
+            pool.terminate()
+            stats.show()
+
+    def savePipelined(self, item, stats):
+        """
+        Waits for the worker to finish the replacements on a page, and puts
+        the page on the put queue if it was changed.
+        """
+        page, original_text, result = item
+        try:
+            # get with a timeout, so that KeyboardInterrupt gets through
+            while not result.ready():
+                result.wait(1)
+            excepted, new_text = result.get()
+        except Exception, error:
+            pywikibot.output(u'Error while doing replacements in %s: %s'
+                             % (page.aslink(), error))
+            return
+        stats.count('transformed')
+        if excepted:
+            pywikibot.output(
+    u'Skipping %s because it contains text that is on the exceptions list.'
+                % page.aslink())
+            return
+        if new_text == original_text:
+            pywikibot.output(u'No changes were necessary in %s'
+                              % page.aslink())
+            return
+        if hasattr(self, "addedCat"):
+            cats = page.categories()
+            if self.addedCat not in cats:
+                cats.append(self.addedCat)
+                new_text = pywikibot.replaceCategoryLinks(new_text, cats)
+        # Show the title of the page we're working on.
+        # Highlight the title in purple.
+        pywikibot.output(u"\n\n>>> \03{lightpurple}%s\03{default} <<<"
+                         % page.title())
+        pywikibot.showDiff(original_text, new_text)
+        page.put_async(new_text, self.editSummary,
+                       callback=lambda page, error: self.pipelineSaved(page, error, stats))
+
+    def pipelineSaved(self, page, error, stats):
+        """
+        Called by the put queue after a page has been saved.
+        """
+        if error is None:
+            stats.count('saved')
+            return
+        stats.count('failed')
+        if isinstance(error, pywikibot.EditConflict):
+            pywikibot.output(u'Skipping %s because of edit conflict'
+                             % (page.title(),))
+        elif isinstance(error, pywikibot.SpamfilterError):
+            pywikibot.output(
+                u'Cannot change %s because of blacklist entry %s'
+                % (page.title(), error.url))
+        elif isinstance(error, pywikibot.LockedPage):
+            pywikibot.output(u'Skipping %s (locked page)'
+                             % (page.title(),))
+        else:
+            pywikibot.output(u'Error putting page %s: %s'
+                             % (page.title(), error))
+
+
+class PipelineStats:
+    """
+    Counts the pages which have passed each stage of
+    ReplaceRobot.runPipelined(), and shows the throughput.
+    """
+    stages = ['loaded', 'transformed', 'saved', 'failed']
+
+    def __init__(self, interval=100):
+        self.start = time.time()
+        self.counts = dict([(stage, 0) for stage in self.stages])
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def count(self, stage):
+        self.lock.acquire()
+        try:
+            self.counts[stage] += 1
+            show = stage == 'loaded' and \
+                   self.counts[stage] % self.interval == 0
+        finally:
+            self.lock.release()
+        if show:
+            self.show()
+
+    def show(self):
+        minutes = max(time.time() - self.start, 1) / 60.0
+        pywikibot.output(u'Pages ' + u', '.join(
+            [u'%s: %i (%.1f/min)' % (stage, self.counts[stage],
+                                     self.counts[stage] / minutes)
+             for stage in self.stages]))
+
+
+# The ReplaceRobot used by the worker processes of runPipelined()
+_pipelineRobot = None
+
+def _initPipelineWorker(replacements, exceptions, allowoverlap, recursive,
+                        sleep):
+    global _pipelineRobot
+    _pipelineRobot = ReplaceRobot(None, replacements, exceptions,
+                                  allowoverlap=allowoverlap,
+                                  recursive=recursive, sleep=sleep)
+
+def _transformText(original_text):
+    """
+    Does the replacements of _pipelineRobot on a text. Returns a tuple
+    (excepted, new text).
+    """
+    robot = _pipelineRobot
+    if robot.isTextExcepted(original_text):
+        return True, original_text
+    new_text = robot.doReplacements(original_text)
+    if robot.recursive and new_text != original_text:
+        newest_text = robot.doReplacements(new_text)
+        while (newest_text!=new_text):
+            new_text = newest_text
+            newest_text = robot.doReplacements(new_text)
+    return False, new_text
+
 def prepareRegexForMySQL(pattern):
     pattern = pattern.replace('\s', '[:space:]')
     pattern = pattern.replace('\d', '[:digit:]')
@@ -494,6 +785,8 @@ def main(*args):
     # will become True when the user presses a ('yes to all') or uses the
     # -always flag.
     acceptall = False
+    # Number of worker processes for the -pipeline flag
+    processes = 0
     # Will become True if the user inputs the commandline parameter -nocase
     caseInsensitive = False
     # Will become True if the user inputs the commandline parameter -dotall
@@ -557,6 +850,12 @@ def main(*args):
             sleep = float(arg[7:])
         elif arg == '-always':
             acceptall = True
+        elif arg.startswith('-pipeline'):
+            if len(arg) > len('-pipeline'):
+                processes = int(arg[len('-pipeline:'):])
+            else:
+                import multiprocessing
+                processes = multiprocessing.cpu_count()
         elif arg == '-recursive':
             recursive = True
         elif arg == '-nocase':
@@ -710,7 +1009,9 @@ LIMIT 200""" % (whereClause, exceptClause)
                                             pageNumber=20, lookahead=100)
     else:
         preloadingGen = pagegenerators.PreloadingGenerator(gen, pageNumber=maxquerysize)
-    bot = ReplaceRobot(preloadingGen, replacements, exceptions, acceptall, allowoverlap, recursive, add_cat, sleep, editSummary)
+    if processes and not acceptall:
+        pywikibot.output(u'-pipeline can only be used together with -always.')
+    bot = ReplaceRobot(preloadingGen, replacements, exceptions, acceptall, allowoverlap, recursive, add_cat, sleep, editSummary, processes)
     bot.run()
 
 
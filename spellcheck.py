@@ -57,8 +57,9 @@ Command-line options:
 
 __version__ = '$Id$'
 
-import re, sys
-import wikipedia, pagegenerators
+import re, sys, os
+import cPickle
+import wikipedia, pagegenerators, config
 import string, codecs
 
 msg={
@@ -78,17 +79,21 @@ class SpecialTerm(object):
         self.style = text
 
 
-def distance(a,b):
+def distance(a,b,limit=None):
     # Calculates the Levenshtein distance between a and b.
     # That is, the number of edits needed to change one into
     # the other, where one edit is the addition, removal or
     # change of a single character.
+    # If limit is given, stops as soon as the distance is known to be
+    # larger than limit, and returns limit + 1 in that case.
     # Copied from Magnus Lie Hetland at http://hetland.org/python/
     n, m = len(a), len(b)
     if n > m:
         # Make sure n <= m, to use O(min(n,m)) space
         a,b = b,a
         n,m = m,n
+    if limit is not None and m - n > limit:
+        return limit + 1
     current = range(n+1)
     for i in range(1,m+1):
         previous, current = current, [i]+[0]*m
@@ -98,33 +103,164 @@ def distance(a,b):
             if a[j-1] != b[i-1]:
                 change = change + 1
             current[j] = min(add, delete, change)
+        if limit is not None and min(current[:n+1]) > limit:
+            return limit + 1
     return current[n]
 
+class WordIndex(object):
+    """An index of words for finding the words similar to a given one.
+
+    Each word is listed under the pairs of consecutive letters (bigrams)
+    it contains, counting its start and end as letters. Replacing, adding
+    or removing one letter breaks at most two bigrams, so a word within
+    k edits of another shares all but 2*k of its bigrams; only the words
+    that do have their distance calculated.
+
+    The index is stored next to the word list it was built from, and is
+    rebuilt when that file has changed since.
+
+    """
+    version = 1
+
+    def __init__(self):
+        self.words = []
+        self.ids = {}
+        # bigram -> ids of the words which contain it
+        self.grams = {}
+        # length -> ids of the words of that length
+        self.lengths = {}
+
+    def bigrams(word):
+        word = u'\x00%s\x00' % word
+        return set([word[i:i+2] for i in xrange(len(word) - 1)])
+    bigrams = staticmethod(bigrams)
+
+    def add(self, word):
+        if word in self.ids:
+            return
+        id = len(self.words)
+        self.words.append(word)
+        self.ids[word] = id
+        for gram in self.bigrams(word):
+            self.grams.setdefault(gram, []).append(id)
+        self.lengths.setdefault(len(word), []).append(id)
+
+    def search(self, word, maxdist, count = None):
+        """Return a list of (distance, word) for the indexed words which
+        are at most maxdist edits away from word, closest first.
+
+        If count is given, the search stops at the smallest distance for
+        which at least count words are found.
+        """
+        grams = self.bigrams(word)
+        shared = {}
+        for gram in grams:
+            for id in self.grams.get(gram, ()):
+                shared[id] = shared.get(id, 0) + 1
+        found = []
+        checked = set()
+        for k in xrange(maxdist + 1):
+            need = len(grams) - 2 * k
+            if need > 0:
+                candidates = [id for id, n in shared.iteritems()
+                              if n >= need]
+            else:
+                # Too short to tell anything from the bigrams
+                candidates = []
+                for length in xrange(max(len(word) - k, 0),
+                                     len(word) + k + 1):
+                    candidates += self.lengths.get(length, [])
+            for id in candidates:
+                if id in checked:
+                    continue
+                alt = self.words[id]
+                if abs(len(alt) - len(word)) > k:
+                    continue
+                diff = distance(word, alt, k)
+                if diff <= k:
+                    checked.add(id)
+                    found.append((diff, alt))
+            if count is not None and len(found) >= count:
+                break
+        found.sort()
+        return found
+
+    def load(cls, filename):
+        """Return the index stored for the word list filename, or None if
+        there is none or the word list has changed since.
+        """
+        try:
+            stat = os.stat(filename)
+            f = open(filename + '.idx', 'rb')
+            try:
+                version, mtime, size, data = cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError,
+                cPickle.UnpicklingError):
+            return None
+        if (version, mtime, size) != (cls.version, stat.st_mtime,
+                                      stat.st_size):
+            return None
+        index = cls()
+        index.words, index.grams, index.lengths = data
+        for id in xrange(len(index.words)):
+            index.ids[index.words[id]] = id
+        return index
+    load = classmethod(load)
+
+    def save(self, filename):
+        """Store the index for the word list filename."""
+        stat = os.stat(filename)
+        f = open(filename + '.idx', 'wb')
+        try:
+            cPickle.dump((self.version, stat.st_mtime, stat.st_size,
+                          (self.words, self.grams, self.lengths)),
+                         f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+def getwordindex():
+    # Return the index of the known words, loading or building it the
+    # first time it is needed.
+    global wordindex
+    if wordindex is None:
+        wordindex = WordIndex.load(filename)
+        if wordindex is None:
+            print "Building word index"
+            wordindex = WordIndex()
+            for word in knownwords:
+                wordindex.add(word)
+    for word in newwords:
+        if word in knownwords:
+            wordindex.add(word)
+    return wordindex
+
 def getalternatives(string):
     # Find possible correct words for the incorrect word string
-    basetext = wikipedia.input(u"Give a text that should occur in the words to be checked.\nYou can choose to give no text, but this will make searching slow:")
+    basetext = wikipedia.input(u"Give a text that should occur in the words to be checked.\nYou can choose to give no text:")
     basetext = basetext.lower()
-    simwords = {}
-    for i in xrange(11):
-        simwords[i] = []
-    for alt in knownwords.keys():
-        if basetext:
-            if basetext not in alt.lower() == -1:
-                dothis = False
-            else:
-                dothis = True
-        else: dothis = True
-        if dothis:
-            diff = distance(string,alt)
-            if diff < 11:
-                if knownwords[alt] == alt:
-                    simwords[diff] += [alt]
-                else:
-                    simwords[diff] += knownwords[alt]
+    if basetext:
+        # the filter may drop any of the closest words
+        count = None
+    else:
+        count = 30
     posswords = []
-    for i in xrange(11):
-        if not simwords[i] in posswords:
-            posswords += simwords[i]
+    for diff, alt in getwordindex().search(string,
+                                           config.spellcheck_max_distance,
+                                           count):
+        if basetext and basetext not in alt.lower():
+            continue
+        try:
+            if knownwords[alt] == alt:
+                alts = [alt]
+            else:
+                alts = knownwords[alt]
+        except KeyError:
+            continue
+        for alt in alts:
+            if alt not in posswords:
+                posswords.append(alt)
     return posswords[:30]
 
 def uncap(string):
@@ -414,6 +550,7 @@ try:
     endpage = SpecialTerm("end page")
     title = []
     knownwords = {}
+    wordindex = None
     newwords = []
     start = None
     newpages = False
@@ -553,3 +690,5 @@ finally:
         else:
             f.write("0 %s %s\n"%(word," ".join(knownwords[word])))
     f.close()
+    if wordindex is not None:
+        getwordindex().save(filename)
@@ -18,6 +18,15 @@ Command line options:
 -namespace:   Filters the search to a given namespace.  If this is specified
               multiple times it will search all given namespaces
 
+-workers:n    Query the transclusions of up to n templates at the same time
+              (default: config.templatecount_workers). Needs the API.
+
+-xml          Count the transclusions in an XML dump instead of asking the
+              wiki. All templates are counted in one scan of the dump. Only
+              direct transclusions are seen this way, not the ones through
+              other templates or through redirects to the template.
+              Argument can also be given as "-xml:filename.xml".
+
 Examples:
 
 Counts how many times {{ref}} and {{note}} are transcluded in articles.
@@ -34,31 +43,179 @@ Lists all the category pages that transclude {{cfd}} and {{cfdu}}.
 #
 __version__ = '$Id$'
 
-import wikipedia, config
+import wikipedia, config, query
 import replace, pagegenerators
+import xmlreader
+from pywikibot import textlib
 import re, sys, string
 import datetime
+import threading, Queue
 
 templates = ['ref', 'note', 'ref label', 'note label', 'reflist']
 
+def normalizeName(name):
+    """Return the template name in a canonical form for comparisons:
+    spaces instead of underscores, single spaces, first letter uppercase.
+    """
+    name = u' '.join(name.replace(u'_', u' ').split())
+    return name[:1].upper() + name[1:]
+
+class TemplateFilter(object):
+    """Filter for XmlDump.parallel_parse() which accepts the entries that
+    transclude any of the given templates.
+
+    It is called in the worker processes; the names of the templates which
+    the entry transcludes are stored in entry.templates, so that they don't
+    have to be found again.
+    """
+    def __init__(self, templates, prefixes):
+        # normalized template names
+        self.templates = set([normalizeName(t) for t in templates])
+        # lowercased names of the template namespace
+        self.prefixes = prefixes
+
+    def __call__(self, entry):
+        found = set()
+        for name, params, start, end in textlib.parse_templates(entry.text):
+            name = name.strip()
+            if u':' in name:
+                prefix, rest = name.split(u':', 1)
+                if prefix.strip().lower() not in self.prefixes:
+                    # subst:, magic words, other namespaces
+                    continue
+                name = rest
+            name = normalizeName(name)
+            if name in self.templates:
+                found.add(name)
+        entry.templates = found
+        return bool(found)
+
 class TemplateCountRobot:
-    #def __init__(self):
-        #Nothing
-    def countTemplates(self, templates, namespaces):
+    def __init__(self, xmlFilename=None, workers=None):
+        self.xmlFilename = xmlFilename
+        if workers is None:
+            workers = config.templatecount_workers
+        self.workers = workers
+
+    def transclusions(self, templates, namespaces, titles=False):
+        """Return a dictionary which maps the template names to the number
+        of pages transcluding them, or, if titles is True, to the lists of
+        titles of those pages.
+        """
+        mysite = wikipedia.getSite()
+        # convert namespace names to namespace numbers
+        namespaces = list(namespaces)
+        for i in xrange(len(namespaces)):
+            if isinstance(namespaces[i], basestring):
+                index = mysite.getNamespaceIndex(namespaces[i])
+                if index is None:
+                    raise ValueError(u'Unknown namespace: %s' % namespaces[i])
+                namespaces[i] = index
+        if self.xmlFilename:
+            return self.transclusionsFromDump(templates, namespaces, titles)
+        elif not mysite.has_api() or self.workers < 1:
+            result = {}
+            mytpl = mysite.template_namespace() + ':'
+            for template in templates:
+                gen = pagegenerators.ReferringPageGenerator(
+                    wikipedia.Page(mysite, mytpl + template),
+                    onlyTemplateInclusion = True)
+                if namespaces:
+                    gen = pagegenerators.NamespaceFilterPageGenerator(
+                        gen, namespaces)
+                result[template] = [page.title() for page in gen]
+                if not titles:
+                    result[template] = len(result[template])
+            return result
+
+        # Ask the API for the embeddedin lists, of several templates at
+        # the same time.
+        result = {}
+        queue = Queue.Queue()
+        for template in templates:
+            queue.put(template)
+        errors = []
+        def work():
+            while not errors:
+                try:
+                    template = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    result[template] = self.embeddedIn(mysite, template,
+                                                       namespaces, titles)
+                except:
+                    errors.append(sys.exc_info())
+        threads = []
+        for i in range(min(self.workers, len(templates))):
+            thread = threading.Thread(target = work)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # join with a timeout, so that KeyboardInterrupt gets through
+            while thread.isAlive():
+                thread.join(1)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return result
+
+    def embeddedIn(self, site, template, namespaces, titles=False):
+        """Return the number of pages transcluding template, or the list of
+        their titles if titles is True, using list=embeddedin.
+        """
+        params = {
+            'action': 'query',
+            'list': 'embeddedin',
+            'eititle': site.template_namespace() + ':' + template,
+            'eilimit': 'max',
+        }
+        if namespaces:
+            params['einamespace'] = '|'.join([str(ns) for ns in namespaces])
+        if titles:
+            return [item['title'] for item in query.IterData(params, site)]
+        count = 0
+        for item in query.IterData(params, site):
+            count += 1
+        return count
+
+    def transclusionsFromDump(self, templates, namespaces, titles=False):
+        """Like transclusions(), but count the direct transclusions in the
+        XML dump, with a single scan for all templates.
+        """
         mysite = wikipedia.getSite()
-        mytpl  = mysite.template_namespace()+':'
+        prefixes = set([u'template', u'msg',
+                        mysite.template_namespace().lower()])
+        names = {}
+        result = {}
+        for template in templates:
+            names[normalizeName(template)] = template
+            if titles:
+                result[template] = []
+            else:
+                result[template] = 0
+        namespaceOf = xmlreader.TitleNamespaces(mysite)
+        dump = xmlreader.XmlDump(self.xmlFilename)
+        for entry in dump.parallel_parse(
+                filter = TemplateFilter(templates, prefixes)):
+            if namespaces:
+                if namespaceOf(entry.title) not in namespaces:
+                    continue
+            for name in entry.templates:
+                template = names[name]
+                if titles:
+                    result[template].append(entry.title)
+                else:
+                    result[template] += 1
+        return result
+
+    def countTemplates(self, templates, namespaces):
         finalText = [u'Number of transclusions per template',u'------------------------------------']
         total = 0
         # The names of the templates are the keys, and the numbers of transclusions are the values.
-        templateDict = {}
+        templateDict = self.transclusions(templates, namespaces)
         for template in templates:
-            gen = pagegenerators.ReferringPageGenerator(wikipedia.Page(mysite, mytpl + template), onlyTemplateInclusion = True)
-            if namespaces:
-                gen = pagegenerators.NamespaceFilterPageGenerator(gen, namespaces)
-            count = 0
-            for page in gen:
-                count += 1
-            templateDict[template] = count
+            count = templateDict[template]
             finalText.append(u'%s: %d' % (template, count))
             total += count
         for line in finalText:
@@ -76,15 +233,13 @@ class TemplateCountRobot:
         for template in templates:
             finalText.append(u'* %s' % template)
         finalText.append(u'------------------------------------')
+        titleDict = self.transclusions(templates, namespaces, titles = True)
         for template in templates:
             transcludingArray = []
-            gen = pagegenerators.ReferringPageGenerator(wikipedia.Page(mysite, mysite.template_namespace() + ':' + template), onlyTemplateInclusion = True)
-            if namespaces:
-                gen = pagegenerators.NamespaceFilterPageGenerator(gen, namespaces)
-            for page in gen:
-                finalText.append(u'%s' % page.title())
+            for title in titleDict[template]:
+                finalText.append(title)
                 count += 1
-                transcludingArray.append(page)
+                transcludingArray.append(wikipedia.Page(mysite, title))
             templateDict[template] = transcludingArray;
         finalText.append(u'Total page count: %d' % count)
         for line in finalText:
@@ -96,6 +251,8 @@ def main():
     operation = None
     argsList = []
     namespaces = []
+    xmlFilename = None
+    workers = None
 
     for arg in wikipedia.handleArgs():
         if arg == '-count':
@@ -107,13 +264,20 @@ def main():
                 namespaces.append(int(arg[len('-namespace:'):]))
             except ValueError:
                 namespaces.append(arg[len('-namespace:'):])
+        elif arg.startswith('-workers:'):
+            workers = int(arg[len('-workers:'):])
+        elif arg.startswith('-xml'):
+            if len(arg) == 4:
+                xmlFilename = wikipedia.input(u'Please enter the XML dump\'s filename:')
+            else:
+                xmlFilename = arg[5:]
         else:
             argsList.append(arg)
 
     if operation == None:
         wikipedia.showHelp('templatecount')
     else:
-        robot = TemplateCountRobot()
+        robot = TemplateCountRobot(xmlFilename, workers)
         if not argsList:
             argsList = templates
         choice = ''
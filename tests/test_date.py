@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+
+"""Unit tests for date.py"""
+__version__ = '$Id$'
+
+import unittest
+import test_utils
+
+import date
+
+class AutoFormatTestCase(unittest.TestCase):
+    def testDates(self):
+        self.assertEquals(('DecadeAD', 1980), date.getAutoFormat('en', u'1980s'))
+        self.assertEquals(('YearAD', 2005), date.getAutoFormat('en', u'2005'))
+        self.assertEquals(('CenturyBC', 5),
+                          date.getAutoFormat('en', u'5th century BC'))
+
+    def testFirstLetterCase(self):
+        self.assertEquals(('MonthName', 1), date.getAutoFormat('en', u'january'))
+        self.assertEquals((None, None),
+                          date.getAutoFormat('en', u'january',
+                                             ignoreFirstLetterCase = False))
+
+    def testNoDate(self):
+        self.assertEquals((None, None), date.getAutoFormat('en', u'Paris'))
+        self.assertEquals((None, None), date.getAutoFormat('en', u''))
+
+    def testAllFormats(self):
+        # every value that a decoder produces must be recognized again
+        for dictName, formats in date.formats.iteritems():
+            pred, start, stop = date.formatLimits.get(dictName, (None, 1, 13))
+            for lang in ('en', 'de', 'ja'):
+                if lang not in formats:
+                    continue
+                for value in (start, stop - 1):
+                    try:
+                        title = formats[lang](value)
+                    except ValueError:
+                        continue
+                    found = date.getAutoFormat(lang, title)
+                    self.assertEquals(title, date.formats[found[0]][lang](found[1]))
+
+if __name__ == '__main__':
+    unittest.main()
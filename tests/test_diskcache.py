@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+
+"""Unit tests for diskcache.py"""
+__version__ = '$Id$'
+
+import os
+import unittest
+import test_utils
+
+import diskcache
+
+class CachedReadOnlyDictITestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = [(u'About', u'About'), (u'Édit', u'Modifier'),
+                     (u'1movedto2', u'[[$1]] moved to [[$2]]'), (u'empty', None),
+                     ('tab\tkey', 'x')]
+        self.data += [(u'msg%i' % i, u'value %i' % i) for i in range(500)]
+
+    def testLookup(self):
+        cache = diskcache.CachedReadOnlyDictI(self.data, max_size = 5)
+        try:
+            self.assertEquals(u'About', cache[u'about'])
+            self.assertEquals(u'Modifier', cache[u'éDIT'])
+            self.assertEquals(u'[[$1]] moved to [[$2]]', cache['1MovedTo2'])
+            self.assertEquals(u'', cache[u'empty'])
+            self.assertEquals(u'x', cache[u'TAB\tkey'])
+            for i in range(500):
+                self.assertEquals(u'value %i' % i, cache[u'msg%i' % i])
+            self.assertRaises(KeyError, cache.__getitem__, u'missing')
+            self.assertRaises(KeyError, cache.__getitem__, u'')
+            self.assertEquals(505, len(cache))
+            self.assertEquals(5, len(cache.cache.map))
+        finally:
+            cache.close()
+        self.failIf(os.path.exists(cache.cache_path))
+
+    def testPersistent(self):
+        name = 'test-diskcache-%i' % os.getpid()
+        cache = diskcache.CachedReadOnlyDictI(self.data, name = name)
+        cache.close()
+        try:
+            cache = diskcache.CachedReadOnlyDictI.open(name)
+            self.assertEquals(u'Modifier', cache[u'édit'])
+            cache.close()
+            self.assertEquals(None,
+                              diskcache.CachedReadOnlyDictI.open(name, max_age = -1))
+        finally:
+            os.unlink(cache.cache_path)
+        self.assertEquals(None, diskcache.CachedReadOnlyDictI.open(name))
+
+class LRUTestCase(unittest.TestCase):
+    def testEviction(self):
+        lru = diskcache._LRU(2)
+        lru['a'] = 1
+        lru['b'] = 2
+        self.assertEquals(1, lru['a'])
+        lru['c'] = 3
+        self.assertRaises(KeyError, lru.__getitem__, 'b')
+        self.assertEquals(1, lru['a'])
+        self.assertEquals(3, lru['c'])
+
+    def testSizeof(self):
+        lru = diskcache._LRU(5, len)
+        lru['a'] = 'xx'
+        lru['b'] = 'yyy'
+        self.assertEquals(5, lru.size)
+        lru['c'] = 'z'
+        self.assertEquals(['b', 'c'], sorted(lru.map.keys()))
+        lru['d'] = 'too long'
+        self.assertFalse('d' in lru)
+        self.assertEquals('yyy', lru.pop('b'))
+        self.assertEquals(1, lru.size)
+
+class CompressedStoreTestCase(unittest.TestCase):
+    def testStore(self):
+        store = diskcache.CompressedStore(memory_size = 10)
+        try:
+            store[1] = u'\xe9dit ' * 10
+            store[2] = 'plain'
+            self.assertEquals(u'\xe9dit ' * 10, store[1])
+            self.assertEquals('plain', store[2])
+            store[2] = u'replaced'
+            self.assertEquals(u'replaced', store[2])
+            del store[1]
+            self.assertFalse(1 in store)
+            store.compact()
+            self.assertEquals(u'replaced', store[2])
+            count, memory, disk, used = store.footprint()
+            self.assertEquals(1, count)
+            self.assertEquals(disk, used)
+        finally:
+            store.delete()
+        self.assertFalse(os.path.exists(store.path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+
+"""Unit tests for the Page class in wikipedia.py"""
+__version__ = '$Id$'
+
+import pickle
+import unittest
+import test_utils
+
+import wikipedia
+
+class PageTitleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.site = wikipedia.getSite('en', 'wikipedia')
+
+    def testCachedTitle(self):
+        for i in range(2):
+            page = wikipedia.Page(self.site, u'fr:Foo_bar#sec')
+            self.assertEquals(u'Foo bar#sec', page.title())
+            self.assertEquals(u'sec', page.section())
+            self.assertEquals(wikipedia.getSite('fr', 'wikipedia'),
+                              page.site())
+            self.assert_((u'fr:Foo_bar#sec', 0) in self.site._titleCache)
+
+    def testDefaultNamespace(self):
+        self.assertEquals(u'Template:Foo',
+                          wikipedia.Page(self.site, u'Foo',
+                                         defaultNamespace=10).title())
+        self.assertEquals(u'Foo', wikipedia.Page(self.site, u'Foo').title())
+
+    def testLazyAttributes(self):
+        page = wikipedia.Page(self.site, u'Foo')
+        other = wikipedia.Page(self.site, u'Foo')
+        self.assertEquals('0', page._editTime)
+        self.assertEquals({}, page.__dict__)
+        page._contents = u'text'
+        self.assertFalse(hasattr(other, '_contents'))
+
+    def testPickle(self):
+        page = wikipedia.Page(self.site, u'Talk:Foo#sec')
+        page._contents = u'text'
+        for protocol in range(3):
+            copy = pickle.loads(pickle.dumps(page, protocol))
+            self.assertEquals(page, copy)
+            self.assertEquals(u'Talk:Foo#sec', copy.title())
+            self.assertEquals(1, copy.namespace())
+            self.assertEquals(self.site, copy.site())
+            self.assertEquals({'_contents': u'text'}, copy.__dict__)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+
+"""Unit tests for redirect.py"""
+__version__ = '$Id$'
+
+import unittest
+import test_utils
+
+import redirect
+from redirect import RedirectMap
+
+class RedirectMapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.map = RedirectMap()
+        for title in [u'A', u'C', u'E']:
+            self.map.addPage(title)
+        # chain: B -> D -> A
+        self.map.addRedirect(u'B', u'D')
+        self.map.addRedirect(u'D', u'A')
+        # cycle: F -> G -> H -> F, and I -> G leading into it
+        self.map.addRedirect(u'F', u'G')
+        self.map.addRedirect(u'G', u'H')
+        self.map.addRedirect(u'H', u'F')
+        self.map.addRedirect(u'I', u'G')
+        # broken: J -> K -> Missing
+        self.map.addRedirect(u'J', u'K')
+        self.map.addRedirect(u'K', u'Missing')
+
+    def final(self, title):
+        final = self.map.resolve()[self.map.ids[title]]
+        if final == RedirectMap.NONE:
+            return None
+        return self.map.titles[final]
+
+    def testChain(self):
+        self.assertEquals(u'A', self.final(u'B'))
+        self.assertEquals(u'A', self.final(u'D'))
+        self.assertEquals(u'A', self.final(u'A'))
+        self.assertEquals(u'C', self.final(u'C'))
+
+    def testCycle(self):
+        for title in [u'F', u'G', u'H', u'I']:
+            self.assertEquals(None, self.final(title))
+
+    def testBroken(self):
+        self.assertEquals(u'Missing', self.final(u'J'))
+        self.assertEquals(u'Missing', self.final(u'K'))
+        self.assertEquals([u'K'], list(self.map.brokenRedirects()))
+
+    def testDoubleRedirectsFromDump(self):
+        generator = redirect.RedirectGenerator(xmlFilename='dump.xml')
+        generator.get_redirect_map_from_dump = lambda: self.map
+        # the redirects of the loop are skipped
+        self.assertEquals([u'B', u'J'],
+                          list(generator.retrieve_double_redirects()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+
+"""Unit tests for replace.py"""
+__version__ = '$Id$'
+
+import re
+import unittest
+import test_utils
+
+import wikipedia
+import replace
+
+class CombinedPatternTestCase(unittest.TestCase):
+    def setUp(self):
+        self.patterns = [re.compile(re.escape(u'Gänse')),
+                         re.compile(u'\\bfoo(bar)+\\d', re.UNICODE),
+                         re.compile(u'(?i)<br\\s*/?>'),
+                         re.compile(u'(a)\\1x'),
+                         re.compile(u'[xyz]{3}')]
+        self.combined = replace.CombinedPattern(self.patterns)
+
+    def assertSameResult(self, text):
+        expected = False
+        for pattern in self.patterns:
+            if pattern.search(text):
+                expected = True
+        self.assertEquals(expected, self.combined.search(text), text)
+
+    def testSearch(self):
+        for text in [u'', u'Gänse', u'gänse', u'foobarbar1', u'xfoobar1',
+                     u'foobar', u'<BR />', u'<Br>', u'<b>', u'aax', u'aab',
+                     u'zyx', u'zy', u'xy z']:
+            self.assertSameResult(text)
+            self.assertSameResult(u'some text %s more text' % text)
+
+    def testByteString(self):
+        self.assertEquals(True, self.combined.search('<br>'))
+        self.assertEquals(False, self.combined.search('text'))
+
+if __name__ == '__main__':
+    unittest.main()
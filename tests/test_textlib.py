@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+
+"""Unit tests for pywikibot/textlib.py"""
+__version__ = '$Id$'
+
+import re
+import unittest
+import test_utils
+
+import wikipedia
+from pywikibot import textlib
+
+class ReplaceExceptTestCase(unittest.TestCase):
+    def setUp(self):
+        self.comment = re.compile(r'(?s)<!--.*?-->')
+
+    def testReplace(self):
+        self.assertEquals(u'bbb', textlib.replaceExcept(u'aaa', re.compile('a'),
+                                                        u'b', []))
+
+    def testException(self):
+        self.assertEquals(u'b<!--a-->b',
+                          textlib.replaceExcept(u'a<!--a-->a', re.compile('a'),
+                                                u'b', [self.comment]))
+
+    def testGroupReferences(self):
+        self.assertEquals(u'[b|a] <!--ab--> [b|a]',
+                          textlib.replaceExcept(u'ab <!--ab--> ab',
+                                                re.compile('(?P<x>a)(b)'),
+                                                u'[\\2|\\g<x>]',
+                                                [self.comment]))
+
+    def testCallable(self):
+        self.assertEquals(u'A-B-c',
+                          textlib.replaceExcept(u'a-b-c', re.compile('[ab]'),
+                                                lambda m: m.group().upper(),
+                                                []))
+
+    def testMarker(self):
+        self.assertEquals(u'b@a<!--a-->',
+                          textlib.replaceExcept(u'aa<!--a-->', re.compile('^a'),
+                                                u'b', [self.comment],
+                                                marker=u'@'))
+        self.assertEquals(u'ccc@',
+                          textlib.replaceExcept(u'ccc', re.compile('a'),
+                                                u'b', [], marker=u'@'))
+
+    def testEmptyMatch(self):
+        self.assertEquals(u'-a-b-',
+                          textlib.replaceExcept(u'ab', re.compile('(?=a)|(?=b)|$'),
+                                                u'-', []))
+
+    def testAllowOverlap(self):
+        self.assertEquals(u'xaxaxa',
+                          textlib.replaceExcept(u'aaa', re.compile('(?<!x)a'),
+                                                u'xa', [], allowoverlap=True))
+
+class ExtractTemplatesTestCase(unittest.TestCase):
+    def testNested(self):
+        self.assertEquals([(u'B', {u'q': u'2'}),
+                           (u'A', {u'1': u'x', u'y': u'1',
+                                   u'z': u'{{B|q=2}}', u'2': u'[[L|a=b]]'})],
+                          textlib.extract_templates_and_params(
+                              u'{{A|x|y=1|z = {{B|q=2}} |[[L|a=b]]}}'))
+
+    def testDisabledParts(self):
+        self.assertEquals([(u'A', {u'1': u'p'})],
+                          textlib.extract_templates_and_params(
+                              u'{{A|<!-- {{X}} -->p}} <nowiki>{{Y}}</nowiki>'))
+
+    def testMath(self):
+        self.assertEquals([(u'D', {u'1': u'<math>a|b=c</math>'})],
+                          textlib.extract_templates_and_params(
+                              u'{{D|<math>a|b=c</math>}}'))
+
+    def testOffsets(self):
+        text = u'x {{A|{{{1|}}}|{{B}}}} y'
+        self.assertEquals([(u'B', {}, 15, 20),
+                           (u'A', {u'1': u'{{{1|}}}', u'2': u'{{B}}'}, 2, 22)],
+                          textlib.extract_templates_and_params(text,
+                                                               offsets=True))
+        self.assertEquals(u'{{B}}', text[15:20])
+
+    def testUnbalanced(self):
+        self.assertEquals([(u'A', {u'1': u'b'}), (u'B', {})],
+                          textlib.extract_templates_and_params(
+                              u'}} {{A|b}} [[x]] {{unclosed|{{B}}'))
+        self.assertEquals([], textlib.extract_templates_and_params(
+                              u'{{ {{B}} |x}}')[1:])
+        self.assertEquals([(u'A', {u'b': u'[[x', u'c': u'd'})],
+                          textlib.extract_templates_and_params(
+                              u'{{A|b=[[x|c=d}}'))
+        self.assertEquals([(u'A', {u'1': u'[[x', u'2': u'[[y|z]]',
+                                   u'c': u'd'})],
+                          textlib.extract_templates_and_params(
+                              u'{{A|[[x|[[y|z]]|c=d}}'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+
+"""Unit tests for pywikibot/throttle.py"""
+__version__ = '$Id$'
+
+import os
+import tempfile
+import unittest
+import test_utils
+
+import wikipedia
+from pywikibot import throttle
+
+class TokenBucketThrottleTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.statefilename = tempfile.mkstemp()
+        os.close(fd)
+        self.sleep = throttle.time.sleep
+        throttle.time.sleep = lambda seconds: None
+
+    def tearDown(self):
+        throttle.time.sleep = self.sleep
+        os.unlink(self.statefilename)
+
+    def makeThrottle(self, write):
+        t = throttle.TokenBucketThrottle(mindelay=1, maxdelay=1,
+                                         writedelay=10, write=write,
+                                         site='wikipedia:xx')
+        t.statefilename = self.statefilename
+        return t
+
+    def testBackoffBlocksBothBuckets(self):
+        for write in (False, True):
+            self.makeThrottle(write).backoff(30)
+            get = self.makeThrottle(False)
+            self.assertTrue(get.waittime() > 20)
+            self.assertTrue(get.waittime(write=True) > 20)
+            open(self.statefilename, 'w').close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+
+"""Unit tests for weblinkchecker.py"""
+__version__ = '$Id$'
+
+import shutil
+import tempfile
+import unittest
+import test_utils
+
+import wikipedia
+import weblinkchecker
+
+class HistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = wikipedia.config.base_dir
+        wikipedia.config.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(wikipedia.config.base_dir)
+        wikipedia.config.base_dir = self.base_dir
+
+    def testPageTitlesWhileWriting(self):
+        history = weblinkchecker.History(None)
+        for i in range(7):
+            history.addSighting(u'http://example.org/%i' % i,
+                                u'Page %i' % i, 1000.0 + i, u'404')
+        # don't wait a minute for a locked database
+        history.db.execute('PRAGMA busy_timeout = 100')
+        other = weblinkchecker.History(None)
+        titles = []
+        for title in other.pageTitles(chunk = 3):
+            titles.append(title)
+            # the bot writes to the database while the titles are read
+            history.addSighting(u'http://example.org/%s' % title,
+                                u'Page 9', 2000.0, u'404')
+            self.assertTrue(history.setLinkAlive(u'http://example.org/%s'
+                                                 % title))
+        self.assertEquals([u'Page %i' % i for i in range(7)], titles)
+        self.assertEquals([u'http://example.org/%i' % i for i in range(7)],
+                          sorted(other.deadSince(0)))
+
+if __name__ == '__main__':
+    unittest.main()
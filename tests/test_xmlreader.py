@@ -1,10 +1,41 @@
+import bz2
+import os
+import tempfile
 import xml.sax
 
 import unittest
 import test_utils
 
+import wikipedia
 import xmlreader
 
+def isRedirect(entry):
+    return entry.isredirect
+
+def writeDump(pages, multistream=False):
+    """Write a dump containing the pages of the given test data files,
+    return its file name.
+    """
+    header = footer = None
+    bodies = []
+    for filename in pages:
+        data = open(filename).read()
+        start = data.find('  <page>')
+        end = data.rfind('</mediawiki>')
+        header, footer = data[:start], data[end:]
+        bodies.append(data[start:end])
+    if multistream:
+        fd, filename = tempfile.mkstemp(suffix='.xml.bz2')
+        data = bz2.compress(header) \
+               + ''.join([bz2.compress(body) for body in bodies]) \
+               + bz2.compress(footer)
+    else:
+        fd, filename = tempfile.mkstemp(suffix='.xml')
+        data = header + ''.join(bodies) + footer
+    os.write(fd, data)
+    os.close(fd)
+    return filename
+
 class XmlReaderTestCase(unittest.TestCase):
     def test_XmlDumpAllRevs(self):
         pages = [r for r in xmlreader.XmlDump("data/article-pear.xml", allrevisions=True).parse()]
@@ -40,5 +71,97 @@ class XmlReaderTestCase(unittest.TestCase):
         self.assertEquals(4, len(pages))
         self.assertNotEquals("", pages[0].comment)
 
+    def test_XmlDumpParallel(self):
+        filename = writeDump(["data/article-pear.xml",
+                              "data/article-pyrus.xml"] * 3)
+        try:
+            dump = xmlreader.XmlDump(filename)
+            pages = [r for r in dump.parallel_parse(processes=2, shardsize=1)]
+            self.assertEquals([u"Pear", u"Pyrus"] * 3,
+                              [page.title for page in pages])
+            pages = [r for r in dump.parallel_parse(processes=2, shardsize=1,
+                                                    filter=isRedirect)]
+            self.assertEquals([u"Pyrus"] * 3, [page.title for page in pages])
+        finally:
+            os.remove(filename)
+
+    def test_XmlDumpParallelMultistream(self):
+        filename = writeDump(["data/article-pear.xml",
+                              "data/article-pyrus.xml"] * 3, multistream=True)
+        try:
+            dump = xmlreader.XmlDump(filename, allrevisions=True)
+            pages = [r for r in dump.parallel_parse(processes=2, shardsize=1,
+                                                    ordered=False)]
+            self.assertEquals(30, len(pages))
+            self.assertEquals(18, len([page for page in pages
+                                      if page.title == u"Pyrus"]))
+        finally:
+            os.remove(filename)
+
+    def test_XmlDumpIndex(self):
+        filename = writeDump(["data/article-pear.xml",
+                              "data/article-pyrus.xml"])
+        try:
+            dump = xmlreader.XmlDump(filename)
+            index = dump.buildIndex()
+            self.assertEquals(index.find(title=u"Pear"),
+                              index.find(pageid=24278))
+            self.assertTrue(index.find(title=u"Apple") is None)
+            page = dump.getEntry(index, title=u"Pyrus")
+            self.assertEquals(u"9261472", page.id)
+            self.assertTrue(page.isredirect)
+            pages = [r for r in dump.resumable_parse(
+                                        start=index.find(title=u"Pyrus"))]
+            self.assertEquals([u"Pyrus"], [page.title for page in pages])
+        finally:
+            os.remove(filename)
+            os.remove(filename + '.index')
+
+    def test_XmlDumpResume(self):
+        filename = writeDump(["data/article-pear.xml",
+                              "data/article-pyrus.xml"] * 2)
+        checkpoint = filename + '.checkpoint'
+        try:
+            dump = xmlreader.XmlDump(filename)
+            gen = dump.resumable_parse(checkpoint, shardsize=1)
+            self.assertEquals(u"Pear", gen.next().title)
+            self.assertEquals(u"Pyrus", gen.next().title)
+            del gen
+            self.assertTrue(os.path.exists(checkpoint))
+            pages = [r for r in dump.resumable_parse(checkpoint, shardsize=1)]
+            self.assertEquals([u"Pyrus", u"Pear", u"Pyrus"],
+                              [page.title for page in pages])
+            self.assertFalse(os.path.exists(checkpoint))
+        finally:
+            os.remove(filename)
+
+    def test_XmlDumpResumeBrokenCheckpoint(self):
+        filename = writeDump(["data/article-pear.xml",
+                              "data/article-pyrus.xml"])
+        checkpoint = filename + '.checkpoint'
+        try:
+            # e.g. left empty by a crash
+            open(checkpoint, 'w').close()
+            dump = xmlreader.XmlDump(filename)
+            pages = [r for r in dump.resumable_parse(checkpoint, shardsize=1)]
+            self.assertEquals([u"Pear", u"Pyrus"],
+                              [page.title for page in pages])
+            self.assertFalse(os.path.exists(checkpoint))
+            self.assertFalse(os.path.exists(checkpoint + '.tmp'))
+        finally:
+            os.remove(filename)
+
+class TitleNamespacesTestCase(unittest.TestCase):
+    def testPrefixes(self):
+        namespaceOf = xmlreader.TitleNamespaces(
+            wikipedia.getSite('en', 'wikipedia'))
+        # articles named like a namespace must not affect later titles
+        self.assertEquals(0, namespaceOf(u'Talk'))
+        self.assertEquals(1, namespaceOf(u'Talk:Pear'))
+        self.assertEquals(10, namespaceOf(u'Template:Stub'))
+        self.assertEquals(0, namespaceOf(u'Template'))
+        self.assertEquals(0, namespaceOf(u'Star Wars: Episode I'))
+        self.assertEquals({u'Talk': 1, u'Template': 10}, namespaceOf.cache)
+
 if __name__ == '__main__':
     unittest.main()
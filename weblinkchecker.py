@@ -7,7 +7,7 @@ max_external_links, which defaults to 50.
 The bot won't change any wiki pages, it will only report dead links such that
 people can fix or remove the links themselves.
 
-The bot will store all links found dead in a .dat file in the deadlinks
+The bot will store all links found dead in a .db file in the deadlinks
 subdirectory. To avoid the removing of links which are only temporarily
 unavailable, the bot ONLY reports links which were reported dead at least
 two times, with a time lag of at least one week. Such links will be logged to a
@@ -22,7 +22,7 @@ feature, set report_dead_links_on_talk = True in your user-config.py, or
 specify "-talk" on the command line. Adding "-notalk" switches this off
 irrespective of the configuration variable.
 
-When a link is found alive, it will be removed from the .dat file.
+When a link is found alive, it will be removed from the .db file.
 
 These command line parameters can be used to specify which pages to work on:
 
@@ -62,6 +62,10 @@ max_external_links        - The maximum number of web pages that should be
                             is congested, and will then think that the page
                             is offline.
 
+max_external_links_per_host
+                          - The maximum number of web pages on the same
+                            host that should be loaded simultaneously.
+
 report_dead_links_on_talk - If set to true, causes the script to report dead
                             links on the article's talk page if (and ONLY if)
                             the linked page has been unavailable at least two
@@ -94,8 +98,12 @@ Syntax examples:
 __version__='$Id$'
 
 import wikipedia, config, pagegenerators
-import sys, re
+import sys, re, os
 import codecs, pickle
+try:
+    import sqlite3 # Python 2.5
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
 import httplib, socket, urlparse, urllib, urllib2
 import threading, time
 try:
@@ -255,6 +263,58 @@ class InternetArchiveConsulter:
         else:
             return None
 
+class DNSCache:
+    '''
+    Remembers the addresses of host names, so that checking many links to
+    the same host doesn't look the name up again for each connection.
+    Failed lookups are remembered as well, as dead domains are common.
+    '''
+    def __init__(self, ttl = 300):
+        self.ttl = ttl
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """
+        Returns the address to connect to. Raises socket.error if the host
+        name can't be resolved.
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.cache.get((host, port))
+        finally:
+            self.lock.release()
+        if entry is None or now - entry[0] > self.ttl:
+            try:
+                address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+            except socket.error, error:
+                address = error
+            entry = (now, address)
+            self.lock.acquire()
+            try:
+                self.cache[(host, port)] = entry
+            finally:
+                self.lock.release()
+        if isinstance(entry[1], socket.error):
+            raise entry[1]
+        return entry[1]
+
+dnsCache = DNSCache()
+
+class CachedDNSHTTPConnection(httplib.HTTPConnection):
+    '''
+    HTTPConnection which looks up the host name in dnsCache.
+    '''
+    def connect(self):
+        host = self.host
+        self.host = dnsCache.resolve(host, self.port)
+        try:
+            httplib.HTTPConnection.connect(self)
+        finally:
+            # the Host header still uses the name
+            self.host = host
+
 class LinkChecker(object):
     '''
     Given a HTTP URL, tries to load the page from the Internet and checks if it
@@ -266,12 +326,17 @@ class LinkChecker(object):
     Warning: Also returns false if your Internet connection isn't working
     correctly! (This will give a Socket Error)
     '''
-    def __init__(self, url, redirectChain = [], serverEncoding = None, HTTPignore = []):
+    def __init__(self, url, redirectChain = [], serverEncoding = None, HTTPignore = [], pool = None):
         """
         redirectChain is a list of redirects which were resolved by
         resolveRedirect(). This is needed to detect redirect loops.
+
+        pool is a wikipedia.HTTPConnectionPool from which keep-alive
+        connections are reused. If it is None, each request uses a new
+        connection.
         """
         self.url = url
+        self.pool = pool
         self.serverEncoding = serverEncoding
         self.header = {
             # 'User-agent': wikipedia.useragent,
@@ -290,11 +355,56 @@ class LinkChecker(object):
         self.HTTPignore = HTTPignore
 
     def getConnection(self):
+        if self.pool:
+            conn = self.pool.get((self.scheme, self.host))
+            if conn:
+                return conn
         if self.scheme == 'http':
-            return httplib.HTTPConnection(self.host)
+            return CachedDNSHTTPConnection(self.host)
         elif self.scheme == 'https':
             return httplib.HTTPSConnection(self.host)
 
+    def releaseConnection(self, conn, response):
+        """
+        Gives the connection back to the pool, if the server allows to
+        reuse it. Reads at most 64 KB of the remaining response body; if
+        there is more, the connection is closed instead.
+        """
+        try:
+            response.read(65536)
+        except (httplib.error, socket.error):
+            conn.close()
+            return
+        if self.pool and response.isclosed() and not response.will_close:
+            self.pool.put((self.scheme, self.host), conn)
+        else:
+            conn.close()
+
+    def request(self, method, extraHeaders = {}):
+        """
+        Sends a request for the current URL and returns the connection and
+        the response. If a reused connection turns out to be closed by the
+        server, tries again with a new one.
+        """
+        headers = dict(self.header)
+        headers.update(extraHeaders)
+        path = '%s%s' % (self.path, self.query)
+        conn = self.getConnection()
+        reused = conn.sock is not None
+        try:
+            conn.request(method, path, None, headers)
+            return conn, conn.getresponse()
+        except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+            conn.close()
+            if not reused:
+                raise
+        conn = self.getConnection()
+        if conn.sock is not None:
+            # don't try another connection from the pool
+            conn.close()
+        conn.request(method, path, None, headers)
+        return conn, conn.getresponse()
+
     def getEncodingUsedByServer(self):
         if not self.serverEncoding:
             try:
@@ -351,15 +461,17 @@ class LinkChecker(object):
         If useHEAD is true, uses the HTTP HEAD method, which saves bandwidth
         by not downloading the body. Otherwise, the HTTP GET method is used.
         '''
-        conn = self.getConnection()
         try:
             if useHEAD:
-                conn.request('HEAD', '%s%s' % (self.path, self.query), None, self.header)
+                self.method = 'HEAD'
+                conn, response = self.request('HEAD')
             else:
-                conn.request('GET', '%s%s' % (self.path, self.query), None, self.header)
-            response = conn.getresponse()
+                self.method = 'GET'
+                conn, response = self.request('GET', {'Range': 'bytes=0-1023'})
             # read the server's encoding, in case we need it later
             self.readEncodingFromResponse(response)
+            self.status, self.reason = response.status, response.reason
+            self.releaseConnection(conn, response)
         except httplib.BadStatusLine:
             # Some servers don't seem to handle HEAD requests properly,
             # e.g. http://www.radiorus.ru/ which is running on a very old
@@ -404,6 +516,10 @@ class LinkChecker(object):
         """
         Returns True and the server status message if the page is alive.
         Otherwise returns false
+
+        If useHEAD is true, a HEAD request is made first, and a GET request
+        for the first bytes of the page only if the HEAD request doesn't show
+        that the page is alive.
         """
         try:
             wasRedirected = self.resolveRedirect(useHEAD = useHEAD)
@@ -437,7 +553,7 @@ class LinkChecker(object):
                     # which leads to a cyclic list of redirects.
                     # We simply start from the beginning, but this time,
                     # we don't use HEAD, but GET requests.
-                    redirChecker = LinkChecker(self.redirectChain[0], serverEncoding = self.serverEncoding, HTTPignore = self.HTTPignore)
+                    redirChecker = LinkChecker(self.redirectChain[0], serverEncoding = self.serverEncoding, HTTPignore = self.HTTPignore, pool = self.pool)
                     return redirChecker.check(useHEAD = False)
                 else:
                     urlList = ['[%s]' % url for url in self.redirectChain + [self.url]]
@@ -448,101 +564,284 @@ class LinkChecker(object):
                     # which leads to a long (or infinite) list of redirects.
                     # We simply start from the beginning, but this time,
                     # we don't use HEAD, but GET requests.
-                    redirChecker = LinkChecker(self.redirectChain[0], serverEncoding = self.serverEncoding, HTTPignore = self.HTTPignore)
+                    redirChecker = LinkChecker(self.redirectChain[0], serverEncoding = self.serverEncoding, HTTPignore = self.HTTPignore, pool = self.pool)
                     return redirChecker.check(useHEAD = False)
                 else:
                     urlList = ['[%s]' % url for url in self.redirectChain + [self.url]]
                     return False, u'Long Chain of Redirects: %s' % ' -> '.join(urlList)
             else:
-                redirChecker = LinkChecker(self.url, self.redirectChain, self.serverEncoding, HTTPignore = self.HTTPignore)
+                redirChecker = LinkChecker(self.url, self.redirectChain, self.serverEncoding, HTTPignore = self.HTTPignore, pool = self.pool)
                 return redirChecker.check(useHEAD = useHEAD)
         else:
-            try:
-                conn = self.getConnection()
-            except httplib.error, error:
-                return False, u'HTTP Error: %s' % error.__class__.__name__
-            try:
-                conn.request('GET', '%s%s' % (self.path, self.query), None, self.header)
-            except socket.error, error:
-                return False, u'Socket Error: %s' % repr(error[1])
-            try:
-                response = conn.getresponse()
-            except Exception, error:
-                return False, u'Error: %s' % error
-            # read the server's encoding, in case we need it later
-            self.readEncodingFromResponse(response)
-            # site down if the server status is between 400 and 499
-            alive = response.status not in range(400, 500)
-            if response.status in self.HTTPignore:
+            if self.method == 'HEAD' and self.status >= 400:
+                # Some servers don't handle HEAD requests properly, so ask
+                # for the first bytes of the page to be sure.
+                try:
+                    conn, response = self.request('GET', {'Range': 'bytes=0-1023'})
+                except httplib.error, error:
+                    return False, u'HTTP Error: %s' % error.__class__.__name__
+                except socket.error, error:
+                    return False, u'Socket Error: %s' % repr(error.args[-1])
+                except Exception, error:
+                    return False, u'Error: %s' % error
+                # read the server's encoding, in case we need it later
+                self.readEncodingFromResponse(response)
+                self.status, self.reason = response.status, response.reason
+                self.releaseConnection(conn, response)
+            # site down if the server status is between 400 and 499; 416
+            # means that the page exists, but is shorter than the range
+            alive = self.status not in range(400, 500) or self.status == 416
+            if self.status in self.HTTPignore:
                 alive = False
-            return alive, '%s %s' % (response.status, response.reason)
+            return alive, '%s %s' % (self.status, self.reason)
 
 class LinkCheckThread(threading.Thread):
     '''
-    A thread responsible for checking one URL. After checking the page, it
-    will die.
+    A worker thread of LinkCheckScheduler. It checks one URL after another
+    until the scheduler is shut down.
     '''
-    def __init__(self, page, url, history, HTTPignore):
+    def __init__(self, scheduler, number):
         threading.Thread.__init__(self)
-        self.page = page
-        self.url = url
-        self.history = history
+        self.scheduler = scheduler
         # identification for debugging purposes
-        self.setName((u'%s - %s' % (page.title(), url)).encode('utf-8', 'replace'))
-        self.HTTPignore = HTTPignore
+        self.setName('LinkCheckThread-%i' % number)
 
     def run(self):
-        linkChecker = LinkChecker(self.url, HTTPignore = self.HTTPignore)
+        while True:
+            job = self.scheduler.next()
+            if job is None:
+                return
+            host, url = job
+            linkChecker = LinkChecker(url, HTTPignore = self.scheduler.HTTPignore,
+                                      pool = self.scheduler.pool)
+            try:
+                ok, message = linkChecker.check(useHEAD = True)
+            except Exception, error:
+                wikipedia.output(u'Exception while processing URL %s: %s' % (url, error))
+                ok, message = None, None
+            self.scheduler.done(host, url, ok, message)
+
+class LinkCheckScheduler:
+    '''
+    Checks the URLs given to add() with a fixed number of LinkCheckThreads.
+
+    Each URL is checked only once per run; if it is found on several pages,
+    the result is recorded for all of them. At most maxPerHost URLs of one
+    host are checked at the same time, and connections to a host are kept
+    open and reused. add() blocks while too many URLs are waiting, so that
+    the page generator doesn't run too far ahead.
+    '''
+    def __init__(self, history, HTTPignore = [], workers = None, maxPerHost = None):
+        if workers is None:
+            workers = config.max_external_links
+        if maxPerHost is None:
+            maxPerHost = config.max_external_links_per_host
+        self.history = history
+        self.HTTPignore = HTTPignore
+        self.maxPerHost = maxPerHost
+        self.maxWaiting = workers * 20
+        self.pool = wikipedia.HTTPConnectionPool(maxsize = maxPerHost,
+                                                 idle_timeout = 15)
+        self.condition = threading.Condition()
+        # host -> list of URLs waiting to be checked
+        self.waiting = {}
+        # host -> number of URLs being checked
+        self.active = {}
+        # URL -> list of pages which link to it, while it is being checked
+        self.pages = {}
+        # URL -> result of the check, for URLs found again later
+        self.results = {}
+        self.stopped = False
+        self.threads = []
+        for i in range(workers):
+            thread = LinkCheckThread(self, i)
+            # thread dies when program terminates
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, page, url):
+        self.condition.acquire()
         try:
-            ok, message = linkChecker.check()
-        except:
-            wikipedia.output('Exception while processing URL %s in page %s' % (self.url, self.page.title()))
-            raise
+            if url in self.results:
+                ok, message = self.results[url]
+            elif url in self.pages:
+                self.pages[url].append(page)
+                return
+            else:
+                while len(self.pages) >= self.maxWaiting:
+                    self.condition.wait(1)
+                host = urlparse.urlsplit(url)[1].lower()
+                self.pages[url] = [page]
+                self.waiting.setdefault(host, []).append(url)
+                self.condition.notifyAll()
+                return
+        finally:
+            self.condition.release()
+        self.report(page, url, ok, message)
+
+    def next(self):
+        """
+        Returns the next (host, URL) tuple to check, or None when the
+        scheduler is shut down.
+        """
+        self.condition.acquire()
+        try:
+            while not self.stopped:
+                for host, urls in self.waiting.iteritems():
+                    if self.active.get(host, 0) < self.maxPerHost:
+                        url = urls.pop(0)
+                        if not urls:
+                            del self.waiting[host]
+                        self.active[host] = self.active.get(host, 0) + 1
+                        return host, url
+                self.condition.wait(1)
+        finally:
+            self.condition.release()
+
+    def done(self, host, url, ok, message):
+        self.condition.acquire()
+        try:
+            self.active[host] -= 1
+            if not self.active[host]:
+                del self.active[host]
+            pages = self.pages.pop(url)
+            if ok is not None:
+                self.results[url] = (ok, message)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        if ok is not None:
+            for page in pages:
+                self.report(page, url, ok, message)
+
+    def report(self, page, url, ok, message):
         if ok:
-            if self.history.setLinkAlive(self.url):
-                wikipedia.output('*Link to %s in [[%s]] is back alive.' % (self.url, self.page.title()))
+            if self.history.setLinkAlive(url):
+                wikipedia.output('*Link to %s in [[%s]] is back alive.' % (url, page.title()))
         else:
-            wikipedia.output('*[[%s]] links to %s - %s.' % (self.page.title(), self.url, message))
-            self.history.setLinkDead(self.url, message, self.page, day)
+            wikipedia.output('*[[%s]] links to %s - %s.' % (page.title(), url, message))
+            self.history.setLinkDead(url, message, page, day)
+
+    def remaining(self):
+        """
+        Returns the number of URLs that are waiting or being checked.
+        """
+        return len(self.pages)
+
+    def shutdown(self):
+        self.condition.acquire()
+        try:
+            self.stopped = True
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        self.pool.close()
 
 class History:
     '''
     Stores previously found dead links.
-    The URLs are dictionary keys, and values are lists of tuples where each tuple
-    represents one time the URL was found dead. Tuples have the form
-    (title, date, error) where title is the wiki page where the URL was found,
-    date is an instance of time, and error is a string with error code and
-    message.
-
-    We assume that the first element in the list represents the first time we
-    found this dead link, and the last element represents the last time.
-
-    Example:
-
-    dict = {
-        'http://www.example.org/page': [
-            ('WikiPageTitle', DATE, '404: File not found'),
-            ('WikiPageName2', DATE, '404: File not found'),
-        ]
+
+    The links are kept in an SQLite database in the deadlinks subdirectory,
+    with one row for each time a URL was found dead. Rows have the columns
+    (url, page, date, error) where page is the title of the wiki page where
+    the URL was found, date is an instance of time, and error is a string
+    with error code and message.
+
+    We assume that the first row of a URL (by date) represents the first
+    time we found this dead link, and the last row represents the last time.
+    Only the first and the last maxSightings - 1 rows of each URL are kept.
+
+    Every change is written to disk immediately, so that an interrupted run
+    doesn't lose what it found; several bots may use the same database.
+    A history saved as a pickled dictionary (deadlinks-*.dat) by older
+    versions of this script is imported automatically.
     '''
+    maxSightings = 10
 
     def __init__(self, reportThread):
         self.reportThread = reportThread
         site = wikipedia.getSite()
         self.semaphore = threading.Semaphore()
-        self.datfilename = wikipedia.config.datafilepath('deadlinks',
-                               'deadlinks-%s-%s.dat'
-                               % (site.family.name, site.lang))
+        self.dbfilename = wikipedia.config.datafilepath('deadlinks',
+                              'deadlinks-%s-%s.db'
+                              % (site.family.name, site.lang))
         # Count the number of logged links, so that we can insert captions
         # from time to time
         self.logCount = 0
+        isNew = not os.path.exists(self.dbfilename)
+        # the connection is shared by the LinkCheckThreads; the semaphore
+        # serializes its use
+        self.db = sqlite3.connect(self.dbfilename, timeout = 60,
+                                  check_same_thread = False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS sightings (
+                               url TEXT, page TEXT, date REAL, error TEXT)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS sightings_url
+                               ON sightings (url, date)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS sightings_page
+                               ON sightings (page)''')
+        self.db.commit()
+        if isNew:
+            self.importDat(wikipedia.config.datafilepath('deadlinks',
+                               'deadlinks-%s-%s.dat'
+                               % (site.family.name, site.lang)))
+
+    def importDat(self, datfilename):
+        """
+        Imports a history that was saved as a pickled dictionary.
+        """
         try:
-            datfile = open(self.datfilename, 'r')
-            self.historyDict = pickle.load(datfile)
+            datfile = open(datfilename, 'r')
+            historyDict = pickle.load(datfile)
             datfile.close()
         except (IOError, EOFError):
-            # no saved history exists yet, or history dump broken
-            self.historyDict = {}
+            # no saved history exists, or history dump broken
+            return
+        wikipedia.output(u'Importing dead link history from %s...'
+                         % wikipedia.config.shortpath(datfilename))
+        for url, entries in historyDict.iteritems():
+            self.db.executemany('INSERT INTO sightings VALUES (?, ?, ?, ?)',
+                                [(url, title, date, error)
+                                 for title, date, error in entries])
+        self.db.commit()
+
+    def sightings(self, url):
+        """
+        Returns a list of (title, date, error) tuples, one for each time the
+        URL was found dead, sorted by date.
+        """
+        return self.db.execute('SELECT page, date, error FROM sightings '
+                               'WHERE url = ? ORDER BY date', (url,)).fetchall()
+
+    def deadSince(self, day):
+        """
+        Yields the URLs which were found dead for the first time more than
+        the given number of days ago.
+        """
+        # fetch all rows at once, an open cursor would lock out the writes
+        # of other connections to the database while we are iterating
+        rows = self.db.execute('SELECT url FROM sightings GROUP BY url '
+                               'HAVING MIN(date) < ?',
+                               (time.time() - 60 * 60 * 24 * day,)).fetchall()
+        for (url,) in rows:
+            yield url
+
+    def pageTitles(self, chunk = 500):
+        """
+        Yields the titles of the pages where dead links were found, in
+        alphabetical order.
+
+        The titles are read in chunks, so that the database isn't locked
+        against writes (e.g. by the bot checking these pages) in between.
+        """
+        rows = self.db.execute('SELECT DISTINCT page FROM sightings '
+                               'ORDER BY page LIMIT ?', (chunk,)).fetchall()
+        while rows:
+            for (title,) in rows:
+                yield title
+            rows = self.db.execute('SELECT DISTINCT page FROM sightings '
+                                   'WHERE page > ? ORDER BY page LIMIT ?',
+                                   (title, chunk)).fetchall()
 
     def log(self, url, error, containingPage, archiveURL):
         """
@@ -553,7 +852,7 @@ class History:
             errorReport = u'* %s ([%s archive])\n' % (url, archiveURL)
         else:
             errorReport = u'* %s\n' % url
-        for (pageTitle, date, error) in self.historyDict[url]:
+        for (pageTitle, date, error) in self.sightings(url):
             # ISO 8601 formulation
             isoDate = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(date))
             errorReport += "** In [[%s]] on %s, %s\n" % (pageTitle, isoDate, error)
@@ -574,53 +873,66 @@ class History:
 
     def setLinkDead(self, url, error, page, day):
         """
-        Adds the fact that the link was found dead to the .dat file.
+        Adds the fact that the link was found dead to the database.
         """
         self.semaphore.acquire()
-        now = time.time()
-        if url in self.historyDict:
-            timeSinceFirstFound = now - self.historyDict[url][0][1]
-            timeSinceLastFound= now - self.historyDict[url][-1][1]
-            # if the last time we found this dead link is less than an hour
-            # ago, we won't save it in the history this time.
-            if timeSinceLastFound > 60 * 60:
-                self.historyDict[url].append((page.title(), now, error))
-            # if the first time we found this link longer than x day ago (default is a week),
-            # it should probably be fixed or removed. We'll list it in a file
-            # so that it can be removed manually.
-            if timeSinceFirstFound > 60 * 60 * 24 * day:
-                # search for archived page
-                iac = InternetArchiveConsulter(url)
-                archiveURL = iac.getArchiveURL()
-                self.log(url, error, page, archiveURL)
-        else:
-            self.historyDict[url] = [(page.title(), now, error)]
-        self.semaphore.release()
+        try:
+            now = time.time()
+            sightings = self.sightings(url)
+            if sightings:
+                timeSinceFirstFound = now - sightings[0][1]
+                timeSinceLastFound= now - sightings[-1][1]
+                # if the last time we found this dead link is less than an hour
+                # ago, we won't save it in the history this time.
+                if timeSinceLastFound > 60 * 60:
+                    self.addSighting(url, page.title(), now, error)
+                # if the first time we found this link longer than x day ago (default is a week),
+                # it should probably be fixed or removed. We'll list it in a file
+                # so that it can be removed manually.
+                if timeSinceFirstFound > 60 * 60 * 24 * day:
+                    # search for archived page
+                    iac = InternetArchiveConsulter(url)
+                    archiveURL = iac.getArchiveURL()
+                    self.log(url, error, page, archiveURL)
+            else:
+                self.addSighting(url, page.title(), now, error)
+        finally:
+            self.semaphore.release()
+
+    def addSighting(self, url, title, date, error):
+        self.db.execute('INSERT INTO sightings VALUES (?, ?, ?, ?)',
+                        (url, title, date, error))
+        # keep the first sighting and the most recent ones
+        self.db.execute('DELETE FROM sightings WHERE url = ? AND rowid NOT IN '
+                        '(SELECT rowid FROM sightings WHERE url = ? '
+                        'ORDER BY date LIMIT 1) AND rowid NOT IN '
+                        '(SELECT rowid FROM sightings WHERE url = ? '
+                        'ORDER BY date DESC LIMIT ?)',
+                        (url, url, url, self.maxSightings - 1))
+        self.db.commit()
 
     def setLinkAlive(self, url):
         """
-        If the link was previously found dead, removes it from the .dat file
+        If the link was previously found dead, removes it from the database
         and returns True, else returns False.
         """
-        if url in self.historyDict:
-            self.semaphore.acquire()
-            try:
-                del self.historyDict[url]
-            except KeyError:
-                # Not sure why this can happen, but I guess we can ignore this...
-                pass
+        self.semaphore.acquire()
+        try:
+            cursor = self.db.execute('DELETE FROM sightings WHERE url = ?', (url,))
+            self.db.commit()
+            return cursor.rowcount > 0
+        finally:
             self.semaphore.release()
-            return True
-        else:
-            return False
 
     def save(self):
         """
-        Saves the .dat file to disk.
+        Makes sure that all changes are saved to disk.
         """
-        datfile = open(self.datfilename, 'w')
-        pickle.dump(self.historyDict, datfile)
-        datfile.close()
+        self.semaphore.acquire()
+        try:
+            self.db.commit()
+        finally:
+            self.semaphore.release()
 
 class DeadLinkReportThread(threading.Thread):
     '''
@@ -696,7 +1008,8 @@ class DeadLinkReportThread(threading.Thread):
 class WeblinkCheckerRobot:
     '''
     Robot which will use several LinkCheckThreads at once to search for dead
-    weblinks on pages provided by the given generator.
+    weblinks on pages provided by the given generator, see
+    LinkCheckScheduler.
     '''
     def __init__(self, generator, HTTPignore = []):
         self.generator = generator
@@ -710,6 +1023,7 @@ class WeblinkCheckerRobot:
             reportThread = None
         self.history = History(reportThread)
         self.HTTPignore = HTTPignore
+        self.scheduler = LinkCheckScheduler(self.history, HTTPignore)
 
     def run(self):
         for page in self.generator:
@@ -727,26 +1041,11 @@ class WeblinkCheckerRobot:
                 if ignoreR.match(url):
                     ignoreUrl = True
             if not ignoreUrl:
-                # Limit the number of threads started at the same time. Each
-                # thread will check one page, then die.
-                while threading.activeCount() >= config.max_external_links:
-                    # wait 100 ms
-                    time.sleep(0.1)
-                thread = LinkCheckThread(page, url, self.history, self.HTTPignore)
-                # thread dies when program terminates
-                thread.setDaemon(True)
-                thread.start()
+                self.scheduler.add(page, url)
 
 def RepeatPageGenerator():
     history = History(None)
-    pageTitles = set()
-    for (key, value) in history.historyDict.iteritems():
-        for entry in value:
-            pageTitle = entry[0]
-            pageTitles.add(pageTitle)
-    pageTitles = list(pageTitles)
-    pageTitles.sort()
-    for pageTitle in pageTitles:
+    for pageTitle in history.pageTitles():
         page = wikipedia.Page(wikipedia.getSite(), pageTitle)
         yield page
 
@@ -810,19 +1109,20 @@ def main():
             bot.run()
         finally:
             waitTime = 0
-            # Don't wait longer than 30 seconds for threads to finish.
-            while countLinkCheckThreads() > 0 and waitTime < 30:
+            # Don't wait longer than 30 seconds for links to be checked.
+            while bot.scheduler.remaining() > 0 and waitTime < 30:
                 try:
-                    wikipedia.output(u"Waiting for remaining %i threads to finish, please wait..." % countLinkCheckThreads())
+                    wikipedia.output(u"Waiting for remaining %i links to be checked, please wait..." % bot.scheduler.remaining())
                     # wait 1 second
                     time.sleep(1)
                     waitTime += 1
                 except KeyboardInterrupt:
                     wikipedia.output(u'Interrupted.')
                     break
-            if countLinkCheckThreads() > 0:
-                wikipedia.output(u'Remaining %i threads will be killed.' % countLinkCheckThreads())
-                # Threads will die automatically because they are daemonic.
+            if bot.scheduler.remaining() > 0:
+                wikipedia.output(u'Remaining %i links will not be checked.' % bot.scheduler.remaining())
+            # Threads will die automatically because they are daemonic.
+            bot.scheduler.shutdown()
             if bot.history.reportThread:
                 bot.history.reportThread.shutdown()
                 # wait until the report thread is shut down; the user can interrupt
@@ -34,6 +34,7 @@ Exceptions:
 Objects:
     get_throttle:       Call to limit rate of read-access to wiki
     put_throttle:       Call to limit rate of write-access to wiki
+    page_put_queue:     PutScheduler saving pages queued by put_async()
 
 Other functions:
     getall(): Load a group of pages via Special:Export
@@ -122,7 +123,7 @@ from __future__ import generators
 #
 __version__ = '$Id$'
 
-import os, sys
+import os, sys, errno
 import httplib, socket, urllib, urllib2, cookielib
 import traceback
 import time, threading, Queue
@@ -259,18 +260,48 @@ class Page(object):
           even reload it if it has been loaded before
 
     """
+    # Only the title parts are stored in slots. All other attributes, like
+    # the contents, get an instance dictionary only once they are set;
+    # until then, the class attributes below are their defaults.
+    __slots__ = ('_site', '_namespace', '_section', '_title',
+                 '__dict__', '__weakref__')
+
+    # if _editrestriction is True, it means that the page has been found
+    # to have an edit restriction, but we do not know yet whether the
+    # restriction affects us or not
+    _editrestriction = False
+    editRestriction = None
+    moveRestriction = None
+    _permalink = None
+    _userName = None
+    _ipedit = None
+    _editTime = '0'
+    _startTime = '0'
+    # For the Flagged Revisions MediaWiki extension
+    _revisionId = None
+    _deletedRevs = None
+
     def __init__(self, site, title, insite=None, defaultNamespace=0):
         try:
-            # if _editrestriction is True, it means that the page has been found
-            # to have an edit restriction, but we do not know yet whether the
-            # restriction affects us or not
-            self._editrestriction = False
-
             if site is None:
                 site = getSite()
             elif type(site) in [str, unicode]:
                 site = getSite(site)
 
+            # The same titles are often constructed many times, so the
+            # result of the normalization below is kept per site.
+            if not insite or insite is site:
+                key = (title, defaultNamespace)
+            else:
+                key = (title, defaultNamespace, repr(insite))
+            cache = site._titleCache
+            try:
+                self._site, self._namespace, self._section, self._title = \
+                            cache[key]
+                return
+            except KeyError:
+                pass
+
             self._site = site
 
             if not insite:
@@ -403,16 +434,11 @@ not supported by PyWikipediaBot!"""
                 t += u'#' + self._section
 
             self._title = t
-            self.editRestriction = None
-            self.moveRestriction = None
-            self._permalink = None
-            self._userName = None
-            self._ipedit = None
-            self._editTime = '0'
-            self._startTime = '0'
-            # For the Flagged Revisions MediaWiki extension
-            self._revisionId = None
-            self._deletedRevs = None
+
+            if len(cache) >= config.page_title_cache_size:
+                cache.clear()
+            cache[key] = (self._site, self._namespace, self._section,
+                          self._title)
         except NoSuchSite:
             raise
         except:
@@ -1486,8 +1512,9 @@ not supported by PyWikipediaBot!"""
         """Put page on queue to be saved to wiki asynchronously.
 
         Asynchronous version of put (takes the same arguments), which places
-        pages on a queue to be saved by a daemon thread. All arguments  are
-        the same as for .put(), except --
+        pages on a queue to be saved by a daemon thread. Each site has its
+        own queue and thread, so pages on different sites are saved at the
+        same time. All arguments  are the same as for .put(), except --
 
         callback: a callable object that will be called after the page put
                   operation; this object must take two arguments:
@@ -1498,16 +1525,8 @@ not supported by PyWikipediaBot!"""
         of which saves were successful.
 
         """
-        try:
-            page_put_queue.mutex.acquire()
-            try:
-                _putthread.start()
-            except (AssertionError, RuntimeError):
-                pass
-        finally:
-            page_put_queue.mutex.release()
-        page_put_queue.put((self, newtext, comment, watchArticle, minorEdit,
-                            force, callback))
+        page_put_queue.put(self, newtext, comment, watchArticle, minorEdit,
+                           force, callback)
 
     def put(self, newtext, comment=None, watchArticle=None, minorEdit=True,
             force=False, sysop=False, botflag=True, maxTries=-1):
@@ -1672,7 +1691,7 @@ not supported by PyWikipediaBot!"""
             # Check whether we are not too quickly after the previous
             # putPage, and wait a bit until the interval is acceptable
             if not dblagged:
-                put_throttle()
+                currentPutThrottle()()
             # Which web-site host are we submitting to?
             if newPage:
                 output(u'Creating page %s via API' % self.aslink())
@@ -1753,7 +1772,7 @@ not supported by PyWikipediaBot!"""
                     timelag = int(lag.group("lag"))
                     output(u"Pausing %d seconds due to database server lag." % min(timelag,300))
                     dblagged = True
-                    time.sleep(min(timelag,300))
+                    currentPutThrottle().backoff(min(timelag,300))
                     continue
                 elif errorCode == 'editconflict':
                     # 'editconflict':"Edit conflict detected",
@@ -1906,7 +1925,7 @@ not supported by PyWikipediaBot!"""
             # Check whether we are not too quickly after the previous
             # putPage, and wait a bit until the interval is acceptable
             if not dblagged:
-                put_throttle()
+                currentPutThrottle()()
             # Which web-site host are we submitting to?
             if newPage:
                 output(u'Creating page %s' % self.aslink())
@@ -1923,7 +1942,7 @@ not supported by PyWikipediaBot!"""
                             output(data, newline=False)
                         output(u"Pausing %d seconds due to database server lag." % wait)
                         dblagged = True
-                        time.sleep(wait)
+                        currentPutThrottle().backoff(wait)
                         wait = min(wait*2, 300)
                         continue
                     # Squid error 503
@@ -2244,6 +2263,18 @@ not supported by PyWikipediaBot!"""
         # representation of an instance can not change after the construction.
         return hash(str(self))
 
+    def __getstate__(self):
+        # Pickling doesn't save the slots by itself
+        state = self.__dict__.copy()
+        for name in ('_site', '_namespace', '_section', '_title'):
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     def linkedPages(self, withImageLinks = False):
         """Return a list of Pages that this Page links to.
 
@@ -2349,114 +2380,36 @@ not supported by PyWikipediaBot!"""
             except (IsRedirectPage, NoPage):
                 return []
 
-        # remove commented-out stuff etc.
-        thistxt  = removeDisabledParts(thistxt)
-
-        # marker for inside templates or parameters
-        marker = findmarker(thistxt,  u'@@', u'@')
-
-        # marker for links
-        marker2 = findmarker(thistxt,  u'##', u'#')
-
-        # marker for math
-        marker3 = findmarker(thistxt,  u'%%', u'%')
-
         result = []
-        inside = {}
-        count = 0
-        Rtemplate = re.compile(
-                    ur'{{(msg:)?(?P<name>[^{\|]+?)(\|(?P<params>[^{]*?))?}}')
-        Rlink = re.compile(ur'\[\[[^\]]+\]\]')
-        Rmath = re.compile(ur'<math>[^<]+</math>')
-        Rmarker = re.compile(ur'%s(\d+)%s' % (marker, marker))
-        Rmarker2 = re.compile(ur'%s(\d+)%s' % (marker2, marker2))
-        Rmarker3 = re.compile(ur'%s(\d+)%s' % (marker3, marker3))
-
-        # Replace math with markers
-        maths = {}
-        count = 0
-        for m in Rmath.finditer(thistxt):
-            count += 1
-            text = m.group()
-            thistxt = thistxt.replace(text, '%s%d%s' % (marker3, count, marker3))
-            maths[count] = text
-
-        while Rtemplate.search(thistxt) is not None:
-            for m in Rtemplate.finditer(thistxt):
-                # Make sure it is not detected again
-                count += 1
-                text = m.group()
-                thistxt = thistxt.replace(text,
-                                          '%s%d%s' % (marker, count, marker))
-                # Make sure stored templates don't contain markers
-                for m2 in Rmarker.finditer(text):
-                    text = text.replace(m2.group(), inside[int(m2.group(1))])
-                for m2 in Rmarker3.finditer(text):
-                    text = text.replace(m2.group(), maths[int(m2.group(1))])
-                inside[count] = text
-
-                # Name
-                name = m.group('name').strip()
-                m2 = Rmarker.search(name) or Rmath.search(name)
-                if m2 is not None:
-                    # Doesn't detect templates whose name changes,
-                    # or templates whose name contains math tags
-                    continue
-                if self.site().isInterwikiLink(name):
-                    continue
+        for name, params, start, end in parse_templates(thistxt):
+            name = name.strip()
+            if self.site().isInterwikiLink(name):
+                continue
 
-                # {{#if: }}
-                if name.startswith('#'):
-                    continue
-                # {{DEFAULTSORT:...}}
-                defaultKeys = self.site().getmagicwords('defaultsort')
-                # It seems some wikis does not have this magic key
-                if defaultKeys:
-                    found = False
-                    for key in defaultKeys:
-                        if name.startswith(key):
-                            found = True
-                            break
-                    if found: continue
+            # {{#if: }}
+            if name.startswith('#'):
+                continue
+            # {{DEFAULTSORT:...}}
+            defaultKeys = self.site().getmagicwords('defaultsort')
+            # It seems some wikis does not have this magic key
+            if defaultKeys:
+                found = False
+                for key in defaultKeys:
+                    if name.startswith(key):
+                        found = True
+                        break
+                if found: continue
 
-                try:
-                    name = Page(self.site(), name).title()
-                except InvalidTitle:
-                    if name:
-                        output(
-                            u"Page %s contains invalid template name {{%s}}."
-                           % (self.title(), name.strip()))
-                    continue
-                # Parameters
-                paramString = m.group('params')
-                params = []
-                if paramString:
-                    # Replace links to markers
-                    links = {}
-                    count2 = 0
-                    for m2 in Rlink.finditer(paramString):
-                        count2 += 1
-                        text = m2.group()
-                        paramString = paramString.replace(text,
-                                        '%s%d%s' % (marker2, count2, marker2))
-                        links[count2] = text
-                    # Parse string
-                    markedParams = paramString.split('|')
-                    # Replace markers
-                    for param in markedParams:
-                        for m2 in Rmarker.finditer(param):
-                            param = param.replace(m2.group(),
-                                                  inside[int(m2.group(1))])
-                        for m2 in Rmarker2.finditer(param):
-                            param = param.replace(m2.group(),
-                                                  links[int(m2.group(1))])
-                        for m2 in Rmarker3.finditer(param):
-                            param = param.replace(m2.group(),
-                                                  maths[int(m2.group(1))])
-                        params.append(param)
-
-                # Add it to the result
-                result.append((name, params))
+            try:
+                name = Page(self.site(), name).title()
+            except InvalidTitle:
+                if name:
+                    output(
+                        u"Page %s contains invalid template name {{%s}}."
+                       % (self.title(), name.strip()))
+                continue
+            # Add it to the result
+            result.append((name, [param for param, equals in params]))
         return result
 
     def getRedirectTarget(self):
@@ -3674,18 +3627,8 @@ class ImagePage(Page):
             #'': '',
         }
 
-        while True:
-            data = query.GetData(params, self.site())
-            if 'error' in data:
-                raise RuntimeError("%s" % data['error'])
-            
-            for iu in data['query']["imageusage"]:
-                yield Page(self.site(), iu['title'], defaultNamespace=iu['ns'])
-            
-            if 'query-continue' in data:
-                params['iucontinue'] = data['query-continue']['imageusage']['iucontinue']
-            else:
-                break
+        for iu in query.IterData(params, self.site(), throttle=False):
+            yield Page(self.site(), iu['title'], defaultNamespace=iu['ns'])
     
     def _usingPagesOld(self):
         """Yield Pages on which the image is displayed."""
@@ -3705,12 +3648,15 @@ class ImagePage(Page):
 
 class _GetAll(object):
     """For internal use only - supports getall() function"""
-    def __init__(self, site, pages, throttle, force):
+    def __init__(self, site, pages, throttle, force, sitethrottle=None):
         self.site = site
         self.pages = []
         self.throttle = throttle
         self.force = force
         self.sleeptime = 15
+        # Throttle to slow down with; the global get_throttle unless the
+        # chunk is fetched by a _GetAllPool worker.
+        self.sitethrottle = sitethrottle or get_throttle
 
         for page in pages:
             if (not hasattr(page, '_contents') and not hasattr(page, '_getexception')) or force:
@@ -3922,7 +3868,7 @@ class _GetAll(object):
             'curonly': 'True',
         }
         # Slow ourselves down
-        get_throttle(requestsize = len(self.pages))
+        self.sitethrottle(requestsize = len(self.pages))
         # Now make the actual request to the server
         now = time.time()
         response, data = self.site.postForm(address, predata)
@@ -4074,26 +4020,115 @@ class _GetAll(object):
         }
 
         # Slow ourselves down
-        get_throttle(requestsize = len(self.pages))
+        self.sitethrottle(requestsize = len(self.pages))
         # Now make the actual request to the server
         now = time.time()
 
         #get_throttle.setDelay(time.time() - now)
         return query.GetData(params, self.site)
 
-def getall(site, pages, throttle=True, force=False):
+class _GetAllPool(object):
+    """For internal use only - supports getall() and getall_multisite().
+
+    Fetches chunks of pages with a bounded pool of worker threads. Chunks
+    for different sites are retrieved at the same time; requests to one site
+    are still slowed down by that site's own throttle (see
+    getSiteThrottle()). The results are stored into the Page objects, as
+    with _GetAll.
+
+    """
+    def __init__(self, workers, throttle, force):
+        self.workers = workers
+        self.throttle = throttle
+        self.force = force
+
+    def run(self, chunks):
+        """Retrieve chunks, a list of (site, pages) tuples."""
+        queue = Queue.Queue()
+        for chunk in chunks:
+            queue.put(chunk)
+        self.errors = []
+        threads = []
+        for i in range(min(self.workers, len(chunks))):
+            thread = threading.Thread(target=self.work, args=(queue,))
+            thread.setName('GetAll-Thread-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # join with a timeout, so that KeyboardInterrupt gets through
+            while thread.isAlive():
+                thread.join(1)
+        if self.errors:
+            exc_type, exc_value, exc_traceback = self.errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+    def work(self, queue):
+        while not self.errors:
+            try:
+                site, pages = queue.get_nowait()
+            except Queue.Empty:
+                return
+            output(u'Getting %d pages from %s...' % (len(pages), site))
+            try:
+                _GetAll(site, pages, self.throttle, self.force,
+                        sitethrottle=getSiteThrottle(site)).run()
+            except:
+                self.errors.append(sys.exc_info())
+
+
+_siteThrottles = {}
+_siteThrottlesLock = threading.Lock()
+
+def getSiteThrottle(site, write=False):
+    """Return the throttle used for site by concurrent bulk retrieval (or,
+    if write is True, by the put lanes of PutScheduler).
+
+    Unlike get_throttle and put_throttle, which are shared by all sites,
+    each site gets its own Throttle objects, so that requests to different
+    sites don't wait for each other.
+
+    """
+    _siteThrottlesLock.acquire()
+    try:
+        key = (repr(site), write)
+        if key not in _siteThrottles:
+            if config.shared_throttle:
+                _siteThrottles[key] = TokenBucketThrottle(site=repr(site),
+                                                          write=write)
+            elif write:
+                _siteThrottles[key] = Throttle(write=True)
+            else:
+                _siteThrottles[key] = Throttle(multiplydelay=False)
+        return _siteThrottles[key]
+    finally:
+        _siteThrottlesLock.release()
+
+def _getallChunks(site, pages):
+    """Split pages into chunks of a size suitable for one bulk request."""
+    # default is 500/4, but It might have good point for server.
+    limit = config.special_page_limit / 4
+    return [(site, pages[i:i + limit]) for i in range(0, len(pages), limit)]
+
+def getall(site, pages, throttle=True, force=False, workers=None):
     """Use Special:Export to bulk-retrieve a group of pages from site
 
     Arguments: site = Site object
                pages = iterable that yields Page objects
+               workers = number of chunks to retrieve at the same time;
+                         defaults to config.getall_workers
 
     """
     # TODO: why isn't this a Site method?
     pages = list(pages)  # if pages is an iterator, we need to make it a list
     output(u'Getting %d pages %s from %s...'
            % (len(pages), iif(site.has_api() and debug, u'via API', u''), site))
+    if workers is None:
+        workers = config.getall_workers
     limit = config.special_page_limit / 4 # default is 500/4, but It might have good point for server.
-    if len(pages) > limit:
+    if len(pages) > limit and workers > 1:
+        _GetAllPool(workers, throttle, force).run(_getallChunks(site, pages))
+    elif len(pages) > limit:
         # separate export pages for bulk-retrieve
         
         for pagg in range(0, len(pages), limit):
@@ -4111,6 +4146,35 @@ def getall(site, pages, throttle=True, force=False):
     else:
         _GetAll(site, pages, throttle, force).run()
 
+def getall_multisite(pages, throttle=True, force=False, workers=None):
+    """Bulk-retrieve a group of pages which may belong to different sites.
+
+    The pages are grouped by site and split into chunks like in getall();
+    all chunks are then retrieved by a pool of worker threads, so that
+    several sites are queried at the same time.
+
+    Arguments: pages = iterable that yields Page objects
+               workers = maximum number of chunks retrieved at the same time;
+                         defaults to config.getall_workers
+
+    """
+    if workers is None:
+        workers = config.getall_workers
+    bysite = {}
+    sites = []
+    for page in pages:
+        key = repr(page.site())
+        if key not in bysite:
+            bysite[key] = []
+            sites.append(page.site())
+        bysite[key].append(page)
+    chunks = []
+    for site in sites:
+        chunks += _getallChunks(site, bysite[repr(site)])
+    output(u'Getting %d pages from %d sites...'
+           % (sum([len(k) for k in bysite.itervalues()]), len(sites)))
+    _GetAllPool(max(1, workers), throttle, force).run(chunks)
+
 
 # Library functions
 
@@ -4406,10 +4470,10 @@ class Site(object):
     fam             Wiki family (optional: defaults to configured).
                     Can either be a string or a Family object.
     user            User to use (optional: defaults to configured)
-    persistent_http Use a persistent http connection. An http connection
-                    has to be established only once, making stuff a whole
-                    lot faster. Do NOT EVER use this if you share Site
-                    objects across threads without proper locking.
+    persistent_http Use persistent (keep-alive) http connections taken from
+                    a connection pool shared by all sites. A connection to a
+                    host has to be established only once, making stuff a
+                    whole lot faster. Defaults to config.persistent_http.
 
     Methods:
 
@@ -4592,6 +4656,9 @@ class Site(object):
 
         self._mediawiki_messages = {}
         self._info = {}
+        # normalized title parts of recently constructed Pages, see
+        # Page.__init__
+        self._titleCache = {}
         self.nocapitalize = self.lang in self.family.nocapitalize
         self.user = user
         self._userData = [False, False]
@@ -4609,7 +4676,9 @@ class Site(object):
             if not language[0].upper() + language[1:] in self.namespaces():
                 self._validlanguages.append(language)
 
-        self.persistent_http = False
+        if persistent_http is None:
+            persistent_http = config.persistent_http
+        self.persistent_http = persistent_http
 
     def _userIndex(self, sysop = False):
         """Returns the internal index of the user."""
@@ -4924,6 +4993,12 @@ sysopnames['%s']['%s']='name' to your user-config.py"""
                 raise CaptchaError('We have been prompted for a ReCaptcha, but pywikipedia does not yet support ReCaptchas')
             return None
 
+    def _urlopener(self):
+        """Return the urllib2 opener to be used for requests to this site."""
+        if self.persistent_http:
+            return KeepAliveURLopener
+        return MyURLopener
+
     def postForm(self, address, predata, sysop = False, cookies = None):
         """Post http form data to the given address at this site.
 
@@ -4985,7 +5060,7 @@ sysopnames['%s']['%s']='name' to your user-config.py"""
         while True:
             try:
                 request = urllib2.Request(url, data, headers)
-                f = MyURLopener.open(request)
+                f = self._urlopener().open(request)
 
                 # read & info can raise socket.error
                 text = f.read()
@@ -4996,6 +5071,14 @@ sysopnames['%s']['%s']='name' to your user-config.py"""
             except urllib2.HTTPError, e:
                 if e.code in [401, 404]:
                     raise PageNotFound(u'Page %s could not be retrieved. Check your family file ?' % url)
+                elif e.code == 503 and config.retry_on_fail \
+                        and e.info().get('retry-after', '').isdigit():
+                    # the server asks us to come back later
+                    wait = min(int(e.info()['retry-after']), 300)
+                    output(u'HTTPError: %s %s. Retrying in %d seconds...'
+                           % (e.code, e.msg, wait))
+                    put_throttle.backoff(wait)
+                    continue
                 # just check for HTTP Status 500 (Internal Server Error)?
                 elif e.code in [500, 502, 504]:
                     output(u'HTTPError: %s %s' % (e.code, e.msg))
@@ -5131,7 +5214,7 @@ sysopnames['%s']['%s']='name' to your user-config.py"""
         while True:
             try:
                 request = urllib2.Request(url, data, headers)
-                f = MyURLopener.open(request)
+                f = self._urlopener().open(request)
 
                 # read & info can raise socket.error
                 text = f.read()
@@ -5142,6 +5225,14 @@ sysopnames['%s']['%s']='name' to your user-config.py"""
             except urllib2.HTTPError, e:
                 if e.code in [401, 404]:
                     raise PageNotFound(u'Page %s could not be retrieved. Check your family file ?' % url)
+                elif e.code == 503 and retry \
+                        and e.info().get('retry-after', '').isdigit():
+                    # the server asks us to come back later
+                    wait = min(int(e.info()['retry-after']), 300)
+                    output(u'HTTPError: %s %s. Retrying in %d seconds...'
+                           % (e.code, e.msg, wait))
+                    get_throttle.backoff(wait)
+                    continue
                 elif e.code == 504:
                     output(u'HTTPError: %s %s' % (e.code, e.msg))
                     if retry:
@@ -5548,15 +5639,24 @@ sysopnames['%s']['%s']='name' to your user-config.py"""
                         output(u'Elementtree was not found, using BeautifulSoup instead')
                     elementtree = False
 
+            cached = None
             if config.use_diskcache and not api:
                 import diskcache
-                _dict = lambda x : diskcache.CachedReadOnlyDictI(x, prefix = "msg-%s-%s-" % (self.family.name, self.lang))
+                # keyed by MediaWiki version, as messages change with it
+                cachename = "msg-%s-%s-%s" % (self.family.name, self.lang,
+                                              self.version())
+                if not forceReload:
+                    cached = diskcache.CachedReadOnlyDictI.open(
+                        cachename, max_age = config.diskcache_max_age * 86400)
+                _dict = lambda x : diskcache.CachedReadOnlyDictI(x, name = cachename)
             else:
                 _dict = dict
 
             retry_idle_time = 1
             retry_attempt = 0
-            while True:
+            if cached:
+                self._mediawiki_messages = cached
+            while not cached:
                 if api and self.versionnumber() >= 12 or self.versionnumber() >= 16:
                     params = {
                         'action': 'query',
@@ -6308,25 +6408,8 @@ sysopnames['%s']['%s']='name' to your user-config.py"""
         elif includeredirects == 'only':
             params['apfilterredir'] = 'redirects'
 
-        while True:
-
-            if throttle:
-                get_throttle()
-            data = query.GetData(params, self)
-            if 'warnings' in data:
-                warning = data['warnings']['allpages']['*']
-                raise str(warning)
-            count = 0
-            for p in data['query']['allpages']:
-                count += 1
-                yield Page(self, p['title'])
-                if count >= config.special_page_limit:
-                    break
-
-            if 'query-continue' in data and count < params['aplimit']:
-                params['apfrom'] = data['query-continue']['allpages']['apfrom']
-            else:
-                break
+        for p in query.IterData(params, self, throttle=throttle):
+            yield Page(self, p['title'])
 
     def _allpagesOld(self, start='!', namespace=0, includeredirects=True,
                  throttle=True):
@@ -7503,22 +7586,141 @@ Global arguments available for all bots:
         raise
         output(u'Sorry, no help available for %s' % moduleName)
 
-page_put_queue = Queue.Queue(config.max_queue_size)
-def async_put():
-    """Daemon; take pages from the queue and try to save them on the wiki."""
+class PutScheduler(object):
+    """Save pages asynchronously, with one worker thread (lane) per site.
+
+    Saves to different sites are made at the same time, while each lane is
+    slowed down by its site's own write throttle (see getSiteThrottle()).
+    Within a lane, pages are saved in the order in which they were queued.
+
+    """
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.lanes = {}
+        self.lock = threading.Lock()
+
+    def put(self, page, *args):
+        """Queue page to be saved; args are the arguments of async_put()."""
+        self.lane(page.site()).put((page,) + args)
+
+    def lane(self, site):
+        """Return the put lane for site, starting it if necessary."""
+        self.lock.acquire()
+        try:
+            key = repr(site)
+            if key not in self.lanes:
+                lane = _PutLane(site, self.maxsize)
+                lane.start()
+                self.lanes[key] = lane
+            return self.lanes[key]
+        finally:
+            self.lock.release()
+
+    def backlog(self):
+        """Return a list of (site, pages remaining, seconds remaining) tuples
+        for the sites which still have pages to be saved.
+        """
+        self.lock.acquire()
+        try:
+            lanes = self.lanes.values()
+        finally:
+            self.lock.release()
+        result = []
+        for lane in lanes:
+            remaining = lane.remaining()
+            if remaining:
+                result.append((lane.site, remaining,
+                               remaining * lane.throttle.getDelay(True)))
+        return result
+
+    def remaining(self):
+        """Return the number of pages not saved yet and the estimated time
+        in seconds needed to save them. Lanes work in parallel, so the time
+        is the one of the slowest lane.
+        """
+        backlog = self.backlog()
+        return (sum([pages for site, pages, eta in backlog]),
+                max([0] + [eta for site, pages, eta in backlog]))
+
+    def stop(self):
+        """Tell all lanes to stop once their queues are empty."""
+        for lane in self.lanes.values():
+            lane.put((None, None, None, None, None, None, None))
+            lane.stopping = True
+
+    def isAlive(self):
+        """Return True while a lane is still saving pages."""
+        for lane in self.lanes.values():
+            if lane.isAlive():
+                return True
+        return False
+
+    def join(self, timeout=None):
+        for lane in self.lanes.values():
+            lane.join(timeout)
+
+
+class _PutLane(threading.Thread):
+    """For internal use only - worker thread of PutScheduler for one site"""
+    def __init__(self, site, maxsize):
+        threading.Thread.__init__(self)
+        # identification for debugging purposes
+        self.setName('Put-Thread-%s' % repr(site))
+        self.setDaemon(True)
+        self.site = site
+        self.queue = Queue.Queue(maxsize)
+        self.throttle = getSiteThrottle(site, write=True)
+        self.busy = False
+        self.stopping = False
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def remaining(self):
+        """Return the number of pages waiting or being saved."""
+        if not self.isAlive():
+            return 0
+        remaining = self.queue.qsize() + int(self.busy)
+        if self.stopping:
+            # don't count the end-of-Queue marker
+            remaining -= 1
+        return max(0, remaining)
+
+    def run(self):
+        # Page.put() uses the throttle of the lane, see currentPutThrottle()
+        _putLaneData.throttle = self.throttle
+        async_put(self)
+
+
+# Holds the write throttle of the put lane running in the current thread
+_putLaneData = threading.local()
+
+def currentPutThrottle():
+    """Return the throttle limiting saves made by the current thread: the
+    site's own write throttle in put lanes, otherwise put_throttle.
+    """
+    return getattr(_putLaneData, 'throttle', None) or put_throttle
+
+page_put_queue = PutScheduler(config.max_queue_size)
+
+def async_put(lane):
+    """Daemon; take pages from the queue of a put lane and try to save them
+    on the wiki."""
     while True:
         (page, newtext, comment, watchArticle,
-                 minorEdit, force, callback) = page_put_queue.get()
+                 minorEdit, force, callback) = lane.queue.get()
         if page is None:
             # an explicit end-of-Queue marker is needed for compatibility
             # with Python 2.4; in 2.5, we could use the Queue's task_done()
             # and join() methods
             return
+        lane.busy = True
         try:
             page.put(newtext, comment, watchArticle, minorEdit, force)
             error = None
         except Exception, error:
             pass
+        lane.busy = False
         if callback is not None:
             callback(page, error)
             # if callback is provided, it is responsible for exception handling
@@ -7538,13 +7740,6 @@ def async_put():
             output(u"Saving page %s failed:\n%s"
                    % (page.aslink(True), "".join(tb)))
 
-_putthread = threading.Thread(target=async_put)
-# identification for debugging purposes
-_putthread.setName('Put-Thread')
-_putthread.setDaemon(True)
-## Don't start the queue if it is not necessary.
-#_putthread.start()
-
 def stopme():
     """This should be run when a bot does not interact with the Wiki, or
        when it has stopped doing so. After a bot has run stopme() it will
@@ -7558,24 +7753,32 @@ def _flush():
     Called automatically upon exiting from Python.
 
     """
+    import datetime
     def remaining():
-        import datetime
-        remainingPages = page_put_queue.qsize() - 1
-            # -1 because we added a None element to stop the queue
-        remainingSeconds = datetime.timedelta(
-            seconds=(remainingPages * put_throttle.getDelay(True)))
+        remainingPages, remainingSeconds = page_put_queue.remaining()
+        remainingSeconds = datetime.timedelta(seconds=remainingSeconds)
         return (remainingPages, remainingSeconds)
 
-    page_put_queue.put((None, None, None, None, None, None, None))
+    def backlog():
+        lines = []
+        for site, pages, seconds in page_put_queue.backlog():
+            lines.append(u'  %s: %i pages, %s'
+                         % (site, pages,
+                            datetime.timedelta(seconds=int(seconds))))
+        return u'\n'.join(lines)
+
+    page_put_queue.stop()
 
-    if page_put_queue.qsize() > 1:
+    if page_put_queue.remaining()[0]:
         output(u'Waiting for %i pages to be put. Estimated time remaining: %s'
                % remaining())
+        output(backlog())
 
-    while(_putthread.isAlive()):
+    while(page_put_queue.isAlive()):
         try:
-            _putthread.join(1)
+            page_put_queue.join(1)
         except KeyboardInterrupt:
+            output(backlog())
             answer = inputChoice(u"""\
 There are %i pages remaining in the queue. Estimated time remaining: %s
 Really exit?"""
@@ -7587,11 +7790,15 @@ Really exit?"""
         get_throttle.drop()
     except NameError:
         pass
+    try:
+        http_connection_pool.close()
+    except NameError:
+        pass
     if config.use_diskcache and not config.use_api:
         for site in _sites.itervalues():
             if site._mediawiki_messages:
                 try:
-                    site._mediawiki_messages.delete()
+                    site._mediawiki_messages.close()
                 except OSError:
                     pass
 
@@ -7615,8 +7822,12 @@ def debugDump(name, site, error, data):
     f.close()
     output( u'ERROR: %s caused error %s. Dump %s created.' % (name,error,filename) )
 
-get_throttle = Throttle()
-put_throttle = Throttle(write=True)
+if config.shared_throttle:
+    get_throttle = TokenBucketThrottle()
+    put_throttle = TokenBucketThrottle(write=True)
+else:
+    get_throttle = Throttle()
+    put_throttle = Throttle(write=True)
 
 def decompress_gzip(data):
     # Use cStringIO if available
@@ -7662,6 +7873,158 @@ class U2RedirectHandler(urllib2.HTTPRedirectHandler):
         result.sheaders = [v for v in headers.__str__().split('\n') if v.startswith('Set-Cookie:')]
         return result
 
+class HTTPConnectionPool(object):
+    """Thread-safe pool of idle keep-alive http connections, keyed per host.
+
+    maxsize      - maximum number of idle connections kept for each host
+    idle_timeout - seconds after which an idle connection is discarded
+                   instead of being reused (the server has probably closed
+                   it in the meantime)
+
+    """
+    def __init__(self, maxsize=4, idle_timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return an idle connection for key, or None if there is none."""
+        now = time.time()
+        stale = []
+        conn = None
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate, since = idle.pop()
+                if now - since <= self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        finally:
+            self._lock.release()
+        for candidate in stale:
+            candidate.close()
+        return conn
+
+    def put(self, key, conn):
+        """Give a connection that is no longer in use back to the pool."""
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                conn = None
+        finally:
+            self._lock.release()
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for connections in idle.itervalues():
+            for conn, since in connections:
+                conn.close()
+
+
+class KeepAliveHandlerMixin:
+    """Common part of the keep-alive http and https handlers for urllib2.
+
+    Unlike the default urllib2 handlers, which send 'Connection: close' and
+    open a new connection for every request, connections are taken from and
+    given back to an HTTPConnectionPool. The response body is read
+    completely before the connection is released.
+
+    """
+    def _keepalive_open(self, http_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (http_class, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict([(k, v) for k, v in req.headers.items()
+                             if k not in headers]))
+        headers['Connection'] = 'keep-alive'
+        headers = dict([(name.title(), val)
+                        for name, val in headers.items()])
+
+        while True:
+            conn = self.pool.get(key)
+            reused = conn is not None
+            if not reused:
+                conn = http_class(host, timeout=req.timeout)
+            # Only retry with a fresh connection if the server has clearly
+            # dropped the idle one before handling the request. Timeouts are
+            # never retried, and neither is a POST once its body was sent,
+            # since the server may have saved it already.
+            try:
+                conn.request(req.get_method(), req.get_selector(),
+                             req.data, headers)
+            except socket.timeout, err:
+                conn.close()
+                raise urllib2.URLError(err)
+            except socket.error, err:
+                conn.close()
+                if reused and err.errno in (errno.ECONNRESET, errno.EPIPE):
+                    continue
+                raise urllib2.URLError(err)
+            except httplib.HTTPException, err:
+                conn.close()
+                raise urllib2.URLError(err)
+            try:
+                r = conn.getresponse()
+                body = r.read()
+            except httplib.BadStatusLine, err:
+                conn.close()
+                if reused and req.get_method() != 'POST':
+                    continue
+                raise urllib2.URLError(err)
+            except (socket.error, httplib.HTTPException), err:
+                conn.close()
+                raise urllib2.URLError(err)
+            break
+
+        if r.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+
+        try:
+            from cStringIO import StringIO
+        except ImportError:
+            from StringIO import StringIO
+        resp = urllib.addinfourl(StringIO(body), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self._keepalive_open(httplib.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+
+    def __init__(self, pool):
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def https_open(self, req):
+        return self._keepalive_open(httplib.HTTPSConnection, req)
+
 # Site Cookies handler
 COOKIEFILE = config.datafilepath('login-data', 'cookies.lwp')
 cj = cookielib.LWPCookieJar()
@@ -7673,26 +8036,35 @@ cookieProcessor = urllib2.HTTPCookieProcessor(cj)
 
 MyURLopener = urllib2.build_opener(U2RedirectHandler)
 
-if config.proxy['host']:
-    proxyHandler = urllib2.ProxyHandler({'http':'http://%s/' % config.proxy['host'] })
-    
-    MyURLopener.add_handler(proxyHandler)
-    if config.proxy['auth']:
-        proxyAuth = urllib2.HTTPPasswordMgrWithDefaultRealm()
-        proxyAuth.add_password(None, config.proxy['host'], config.proxy['auth'][0], config.proxy['auth'][1])
-        proxyAuthHandler = urllib2.ProxyBasicAuthHandler(proxyAuth)
-        
-        MyURLopener.add_handler(proxyAuthHandler)
+# Opener used by sites with persistent_http enabled; it shares one pool of
+# keep-alive connections between all threads and sites.
+http_connection_pool = HTTPConnectionPool(config.persistent_http_pool_size,
+                                          config.persistent_http_idle_timeout)
+KeepAliveURLopener = urllib2.build_opener(
+    U2RedirectHandler, KeepAliveHTTPHandler(http_connection_pool),
+    KeepAliveHTTPSHandler(http_connection_pool))
+
+for _opener in (MyURLopener, KeepAliveURLopener):
+    if config.proxy['host']:
+        proxyHandler = urllib2.ProxyHandler({'http':'http://%s/' % config.proxy['host'] })
+
+        _opener.add_handler(proxyHandler)
+        if config.proxy['auth']:
+            proxyAuth = urllib2.HTTPPasswordMgrWithDefaultRealm()
+            proxyAuth.add_password(None, config.proxy['host'], config.proxy['auth'][0], config.proxy['auth'][1])
+            proxyAuthHandler = urllib2.ProxyBasicAuthHandler(proxyAuth)
+
+            _opener.add_handler(proxyAuthHandler)
 
-if config.authenticate:
-    passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-    for site in config.authenticate:
-        passman.add_password(None, site, config.authenticate[site][0], config.authenticate[site][1])
-    authhandler = urllib2.HTTPBasicAuthHandler(passman)
+    if config.authenticate:
+        passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        for site in config.authenticate:
+            passman.add_password(None, site, config.authenticate[site][0], config.authenticate[site][1])
+        authhandler = urllib2.HTTPBasicAuthHandler(passman)
 
-    MyURLopener.add_handler(authhandler)
+        _opener.add_handler(authhandler)
 
-MyURLopener.addheaders = [('User-agent', useragent)]
+    _opener.addheaders = [('User-agent', useragent)]
 
 if __name__ == '__main__':
     import doctest
@@ -23,6 +23,7 @@ to the older method using regular expressions.
 __version__='$Id$'
 #
 
+import os
 import threading
 import xml.sax
 import codecs, re
@@ -91,6 +92,33 @@ class XmlHeaderEntry:
         self.namespaces = {}
 
 
+class TitleNamespaces(object):
+    """
+    Tells the namespace numbers of the page titles in a dump of the given
+    site. Titles without a namespace prefix are in namespace 0; only the
+    prefixes which are namespace names are cached, so the cache doesn't
+    grow with the size of the dump.
+    """
+    def __init__(self, site):
+        self.site = site
+        self.cache = {}
+
+    def __call__(self, title):
+        if u':' not in title:
+            return 0
+        prefix = title.split(u':', 1)[0]
+        try:
+            return self.cache[prefix]
+        except KeyError:
+            pass
+        ns = self.site.getNamespaceIndex(prefix)
+        if ns is None:
+            # e.g. an article named 'Star Wars: Episode I'
+            return 0
+        self.cache[prefix] = ns
+        return ns
+
+
 class MediaWikiXmlHandler(xml.sax.handler.ContentHandler):
     def __init__(self):
         xml.sax.handler.ContentHandler.__init__(self)
@@ -257,6 +285,76 @@ class XmlParserThread(threading.Thread):
         xml.sax.parse(self.filename, self.handler)
 
 
+class XmlDumpIndex(object):
+    """
+    Index of an XML dump, as written by XmlDump.buildIndex(), which maps
+    page titles and ids to the offset of the page in the dump file (for
+    multistream bz2 dumps: to the offset of the stream containing the page).
+
+    The index file is read into memory when it is first used.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._titles = None
+
+    def _load(self):
+        self._titles = {}
+        self._ids = {}
+        offsets = set()
+        if self.filename.endswith('.bz2'):
+            import bz2
+            f = codecs.getreader('utf-8')(bz2.BZ2File(self.filename))
+        else:
+            f = codecs.open(self.filename, 'r', 'utf-8')
+        try:
+            for line in f:
+                offset, pageid, title = line.rstrip(u'\n').split(u':', 2)
+                offset = int(offset)
+                self._titles[title] = offset
+                self._ids[pageid] = offset
+                offsets.add(offset)
+        finally:
+            f.close()
+        self._offsets = sorted(offsets)
+
+    def find(self, title=None, pageid=None):
+        """Return the offset of the page with the given title or id, or
+        None if it is not in the index.
+        """
+        if self._titles is None:
+            self._load()
+        if title is not None:
+            return self._titles.get(title)
+        return self._ids.get(unicode(pageid))
+
+    def nextOffset(self, offset):
+        """Return the first offset in the index after offset, or None."""
+        if self._titles is None:
+            self._load()
+        import bisect
+        i = bisect.bisect_right(self._offsets, offset)
+        if i < len(self._offsets):
+            return self._offsets[i]
+        return None
+
+
+def _saveCheckpoint(checkpoint, offset):
+    # Write to a temporary file first, so that a crash while writing doesn't
+    # leave a truncated checkpoint behind.
+    tmp = checkpoint + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        f.write('%d\n' % offset)
+    finally:
+        f.close()
+    try:
+        os.rename(tmp, checkpoint)
+    except OSError:
+        # Windows doesn't replace existing files
+        os.unlink(checkpoint)
+        os.rename(tmp, checkpoint)
+
+
 class XmlDump(object):
     """
     Represents an XML dump file. Reads the local file at initialization,
@@ -270,9 +368,16 @@ class XmlDump(object):
         Only available for cElementTree version:
         If True, parse all revisions instead of only the latest one.
         Default: False.
+
+    Uncompressed and multistream bz2 dumps can also be parsed by a pool of
+    worker processes, see parallel_parse(), or be scanned with checkpoints
+    so that an interrupted scan can be resumed, see resumable_parse(). An
+    index of such dumps allows to read single pages and to start a scan at
+    a given page, see buildIndex().
     """
     def __init__(self, filename, allrevisions=False):
         self.filename = filename
+        self.allrevisions = allrevisions
         if allrevisions:
             self._parse = self._parse_all
         else:
@@ -304,6 +409,10 @@ Consider installing the python-celementtree package.''')
         else:
             # assume it's an uncompressed XML file
             source = open(self.filename)
+        return self._iterparse(source)
+
+    def _iterparse(self, source):
+        """Generator yielding the XmlEntry objects read from file object source"""
         context = iterparse(source, events=("start", "end", "start-ns"))
         self.root = None
 
@@ -317,6 +426,261 @@ Consider installing the python-celementtree package.''')
             for rev in self._parse(event, elem):
                 yield rev
 
+    def parallel_parse(self, processes=None, ordered=True, filter=None,
+                       shardsize=None):
+        """Return a generator that will yield XmlEntry objects, parsing the
+        dump with a pool of worker processes.
+
+        The dump is split into shards at <page> boundaries (for multistream
+        bz2 dumps: at bz2 stream boundaries), and each shard is parsed by a
+        worker process. Dumps which can't be split (.7z files and ordinary
+        single-stream bz2 files) are parsed in this process.
+
+        @param processes: number of worker processes; defaults to the number
+            of CPUs.
+        @param ordered: if True, entries are yielded in dump order. Otherwise
+            they are yielded as soon as their shard is parsed.
+        @param filter: optional callable taking an XmlEntry and returning
+            True if it should be yielded. It is called in the workers, so
+            that only matching entries are sent back; it must be picklable,
+            i.e. a module-level function or an instance of a module-level
+            class.
+        @param shardsize: approximate number of bytes read from the dump file
+            per shard.
+        """
+        if not 'iterparse' in globals():
+            wikipedia.output(
+u'''WARNING: cElementTree not found. The dump can't be parsed in parallel.''')
+            return self._filtered(self.regex_parse(), filter)
+        kind = self._kind()
+        if kind is None:
+            return self._filtered(self.new_parse(), filter)
+        if shardsize is None:
+            shardsize = _defaultShardSize[kind]
+        header, shards = self._shards(kind, shardsize)
+        return self._parallel(kind, header, shards, processes, ordered, filter)
+
+    def _parallel(self, kind, header, shards, processes, ordered, filter):
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            jobs = [(self.filename, kind, header, start, end,
+                     self.allrevisions, filter)
+                    for start, end in shards]
+            if ordered:
+                results = pool.imap(_parseShard, jobs)
+            else:
+                results = pool.imap_unordered(_parseShard, jobs)
+            for entries in results:
+                for entry in entries:
+                    yield entry
+            pool.close()
+        finally:
+            pool.terminate()
+
+    def _filtered(self, entries, filter):
+        for entry in entries:
+            if filter is None or filter(entry):
+                yield entry
+
+    def _kind(self):
+        """Return 'xml' or 'bz2' if the dump can be split into shards,
+        or None if it has to be parsed as one stream.
+        """
+        if self.filename.endswith('.7z'):
+            return None
+        elif self.filename.endswith('.bz2'):
+            f = open(self.filename, 'rb')
+            try:
+                if len(_findAll(f, _Rbz2stream, 10, limit=2)) < 2:
+                    # ordinary single stream bz2 file
+                    return None
+            finally:
+                f.close()
+            return 'bz2'
+        else:
+            return 'xml'
+
+    def _header(self, f, kind):
+        """Return the part of the dump before the first page, or None if
+        the dump contains no pages.
+        """
+        if kind == 'bz2':
+            # the first stream of a multistream dump contains the siteinfo
+            streams = _findAll(f, _Rbz2stream, 10, limit=2)
+            f.seek(streams[0])
+            header = _decompressStreams(f.read(streams[1] - streams[0]))
+            first = header.find('<page>')
+            if first != -1:
+                header = header[:first]
+        else:
+            first = _findAll(f, _Rpage, 6, limit=1)
+            if not first:
+                return None
+            f.seek(0)
+            header = f.read(first[0])
+        return header
+
+    def _shards(self, kind, shardsize, start=None, end=None):
+        """Return the dump header and a list of (start, end) byte ranges
+        of the dump file, each containing complete pages.
+
+        If given, start and end must be offsets of pages (for multistream
+        bz2 dumps: of streams), as found in the dump index.
+        """
+        f = open(self.filename, 'rb')
+        try:
+            header = self._header(f, kind)
+            if header is None:
+                return '', []
+            if end is None:
+                end = os.path.getsize(self.filename)
+            if kind == 'bz2':
+                # each stream of a multistream dump contains complete pages
+                offsets = [offset
+                           for offset in _findAll(f, _Rbz2stream, 10, start or 0)
+                           if offset < end]
+            else:
+                if start is None:
+                    start = len(header)
+                offsets = [start]
+                while offsets[-1] + shardsize < end:
+                    found = _findAll(f, _Rpage, 6, offsets[-1] + shardsize, 1)
+                    if not found or found[0] >= end:
+                        break
+                    offsets.append(found[0])
+            if not offsets or offsets[0] >= end:
+                return header, []
+            offsets.append(end)
+        finally:
+            f.close()
+        shards = []
+        start = offsets[0]
+        for i in range(1, len(offsets)):
+            if offsets[i] - start >= shardsize or i == len(offsets) - 1:
+                shards.append((start, offsets[i]))
+                start = offsets[i]
+        return header, shards
+
+    def resumable_parse(self, checkpoint=None, start=None, end=None,
+                        shardsize=None):
+        """Return a generator that will yield XmlEntry objects, reading the
+        dump shard by shard so that an interrupted scan can be resumed.
+
+        Only uncompressed and multistream bz2 dumps can be read this way.
+
+        @param checkpoint: name of a file to which the offset reached is
+            written after each shard. If it exists, the scan continues from
+            the offset saved in it. It is removed when the scan is complete.
+        @param start: offset at which the scan starts, as returned by
+            XmlDumpIndex.find(). Default: the first page.
+        @param end: offset at which the scan stops. Default: end of file.
+        @param shardsize: approximate number of bytes read from the dump file
+            between two checkpoints.
+        """
+        kind = self._kind()
+        if kind is None:
+            raise wikipedia.Error(u'Dump %s cannot be read from an offset'
+                                  % self.filename)
+        if shardsize is None:
+            shardsize = _defaultShardSize[kind]
+        if checkpoint and os.path.exists(checkpoint):
+            try:
+                f = open(checkpoint)
+                try:
+                    reached = int(f.read().strip())
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                wikipedia.output(u'WARNING: Cannot read checkpoint %s, '
+                                 u'starting the dump scan from the beginning'
+                                 % checkpoint)
+            else:
+                if start is None or reached > start:
+                    start = reached
+                wikipedia.output(u'Resuming dump scan at offset %d' % start)
+        header, shards = self._shards(kind, shardsize, start, end)
+        for shard in shards:
+            for entry in _parseShard((self.filename, kind, header,
+                                      shard[0], shard[1],
+                                      self.allrevisions, None)):
+                yield entry
+            if checkpoint:
+                _saveCheckpoint(checkpoint, shard[1])
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def buildIndex(self, indexfile=None):
+        """Scan the dump and write a sidecar index of it, mapping the title
+        and id of every page to its offset. Returns an XmlDumpIndex.
+
+        The index file (default: the dump file name with '.index' appended)
+        uses the format of the multistream index files offered by Wikimedia,
+        one 'offset:pageid:title' line per page, so that such an index can
+        also be used directly.
+        """
+        kind = self._kind()
+        if kind is None:
+            raise wikipedia.Error(u'Dump %s cannot be read from an offset'
+                                  % self.filename)
+        if indexfile is None:
+            indexfile = self.filename + '.index'
+        wikipedia.output(u'Building index of %s...' % self.filename)
+        f = open(self.filename, 'rb')
+        out = codecs.open(indexfile, 'w', 'utf-8')
+        try:
+            if kind == 'bz2':
+                offsets = _findAll(f, _Rbz2stream, 10)
+                offsets.append(os.path.getsize(self.filename))
+                for i in range(len(offsets) - 1):
+                    f.seek(offsets[i])
+                    data = _decompressStreams(
+                        f.read(offsets[i + 1] - offsets[i]))
+                    for m in _Rtitle.finditer(data):
+                        out.write(u'%d:%s:%s\n' % (offsets[i], m.group('id'),
+                                                   _unescapeTitle(m)))
+            else:
+                for offset, m in _finditer(f, _Rtitle, 4096):
+                    out.write(u'%d:%s:%s\n' % (offset, m.group('id'),
+                                               _unescapeTitle(m)))
+        finally:
+            out.close()
+            f.close()
+        return XmlDumpIndex(indexfile)
+
+    def index(self, indexfile=None):
+        """Return the XmlDumpIndex of this dump, or None if it has not been
+        built yet. See buildIndex().
+        """
+        if indexfile is None:
+            indexfile = self.filename + '.index'
+        if not os.path.exists(indexfile):
+            return None
+        return XmlDumpIndex(indexfile)
+
+    def getEntry(self, index, title=None, pageid=None):
+        """Read a single page from the dump using its index, without
+        scanning the dump. Returns an XmlEntry, or None if the page is not
+        in the dump.
+        """
+        offset = index.find(title=title, pageid=pageid)
+        if offset is None:
+            return None
+        kind = self._kind()
+        f = open(self.filename, 'rb')
+        try:
+            header = self._header(f, kind)
+        finally:
+            f.close()
+        end = index.nextOffset(offset)
+        if end is None:
+            end = os.path.getsize(self.filename)
+        for entry in _parseShard((self.filename, kind, header, offset, end,
+                                  False, None)):
+            if entry.title == title or entry.id == unicode(pageid):
+                return entry
+        return None
+
     def _parse_only_latest(self, event, elem):
         """Parser that yields only the latest revision"""
         if event == "end" and elem.tag == "{%s}page" % self.uri:
@@ -435,3 +799,97 @@ Consider installing the python-celementtree package.''')
                                    moveRestriction=moveRestriction,
                                    revisionid=m.group('revisionid')
                                   )
+
+
+# default number of bytes read from the dump file per shard by
+# XmlDump.parallel_parse()
+_defaultShardSize = {
+    'xml': 32 * 1024 * 1024,
+    'bz2': 4 * 1024 * 1024,
+}
+
+# start of a bz2 stream: stream header followed by a block header or, for an
+# empty stream, the end of stream marker
+_Rbz2stream = re.compile('BZh[1-9](?:1AY&SY|\x17rE8P\x90)')
+_Rpage = re.compile('<page>')
+
+_Rtitle = re.compile(r'<page>\s*<title>(?P<title>[^<]*)</title>\s*'
+                    r'(?:<ns>-?\d+</ns>\s*)?<id>(?P<id>\d+)</id>')
+
+def _unescapeTitle(m):
+    """Return the title matched by _Rtitle as a unicode string"""
+    from xml.sax.saxutils import unescape
+    return unescape(m.group('title').decode('utf-8'), {'&quot;': '"'})
+
+def _finditer(f, regex, overlap, start=0):
+    """Yield (offset, match) tuples for the matches of regex in file f,
+    starting the search at offset start. overlap is the maximum length of
+    a match.
+    """
+    blocksize = 1024 * 1024
+    f.seek(start)
+    data = f.read(blocksize)
+    pos = start
+    last = -1
+    while data:
+        for m in regex.finditer(data):
+            if pos + m.start() > last:
+                last = pos + m.start()
+                yield last, m
+        block = f.read(blocksize)
+        if not block:
+            break
+        # keep the tail of the previous block, a match might span both
+        pos += len(data) - overlap
+        data = data[-overlap:] + block
+
+def _findAll(f, regex, overlap, start=0, limit=None):
+    """Return the offsets of the matches of regex in file f, starting the
+    search at offset start. overlap is the maximum length of a match.
+    """
+    offsets = []
+    for offset, m in _finditer(f, regex, overlap, start):
+        offsets.append(offset)
+        if limit is not None and len(offsets) >= limit:
+            break
+    return offsets
+
+def _decompressStreams(data):
+    """Decompress data consisting of one or more complete bz2 streams"""
+    import bz2
+    result = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        result.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return ''.join(result)
+
+def _parseShard(args):
+    """Parse one shard of a dump; run by the worker processes of
+    XmlDump.parallel_parse(). Returns a list of XmlEntry objects.
+    """
+    filename, kind, header, start, end, allrevisions, filter = args
+    f = open(filename, 'rb')
+    try:
+        f.seek(start)
+        data = f.read(end - start)
+    finally:
+        f.close()
+    if kind == 'bz2':
+        data = _decompressStreams(data)
+    # strip the header of the first and the footer of the last shard
+    first = data.find('<page>')
+    if first == -1:
+        return []
+    data = data[first:]
+    last = data.rfind('</mediawiki>')
+    if last != -1:
+        data = data[:last]
+    try:
+        from cStringIO import StringIO
+    except ImportError:
+        from StringIO import StringIO
+    dump = XmlDump(filename, allrevisions)
+    source = StringIO(header + data + '</mediawiki>')
+    return [entry for entry in dump._iterparse(source)
+            if filter is None or filter(entry)]